@@ -21,13 +21,27 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+import os
 import processing
+from collections import OrderedDict
 from functools import partial
+from numpy import array, bincount, float64, int64, ma, zeros
 
 from qgis.core import (
     QgsApplication, QgsProcessingFeedback, QgsProcessingContext,
-    QgsProcessingAlgRunnerTask,
+    QgsProcessingAlgRunnerTask, QgsTask, QgsFeedback, QgsField,
+    QgsFeatureRequest, QgsVectorLayer, QgsVectorLayerFeatureSource,
+    QgsCoordinateTransform, QgsProject, QgsWkbTypes,
     )
+from svir.calculations.parallel import get_max_workers
+from svir.calculations.process_layer import ProcessLayer
+from svir.calculations.zonal_stats import (
+    assign_points_to_zones_in_parallel, summarize_by_zone,
+    coordinates_fingerprint, group_zones_by_code, roll_up_assignment,
+    NATIVE_SUMMARIES, ZONE_ASSIGNMENT_CACHE)
+from svir.utilities.shared import (
+    DOUBLE_FIELD_TYPE, DOUBLE_FIELD_TYPE_NAME,
+    INT_FIELD_TYPE, INT_FIELD_TYPE_NAME)
 from svir.utilities.utils import log_msg
 
 
@@ -53,10 +67,22 @@ ACTIVE_AGGREGATION_TASKS = []
 
 def calculate_zonal_stats(callback, zonal_layer, points_layer, join_fields,
                           output_layer_name, discard_nonmatching=False,
-                          predicates=('intersects',), summaries=('sum',)):
+                          predicates=('intersects',), summaries=('sum',),
+                          use_processing=False, max_workers=None):
     """
-    Leveraging the QGIS processing algorithm 'Join attributes by location
-    (summary)', that is described in QGIS as follows:
+    Calculate statistics of the values of the points in each zone. Unless
+    use_processing is True, they are calculated by a native task (see
+    :class:`ZonalStatsTask`), reading the points into numpy arrays and
+    grouping their values by zone, and the assignment of the points to the
+    zones is cached, to be reused aggregating other layers of points located
+    on the same sites. With many points, the zones are partitioned into
+    spatial tiles that are joined with the points by parallel worker
+    processes. The native task gives the same results of
+    the QGIS processing algorithm 'Join attributes by location (summary)',
+    that is used instead for predicates other than 'intersects', for
+    summaries not in NATIVE_SUMMARIES, for non-numeric join fields and for
+    layers of non-point features.
+    The processing algorithm is described in QGIS as follows:
     This algorithm takes an input vector layer and creates a new vector layer
     that is an extended version of the input one, with additional attributes in
     its attribute table. The additional attributes and their values are taken
@@ -82,12 +108,86 @@ def calculate_zonal_stats(callback, zonal_layer, points_layer, join_fields,
     :param predicates: geometric predicates (default: 'intersects')
     :param summaries: statistics to be calculated for each join field
         (default: 'sum')
+    :param use_processing: if True, the processing algorithm is used even
+        when the native task could be used
+    :param max_workers: the maximum number of worker processes joining the
+        points with the zones (if None, it is read from the settings; if 1,
+        points are joined sequentially)
 
     :returns: it waits until the task is complete or terminated, then it
         calls the callback function, passing the output QgsVectorLayer as
         parameter, or None in case of failure
     """
 
+    if isinstance(zonal_layer, str):
+        zonal_layer = QgsVectorLayer(
+            zonal_layer, os.path.basename(zonal_layer), 'ogr')
+    if isinstance(points_layer, str):
+        points_layer = QgsVectorLayer(
+            points_layer, os.path.basename(points_layer), 'ogr')
+    if use_processing or not ZonalStatsTask.can_summarize(
+            points_layer, join_fields, predicates, summaries):
+        _calculate_zonal_stats_with_processing(
+            callback, zonal_layer, points_layer, join_fields,
+            output_layer_name, discard_nonmatching, predicates, summaries)
+        return
+    task = ZonalStatsTask(
+        'Aggregating points by zone', zonal_layer,
+        [(points_layer, join_fields, '')], output_layer_name, callback,
+        discard_nonmatching=discard_nonmatching, summaries=summaries,
+        max_workers=max_workers)
+    # keep the task alive at module level
+    ACTIVE_AGGREGATION_TASKS.append(task)
+    QgsApplication.taskManager().addTask(task)
+
+
+def calculate_multi_layer_zonal_stats(
+        callback, zonal_layer, inputs, output_layer_name,
+        discard_nonmatching=False, summaries=('sum',), max_workers=None):
+    """
+    Calculate statistics of the values of several fields of several layers
+    of points in each zone, with a single task, adding all of them to the
+    same output layer (see :func:`calculate_zonal_stats`). The points are
+    joined with the zones only once for each distinct set of sites.
+
+    :param callback: function to be called once the aggregation is complete,
+        passing the output zonal layer (or None in case of failure)
+    :param zonal_layer: vector layer containing polygons
+    :param inputs: a list of tuples (points_layer, join_fields, prefix), where
+        prefix is prepended to the names of the output fields of the join
+        fields of the points layer (e.g. '<prefix><field>_sum')
+    :param output_layer_name: the name of the output memory layer
+    :param discard_nonmatching: discard zones that contain no points of any
+        of the layers
+    :param summaries: statistics to be calculated for each join field
+        (default: 'sum')
+    :param max_workers: the maximum number of worker processes joining the
+        points with the zones (if None, it is read from the settings)
+    """
+    _check_inputs(inputs, summaries)
+    task = ZonalStatsTask(
+        'Aggregating points by zone', zonal_layer, inputs, output_layer_name,
+        callback, discard_nonmatching=discard_nonmatching,
+        summaries=summaries, max_workers=max_workers)
+    # keep the task alive at module level
+    ACTIVE_AGGREGATION_TASKS.append(task)
+    QgsApplication.taskManager().addTask(task)
+
+
+def _check_inputs(inputs, summaries):
+    for points_layer, join_fields, _ in inputs:
+        if not ZonalStatsTask.can_summarize(
+                points_layer, join_fields, ('intersects',), summaries):
+            raise ValueError(
+                'Unable to aggregate the fields %s of layer %s by zone: the'
+                ' layer must contain points, the fields must be numeric and'
+                ' the summaries must be in %s' % (
+                    join_fields, points_layer.name(), NATIVE_SUMMARIES))
+
+
+def _calculate_zonal_stats_with_processing(
+        callback, zonal_layer, points_layer, join_fields, output_layer_name,
+        discard_nonmatching, predicates, summaries):
     processing.Processing.initialize()
     # Using createAlgorithmById instead of algorithmById, to get a
     # fresh instance for this task
@@ -149,3 +249,402 @@ def task_finished(task, callback, successful, results):
     except Exception as exc:
         log_msg(f'Error retrieving output layer: {exc}', level='C')
         callback(None)
+
+
+class ZonalStatsTask(QgsTask):
+    """
+    Task calculating statistics of the values of the points in each zone
+    (see :func:`calculate_zonal_stats` and
+    :func:`calculate_multi_layer_zonal_stats`). Points and zones are read in
+    the background into numpy arrays, each point is assigned to the zones it
+    intersects (see
+    :func:`svir.calculations.zonal_stats.assign_points_to_zones_in_parallel`),
+    unless the assignment is found in the ZONE_ASSIGNMENT_CACHE, and values
+    are grouped by zone (see
+    :func:`svir.calculations.zonal_stats.summarize_by_zone`). Once the task
+    is complete, in the main thread, the zonal layer is copied into a memory
+    layer and all the statistics are written into it at once.
+    """
+    def __init__(self, description, zonal_layer, inputs, output_layer_name,
+                 callback, discard_nonmatching=False, summaries=('sum',),
+                 max_workers=None):
+        """
+        :param inputs: a list of tuples (points_layer, join_fields, prefix),
+            where prefix is prepended to the names of the output fields of
+            the join fields of the points layer. All the output fields are
+            added to the same output layer
+        :param max_workers: the maximum number of worker processes joining
+            the points with the zones (if None, it is read from the settings)
+        """
+        super().__init__(description, QgsTask.CanCancel)
+        self.zonal_layer = zonal_layer
+        self.output_layer_name = output_layer_name
+        self.callback = callback
+        self.discard_nonmatching = discard_nonmatching
+        self.summaries = list(summaries)
+        # settings are read in the main thread
+        if max_workers is None:
+            max_workers = get_max_workers()
+        self.max_workers = max_workers
+        # features have to be read from sources built in the main thread.
+        # Zones are read from the data provider, as the copy of the zonal
+        # layer, so they are in the same order
+        self.zonal_source = zonal_layer.dataProvider().featureSource()
+        self.zonal_state = ZONE_ASSIGNMENT_CACHE.zonal_state(zonal_layer)
+        self.inputs = []
+        for points_layer, join_fields, prefix in inputs:
+            # zones are transformed into the crs of the points
+            transform = None
+            if zonal_layer.crs() != points_layer.crs():
+                transform = QgsCoordinateTransform(
+                    zonal_layer.crs(), points_layer.crs(),
+                    QgsProject.instance())
+            self.inputs.append((
+                points_layer, list(join_fields), prefix,
+                QgsVectorLayerFeatureSource(points_layer),
+                points_layer.crs().toWkt(), transform))
+        self.feedback = QgsFeedback()
+        self.feedback.progressChanged.connect(self.setProgress)
+        self.stats = None
+        self.matched = None
+        self.exception = None
+
+    @staticmethod
+    def can_summarize(points_layer, join_fields, predicates, summaries):
+        """
+        Check if the statistics can be calculated by the task
+
+        :returns: True if the points layer contains single points, all the
+                  join fields are numeric, the only predicate is
+                  'intersects' and all the summaries are in NATIVE_SUMMARIES
+        """
+        if QgsWkbTypes.flatType(points_layer.wkbType()) != QgsWkbTypes.Point:
+            return False
+        if set(predicates) != {'intersects'}:
+            return False
+        if not set(summaries).issubset(NATIVE_SUMMARIES):
+            return False
+        fields = points_layer.fields()
+        for field_name in join_fields:
+            field_idx = fields.indexOf(field_name)
+            if field_idx == -1 or not fields.at(field_idx).isNumeric():
+                return False
+        return True
+
+    def cancel(self):
+        self.feedback.cancel()
+        super().cancel()
+
+    def run(self):
+        try:
+            self.stats = OrderedDict()
+            assignments = {}
+            for (points_layer, join_fields, prefix, points_source,
+                    points_crs, transform) in self.inputs:
+                _, points = ProcessLayer(points_layer).to_numpy(
+                    join_fields, geometry='xy', source=points_source)
+                fingerprint = coordinates_fingerprint(
+                    points['$x'], points['$y'])
+                # points located on the same sites of the previous layers
+                # are not joined again
+                assignment = assignments.get((points_crs, fingerprint))
+                if assignment is None:
+                    assignment = ZONE_ASSIGNMENT_CACHE.get(
+                        self.zonal_state, points_crs, fingerprint)
+                if assignment is None:
+                    assignment = self.assign_points_to_zones(
+                        points, transform)
+                    if assignment is None:
+                        return False
+                    ZONE_ASSIGNMENT_CACHE.put(
+                        self.zonal_state, points_crs, fingerprint,
+                        assignment)
+                assignments[(points_crs, fingerprint)] = assignment
+                self.add_stats(points, join_fields, prefix, assignment)
+                if self.isCanceled():
+                    return False
+        except Exception as exc:
+            self.exception = exc
+            return False
+        return not self.isCanceled()
+
+    def add_stats(self, points, join_fields, prefix, assignment):
+        """
+        Calculate the statistics of the join fields of a layer of points in
+        each zone
+
+        :param points: numpy table with the values of the points
+        :param join_fields: names of the fields to be aggregated
+        :param prefix: prefix of the names of the statistics
+        :param assignment: a tuple (point_idxs, zone_idxs, n_zones)
+        """
+        point_idxs, zone_idxs, n_zones = assignment
+        matched = bincount(zone_idxs, minlength=n_zones) > 0
+        if self.matched is None:
+            self.matched = matched
+        else:
+            self.matched |= matched
+        self.stats.update(self.summarize(
+            points, join_fields, prefix, point_idxs, zone_idxs, n_zones))
+
+    def summarize(self, points, join_fields, prefix, point_idxs, zone_idxs,
+                  n_zones):
+        """
+        :returns: an ordered dict statistic name -> numpy masked array with
+                  the values of the statistic in each zone
+        """
+        stats = OrderedDict()
+        for field_name in join_fields:
+            field_stats = summarize_by_zone(
+                zone_idxs, points[field_name][point_idxs], n_zones,
+                self.summaries)
+            for summary, values in field_stats.items():
+                stats['%s%s_%s' % (prefix, field_name, summary)] = values
+        return stats
+
+    def assign_points_to_zones(self, points, transform=None):
+        """
+        Read the zones and find the zones intersecting each point
+
+        :param points: numpy table with the coordinates of the points
+        :param transform: the (optional) QgsCoordinateTransform from the crs
+            of the zones to the crs of the points
+        :returns: a tuple (point_idxs, zone_idxs, n_zones), or None if the
+                  task was canceled
+        """
+        zone_geometries = []
+        request = QgsFeatureRequest().setNoAttributes()
+        for feat in self.zonal_source.getFeatures(request):
+            geom = feat.geometry()
+            if transform is not None and not geom.isNull():
+                geom.transform(transform)
+            zone_geometries.append(geom)
+        assignment = assign_points_to_zones_in_parallel(
+            points['$x'], points['$y'], zone_geometries, self.feedback,
+            self.max_workers)
+        if assignment is None:
+            return None
+        point_idxs, zone_idxs = assignment
+        return point_idxs, zone_idxs, len(zone_geometries)
+
+    def finished(self, success):
+        if self in ACTIVE_AGGREGATION_TASKS:
+            ACTIVE_AGGREGATION_TASKS.remove(self)
+        output_layer = None
+        if success:
+            try:
+                output_layer = self.build_output()
+            except Exception as exc:
+                self.exception = exc
+        if self.exception is not None:
+            log_msg('Unable to aggregate points by zone', level='C',
+                    exception=self.exception)
+        elif output_layer is None:
+            log_msg('Task failed or canceled', level='W')
+        self.callback(output_layer)
+
+    def build_output(self):
+        """
+        :returns: the output of the task, passed to the callback
+        """
+        return self.build_output_layer()
+
+    def build_output_layer(self):
+        """
+        Copy the zonal layer into a memory layer, adding the statistics with
+        a single bulk write
+
+        :returns: the output memory layer
+        """
+        output_layer = ProcessLayer(self.zonal_layer).duplicate_in_memory(
+            self.output_layer_name)
+        proc = ProcessLayer(output_layer)
+        feature_ids, _ = proc.to_numpy([])
+        if len(feature_ids) != len(self.matched):
+            raise RuntimeError('The zonal layer was modified during the'
+                               ' aggregation')
+        if self.discard_nonmatching:
+            if not output_layer.dataProvider().deleteFeatures(
+                    feature_ids[~self.matched].tolist()):
+                raise RuntimeError('Unable to discard the zones without'
+                                   ' points')
+            feature_ids = feature_ids[self.matched]
+        self.write_stats(proc, self.stats, self.matched, feature_ids)
+        return output_layer
+
+    def write_stats(self, proc, stats, matched, feature_ids=None,
+                    columns=()):
+        """
+        Add the fields of the statistics to a layer, and write their values
+        with a single bulk write
+
+        :param proc: the ProcessLayer of the output layer
+        :param stats: an ordered dict statistic name -> values in each zone
+        :param matched: a boolean numpy array, True for zones with points
+        :param feature_ids: the ids of the features to be updated (if None,
+            a new feature is added for each zone)
+        :param columns: a list of tuples (field, values) of other fields to
+            be added and written before the statistics, where values is a
+            numpy array with a value for each zone
+        """
+        fields = [field for field, _ in columns]
+        for stat_name in stats:
+            if stat_name.endswith('_count'):
+                field = QgsField(stat_name, INT_FIELD_TYPE)
+                field.setTypeName(INT_FIELD_TYPE_NAME)
+            else:
+                field = QgsField(stat_name, DOUBLE_FIELD_TYPE)
+                field.setTypeName(DOUBLE_FIELD_TYPE_NAME)
+            fields.append(field)
+        attr_names = proc.add_attributes(fields)
+        dtype = [(attr_names[field.name()], object) for field, _ in columns]
+        dtype.extend((attr_names[stat_name],
+                      int64 if stat_name.endswith('_count') else float64)
+                     for stat_name in stats)
+        n_rows = int(matched.sum()) if self.discard_nonmatching else len(
+            matched)
+        table = ma.array(zeros(n_rows, dtype=dtype))
+        for field, values in columns:
+            if self.discard_nonmatching:
+                values = values[matched]
+            table[attr_names[field.name()]] = values
+        for stat_name, values in stats.items():
+            if self.discard_nonmatching:
+                values = values[matched]
+            table[attr_names[stat_name]] = values
+        proc.from_numpy(table, feature_ids=feature_ids)
+
+
+class ZonalStatsRollupTask(ZonalStatsTask):
+    """
+    Task calculating statistics of the values of the points at several
+    levels of a hierarchy of zones (e.g. districts, regions and countries),
+    joining the points only with the finest zones (see
+    :class:`ZonalStatsTask`). The statistics of each coarser level are
+    calculated grouping the finest zones by the code of their parent zone
+    at that level (see
+    :func:`svir.calculations.zonal_stats.group_zones_by_code`), that has to
+    be an attribute of the finest zonal layer. A point matching several
+    finest zones of the same parent (e.g. on the border between them) is
+    counted only once for the parent. The callback receives a list of output
+    layers: the copy of the finest zonal layer, followed by a layer without
+    geometries for each coarser level, containing the parent codes and their
+    statistics.
+    """
+    def __init__(self, description, zonal_layer, inputs, parent_code_fields,
+                 output_layer_name, callback, discard_nonmatching=False,
+                 summaries=('sum',), max_workers=None):
+        """
+        :param parent_code_fields: names of the fields of the zonal layer
+            containing the codes of the parent zones of each coarser level,
+            from the finest to the coarsest
+        """
+        super().__init__(description, zonal_layer, inputs, output_layer_name,
+                         callback, discard_nonmatching=discard_nonmatching,
+                         summaries=summaries, max_workers=max_workers)
+        self.parent_code_fields = list(parent_code_fields)
+        self.levels = None
+
+    def run(self):
+        try:
+            _, parent_codes = ProcessLayer(self.zonal_layer).to_numpy(
+                self.parent_code_fields, source=self.zonal_source)
+            # each level is a dict with the group of each zone, the codes of
+            # the groups, and their statistics
+            self.levels = []
+            for field_name in self.parent_code_fields:
+                group_idxs, group_codes = group_zones_by_code(
+                    parent_codes[field_name])
+                self.levels.append(dict(
+                    field_name=field_name, group_idxs=group_idxs,
+                    group_codes=group_codes, stats=OrderedDict(),
+                    matched=None))
+        except Exception as exc:
+            self.exception = exc
+            return False
+        return super().run()
+
+    def add_stats(self, points, join_fields, prefix, assignment):
+        super().add_stats(points, join_fields, prefix, assignment)
+        point_idxs, zone_idxs, n_zones = assignment
+        for level in self.levels:
+            if len(level['group_idxs']) != n_zones:
+                raise RuntimeError('The zonal layer was modified during the'
+                                   ' aggregation')
+            group_point_idxs, group_idxs = roll_up_assignment(
+                point_idxs, zone_idxs, level['group_idxs'])
+            n_groups = len(level['group_codes'])
+            matched = bincount(group_idxs, minlength=n_groups) > 0
+            if level['matched'] is None:
+                level['matched'] = matched
+            else:
+                level['matched'] |= matched
+            level['stats'].update(self.summarize(
+                points, join_fields, prefix, group_point_idxs, group_idxs,
+                n_groups))
+
+    def build_output(self):
+        """
+        :returns: a list with the output layer of each level, from the
+                  finest to the coarsest
+        """
+        output_layers = [self.build_output_layer()]
+        zonal_fields = self.zonal_layer.fields()
+        for level in self.levels:
+            field_name = level['field_name']
+            level_layer = QgsVectorLayer(
+                'None', '%s by %s' % (self.output_layer_name, field_name),
+                'memory')
+            code_field = QgsField(
+                zonal_fields.at(zonal_fields.indexOf(field_name)))
+            self.write_stats(
+                ProcessLayer(level_layer), level['stats'], level['matched'],
+                columns=[(code_field, array(level['group_codes'],
+                                            dtype=object))])
+            output_layers.append(level_layer)
+        return output_layers
+
+
+def calculate_rollup_zonal_stats(
+        callback, zonal_layer, inputs, parent_code_fields, output_layer_name,
+        discard_nonmatching=False, summaries=('sum',), max_workers=None):
+    """
+    Calculate statistics of the values of several fields of several layers
+    of points at several levels of a hierarchy of zones, joining the points
+    only with the finest zones and deriving the coarser levels from the
+    codes of their parent zones (see :class:`ZonalStatsRollupTask`)
+
+    :param callback: function to be called once the aggregation is complete,
+        passing the list of output layers, from the finest to the coarsest
+        level (or None in case of failure)
+    :param zonal_layer: vector layer containing the polygons of the finest
+        zones
+    :param inputs: a list of tuples (points_layer, join_fields, prefix) (see
+        :func:`calculate_multi_layer_zonal_stats`)
+    :param parent_code_fields: names of the fields of the zonal layer
+        containing the codes of the parent zones at each coarser level
+        (e.g. ['ID_1', 'ID_0'] for the regions and the countries containing
+        districts)
+    :param output_layer_name: the name of the output memory layer of the
+        finest level (the other layers are named '<name> by <field>')
+    :param discard_nonmatching: discard zones that contain no points of any
+        of the layers, at each level
+    :param summaries: statistics to be calculated for each join field
+        (default: 'sum')
+    :param max_workers: the maximum number of worker processes joining the
+        points with the zones (if None, it is read from the settings)
+    """
+    fields = zonal_layer.fields()
+    for field_name in parent_code_fields:
+        if fields.indexOf(field_name) == -1:
+            raise ValueError('The zonal layer %s does not contain the field'
+                             ' %s' % (zonal_layer.name(), field_name))
+    _check_inputs(inputs, summaries)
+    task = ZonalStatsRollupTask(
+        'Aggregating points by zone at several levels', zonal_layer, inputs,
+        parent_code_fields, output_layer_name, callback,
+        discard_nonmatching=discard_nonmatching, summaries=summaries,
+        max_workers=max_workers)
+    # keep the task alive at module level
+    ACTIVE_AGGREGATION_TASKS.append(task)
+    QgsApplication.taskManager().addTask(task)
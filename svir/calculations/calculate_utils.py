@@ -30,6 +30,28 @@ from svir.utilities.shared import (
 
 
 def add_attribute(proposed_attr_name, dtype, layer):
+    assigned_attr_names = add_attributes({proposed_attr_name: dtype}, layer)
+    assigned_attr_name = assigned_attr_names[proposed_attr_name]
+    return assigned_attr_name
+
+
+def add_attributes(field_types, layer):
+    """
+    Add to the layer all the given fields at once (see
+    :meth:`svir.calculations.process_layer.ProcessLayer.add_attributes`)
+
+    :param field_types: dict field_name -> numpy dtype char ('S' for strings,
+                        'U' and 'I' for unsigned and signed integers, doubles
+                        otherwise)
+    :param layer: the layer to which fields are added
+    :returns: dict field_name -> name actually assigned to the field
+    """
+    fields = [_build_field(field_name, dtype)
+              for field_name, dtype in field_types.items()]
+    return ProcessLayer(layer).add_attributes(fields)
+
+
+def _build_field(proposed_attr_name, dtype):
     # TODO: map numpy types to qt types more precisely to optimize storage
     if dtype == 'S':
         qtype = STRING_FIELD_TYPE
@@ -45,7 +67,4 @@ def add_attribute(proposed_attr_name, dtype, layer):
         qname = 'Double'
     field = QgsField(proposed_attr_name, qtype)
     field.setTypeName(qname)
-    assigned_attr_names = ProcessLayer(layer).add_attributes(
-        [field])
-    assigned_attr_name = assigned_attr_names[proposed_attr_name]
-    return assigned_attr_name
+    return field
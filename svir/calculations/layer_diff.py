@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+from collections import OrderedDict
+from numpy import (
+    abs as numpy_abs, array, concatenate, errstate, unique, float64, int64,
+    ma)
+
+from svir.calculations.process_layer import ProcessLayer
+from svir.utilities.shared import TRANSFORMATION_CHUNK_SIZE
+
+
+class LayerDiff(object):
+    """
+    Report of the differences between the contents of two layers, as built
+    by :func:`diff_layers`. Features are matched by their position in the
+    layers, and they are referred to by their ids in the first layer.
+
+    :param field_names: tuple with the names of the fields of the two layers
+    :param feature_counts: tuple with the number of features of the two
+                           layers
+    """
+    def __init__(self, field_names, feature_counts):
+        self.field_names = field_names
+        self.feature_counts = feature_counts
+        # field name -> ids of the features whose values differ
+        self.differences = OrderedDict()
+        # field name -> (hash of the column of the first layer, hash of the
+        # column of the second layer), that depend on the size of the chunks
+        # the layers were read in
+        self.hashes = OrderedDict()
+
+    @property
+    def missing_fields(self):
+        """Fields of the first layer that are not in the second one"""
+        return [name for name in self.field_names[0]
+                if name not in self.field_names[1]]
+
+    @property
+    def extra_fields(self):
+        """Fields of the second layer that are not in the first one"""
+        return [name for name in self.field_names[1]
+                if name not in self.field_names[0]]
+
+    @property
+    def differing_feature_ids(self):
+        """Sorted ids of the features that differ in any field"""
+        if not self.differences:
+            return array([], dtype=int64)
+        return unique(concatenate(list(self.differences.values())))
+
+    @property
+    def is_equal(self):
+        """True if the two layers have the same fields and contents"""
+        return (self.field_names[0] == self.field_names[1]
+                and self.feature_counts[0] == self.feature_counts[1]
+                and not self.differences)
+
+    def __repr__(self):
+        if self.is_equal:
+            return '<LayerDiff: equal>'
+        return ('<LayerDiff: feature counts %s, missing fields %s,'
+                ' extra fields %s, differing fields %s>' % (
+                    self.feature_counts, self.missing_fields,
+                    self.extra_fields,
+                    {name: len(feature_ids)
+                     for name, feature_ids in self.differences.items()}))
+
+
+def diff_layers(layer, other_layer, decimal=7, chunk_size=None,
+                stop_at_first=False):
+    """
+    Compare the contents of two layers, reading them in chunks of columns
+    (see :meth:`svir.calculations.process_layer.ProcessLayer.iter_numpy`).
+    Numeric values are compared with a tolerance, as done by
+    `numpy.testing.assert_almost_equal`, while other values must be equal.
+    For each chunk, the values of a column are compared only if the hashes
+    of the column in the two layers differ.
+
+    :param layer: the first layer
+    :type layer: QgsVectorLayer
+    :param other_layer: the layer to compare with
+    :type other_layer: QgsVectorLayer
+    :param decimal: numeric values are considered equal if they differ by
+                    less than 1.5 * 10**(-decimal)
+    :param chunk_size: maximum number of features read at once
+    :param stop_at_first: if True, the comparison stops as soon as a
+                          difference is found (the hashes of the columns are
+                          then incomplete)
+    :returns: a :class:`LayerDiff`
+    """
+    if chunk_size is None:
+        chunk_size = TRANSFORMATION_CHUNK_SIZE
+    field_names = tuple(
+        tuple(field.name() for field in lyr.fields())
+        for lyr in (layer, other_layer))
+    report = LayerDiff(field_names,
+                       (layer.featureCount(), other_layer.featureCount()))
+    if report.feature_counts[0] != report.feature_counts[1]:
+        return report
+    common_fields = [name for name in field_names[0]
+                     if name in field_names[1]]
+    if stop_at_first and not report.is_equal:
+        return report
+    hashers = OrderedDict(
+        (name, (hashlib.sha1(), hashlib.sha1())) for name in common_fields)
+    chunks = zip(
+        ProcessLayer(layer).iter_numpy(common_fields, chunk_size=chunk_size),
+        ProcessLayer(other_layer).iter_numpy(
+            common_fields, chunk_size=chunk_size))
+    tolerance = 1.5 * 10.0 ** (-decimal)
+    for (feature_ids, table), (_, other_table) in chunks:
+        for name in common_fields:
+            column = table[name]
+            other_column = other_table[name]
+            this_hash = _column_hash(column)
+            other_hash = _column_hash(other_column)
+            hashers[name][0].update(this_hash)
+            hashers[name][1].update(other_hash)
+            if this_hash == other_hash:
+                continue
+            differ = _differing(column, other_column, tolerance)
+            if differ.any():
+                if name in report.differences:
+                    report.differences[name] = concatenate(
+                        [report.differences[name], feature_ids[differ]])
+                else:
+                    report.differences[name] = feature_ids[differ]
+                if stop_at_first:
+                    return report
+    for name, (hasher, other_hasher) in hashers.items():
+        report.hashes[name] = (hasher.hexdigest(), other_hasher.hexdigest())
+    return report
+
+
+def _column_hash(column):
+    # digest of the mask and of the values that are not masked
+    mask = ma.getmaskarray(column)
+    digest = hashlib.sha1(mask.tobytes())
+    values = column.data[~mask]
+    if values.dtype == float64:
+        digest.update(values.tobytes())
+    else:
+        digest.update(repr(values.tolist()).encode('utf8'))
+    return digest.digest()
+
+
+def _differing(column, other_column, tolerance):
+    # boolean array, True where values differ
+    mask = ma.getmaskarray(column)
+    differ = mask != ma.getmaskarray(other_column)
+    valid = ~mask & ~differ
+    values = column.data[valid]
+    other_values = other_column.data[valid]
+    if values.dtype == other_values.dtype == float64:
+        # NaN (or infinite) values are equal to each other, as in
+        # assert_almost_equal
+        with errstate(invalid='ignore'):
+            differ[valid] = ~(
+                (values == other_values)
+                | (numpy_abs(values - other_values) < tolerance)
+                | ((values != values) & (other_values != other_values)))
+    else:
+        differ[valid] = [value != other_value for value, other_value
+                         in zip(values.tolist(), other_values.tolist())]
+    return differ
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from numpy import ndarray, float64, ma
+from qgis.PyQt.QtCore import QSettings
+
+from svir.calculations.transformation_algs import transform_array
+from svir.utilities.shared import DEFAULT_SETTINGS
+from svir.utilities.utils import log_msg
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+# below this amount of values, starting the worker processes takes longer
+# than transforming the values sequentially
+MIN_PARALLEL_VALUES = 1000000
+# minimum number of features read by each thread, when layers are read by
+# parallel threads
+MIN_PARALLEL_FEATURES = 10000
+# below this amount of points, starting the worker processes takes longer
+# than joining the points with the zones sequentially
+MIN_PARALLEL_POINTS = 200000
+
+
+def get_max_workers():
+    """
+    Get from the QSettings the maximum number of worker processes to be used
+    for parallel calculations (0 means one per CPU core)
+
+    :returns: the maximum number of worker processes
+    """
+    max_workers = QSettings().value(
+        'irmt/max_workers', DEFAULT_SETTINGS['max_workers'], type=int)
+    if max_workers <= 0:
+        max_workers = os.cpu_count() or 1
+    return max_workers
+
+
+def get_python_executable():
+    """
+    Inside QGIS, sys.executable can point to the QGIS binary instead of the
+    python interpreter, that is needed to spawn worker processes
+
+    :returns: the path of the python interpreter, or None if not found
+    """
+    candidates = [sys.executable,
+                  os.path.join(sys.exec_prefix, 'python.exe'),
+                  os.path.join(sys.exec_prefix, 'python3.exe'),
+                  os.path.join(sys.exec_prefix, 'bin', 'python3'),
+                  os.path.join(sys.exec_prefix, 'bin', 'python')]
+    for candidate in candidates:
+        if (candidate
+                and os.path.basename(candidate).lower().startswith('python')
+                and os.path.isfile(candidate)):
+            return candidate
+    return None
+
+
+def get_process_pool(max_workers=None):
+    """
+    Build a pool of worker processes, spawning fresh python interpreters (it
+    is not safe to fork the QGIS process)
+
+    :param max_workers: the maximum number of worker processes (if None,
+                        it is read from the settings)
+    :returns: a `concurrent.futures.ProcessPoolExecutor`, or None if worker
+              processes can not be started
+    """
+    if max_workers is None:
+        max_workers = get_max_workers()
+    python_executable = get_python_executable()
+    if python_executable is None:
+        log_msg('Unable to find the python interpreter: calculations will'
+                ' not be parallelized', level='W')
+        return None
+    context = multiprocessing.get_context('spawn')
+    context.set_executable(python_executable)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def transform_arrays(arrays, algorithm_name, variant_name="", inverse=False,
+                     max_workers=None):
+    """
+    Transform several arrays with the same algorithm (see
+    :func:`svir.calculations.transformation_algs.transform_array`). When
+    there are enough values, each array is transformed by a separate worker
+    process, and arrays are passed to and from the workers through shared
+    memory, without copies. If the worker processes can not be started, the
+    arrays are transformed sequentially
+
+    :param arrays: a list of tuples (values, valid_mask)
+    :param algorithm_name: the name of the algorithm
+    :param variant_name: the (optional) variant to be used
+    :param inverse: a boolean (default False) to run the inverse function
+                    if available
+    :param max_workers: the maximum number of worker processes (if None, it
+                        is read from the settings)
+    :returns: a list containing, for each input array, a tuple
+              (transformed_values, invalid_input_values), or the exception
+              raised trying to transform it
+    """
+    if max_workers is None:
+        max_workers = get_max_workers()
+    n_values = sum(values.size for values, _ in arrays)
+    pool = None
+    if (shared_memory is not None and len(arrays) > 1 and max_workers > 1
+            and n_values >= MIN_PARALLEL_VALUES):
+        pool = get_process_pool(min(max_workers, len(arrays)))
+    if pool is None:
+        return _transform_arrays_sequentially(
+            arrays, algorithm_name, variant_name, inverse)
+    shms = []
+    try:
+        futures = []
+        for values, valid_mask in arrays:
+            shm = _SharedColumn(values.size)
+            shms.append(shm)
+            shm.values[:] = values
+            shm.valid_mask[:] = valid_mask
+            futures.append(pool.submit(
+                _transform_shared_column, shm.name, values.size,
+                algorithm_name, variant_name, inverse))
+        results = []
+        for shm, future in zip(shms, futures):
+            try:
+                invalid_input_values = future.result()
+            except BrokenProcessPool:
+                raise
+            except Exception as exc:
+                results.append(exc)
+            else:
+                # copy the results before releasing the shared memory
+                transformed_values = ma.array(
+                    shm.output_values.copy(), mask=shm.output_mask.copy())
+                results.append((transformed_values, invalid_input_values))
+        return results
+    except (BrokenProcessPool, OSError) as exc:
+        # e.g. the python interpreter found can not run the workers, or the
+        # shared memory can not be allocated
+        log_msg('Unable to transform the fields in parallel (%s): they will'
+                ' be transformed sequentially' % exc, level='W')
+    finally:
+        pool.shutdown()
+        for shm in shms:
+            shm.close(unlink=True)
+    return _transform_arrays_sequentially(
+        arrays, algorithm_name, variant_name, inverse)
+
+
+def _transform_arrays_sequentially(
+        arrays, algorithm_name, variant_name, inverse):
+    results = []
+    for values, valid_mask in arrays:
+        try:
+            results.append(transform_array(
+                values, valid_mask, algorithm_name, variant_name, inverse))
+        except Exception as exc:
+            results.append(exc)
+    return results
+
+
+class _SharedColumn(object):
+    """
+    Block of shared memory containing the input values of a column, its
+    validity mask, the output values and the output mask
+    """
+    def __init__(self, size, name=None):
+        if name is None:
+            # a zero-sized block can not be created
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=max(18 * size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        buf = self.shm.buf
+        self.values = ndarray(size, dtype=float64, buffer=buf)
+        self.output_values = ndarray(
+            size, dtype=float64, buffer=buf, offset=8 * size)
+        self.valid_mask = ndarray(
+            size, dtype=bool, buffer=buf, offset=16 * size)
+        self.output_mask = ndarray(
+            size, dtype=bool, buffer=buf, offset=17 * size)
+
+    def close(self, unlink=False):
+        # the views have to be released before closing the block
+        del self.values, self.output_values
+        del self.valid_mask, self.output_mask
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _transform_shared_column(
+        name, size, algorithm_name, variant_name, inverse):
+    # run in the worker processes
+    shm = _SharedColumn(size, name)
+    try:
+        transformed_values, invalid_input_values = transform_array(
+            shm.values, shm.valid_mask, algorithm_name, variant_name,
+            inverse)
+        shm.output_values[:] = transformed_values.data
+        shm.output_mask[:] = ma.getmaskarray(transformed_values)
+        return invalid_input_values
+    finally:
+        shm.close()
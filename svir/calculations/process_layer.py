@@ -25,23 +25,36 @@
 import sys
 
 import uuid
-from numpy.testing import assert_almost_equal
+from concurrent.futures import ThreadPoolExecutor
+from numpy import (
+    array, array_split, asarray, concatenate, empty, zeros, int64, float64,
+    nan, ma, dtype as numpy_dtype)
 from pprint import pformat
 from qgis.core import (
+                       NULL,
+                       QgsFeature,
                        QgsFeatureRequest,
+                       QgsGeometry,
+                       QgsPointXY,
                        QgsMapLayer,
                        QgsWkbTypes,
                        QgsVectorLayer,
+                       QgsVectorLayerFeatureSource,
                        QgsVectorDataProvider,
                        QgsProject,
                        QgsField,
                        edit,
                        )
 
-from svir.calculations.transformation_algs import TRANSFORMATION_ALGS, \
-    transform
+from svir.calculations.transformation_algs import (
+    transform_array, values_to_array, streaming_accumulator,
+    STREAMING_KERNELS)
+from svir.calculations.parallel import (
+    transform_arrays, get_max_workers, MIN_PARALLEL_FEATURES)
+from svir.calculations.transformation_cache import (
+    TRANSFORMATION_CACHE, column_fingerprint)
 from svir.utilities.shared import (
-    DEBUG, DOUBLE_FIELD_TYPE, DOUBLE_FIELD_TYPE_NAME)
+    DEBUG, DOUBLE_FIELD_TYPE, DOUBLE_FIELD_TYPE_NAME, WRITE_BATCH_SIZE)
 
 from svir.utilities.utils import tr, log_msg
 
@@ -120,48 +133,23 @@ class ProcessLayer(object):
 
     def has_same_content_as(self, other_layer):
         """
-        Check if the layer has the same content as another layer
+        Check if the layer has the same content as another layer (see
+        :func:`svir.calculations.layer_diff.diff_layers` to find out which
+        features and fields differ)
 
         :param other_layer: layer to compare with
         :type other_layer: QgsVectorLayer
         """
-        len_this = self.layer.featureCount()
-        len_other = other_layer.featureCount()
-        # Check if the layers have the same number of rows (features)
-        if len_this != len_other:
-            return False
-        # Check if the layers have the same field names (columns)
-        this_fields = [field.name() for field in self.layer.fields()]
-        other_fields = [field.name() for field in other_layer.fields()]
-        if this_fields != other_fields:
-            return False
-        this_features = self.layer.getFeatures()
-        other_features = other_layer.getFeatures()
-        # we already checked that the layers have the same number of features
-        # and now we want to make sure that for each feature the contents are
-        # the same
-        for i in range(len_this):
-            this_feature = next(this_features)
-            other_feature = next(other_features)
-            this_feat_data = this_feature.attributes()
-            other_feat_data = other_feature.attributes()
-            if len(this_feat_data) != len(other_feat_data):
-                return False
-            for j in range(len(this_feat_data)):
-                if isinstance(this_feat_data[j], (int, float, complex)):
-                    try:
-                        assert_almost_equal(this_feat_data[j],
-                                            other_feat_data[j])
-                    except AssertionError:
-                        return False
-                else:
-                    if this_feat_data[j] != other_feat_data[j]:
-                        return False
-        return True
+        # imported here to avoid circular imports
+        from svir.calculations.layer_diff import diff_layers
+        return diff_layers(
+            self.layer, other_layer, stop_at_first=True).is_equal
 
     def add_attributes(self, attribute_list, simulate=False):
         """
-        Add attributes to the layer
+        Add attributes to the layer, with a single call to the data provider.
+        Names that are already taken (or that exceed the limits of
+        shapefiles) are laundered, and the original names are set as aliases
 
         :param attribute_list: list of QgsField to add to the layer
         :type attribute_list: list of QgsField
@@ -183,59 +171,59 @@ class ProcessLayer(object):
         aliases = dict()
         proposed_attribute_dict = {}
         proposed_attribute_list = []
-        with edit(self.layer):
-            # add attributes
-            layer_pr = self.layer.dataProvider()
-            for input_attribute in attribute_list:
-                input_attribute_name = input_attribute.name()
-                if self.layer.providerType() == 'ogr':
-                    proposed_attribute_name = \
-                        input_attribute_name[:10].upper().replace(' ', '_')
+        is_ogr = self.layer.providerType() == 'ogr'
+        # names are laundered against a set, that is updated while the
+        # attributes are processed, so attributes of the same list can not
+        # collide with each other either
+        current_attribute_names = set(
+            attribute.name() for attribute in self.layer.fields())
+        for input_attribute in attribute_list:
+            input_attribute_name = input_attribute.name()
+            if is_ogr:
+                proposed_attribute_name = \
+                    input_attribute_name[:10].upper().replace(' ', '_')
+            else:
+                proposed_attribute_name = input_attribute_name
+            i = 1
+            while proposed_attribute_name in current_attribute_names:
+                # If the attribute is already assigned, change the
+                # proposed_attribute_name
+                if is_ogr:
+                    i_num_digits = len(str(i))
+                    # 10 = shapefile limit
+                    # 1 = underscore
+                    max_name_len = 10 - i_num_digits - 1
+                    proposed_attribute_name = '%s_%d' % (
+                        input_attribute_name[:max_name_len].upper(
+                            ).replace(' ', '_'), i)
                 else:
-                    proposed_attribute_name = input_attribute_name
-                i = 1
-                while True:
-                    current_attribute_names = \
-                        [attribute.name() for attribute in self.layer.fields()]
-                    if proposed_attribute_name in current_attribute_names:
-                        # If the attribute is already assigned, change the
-                        # proposed_attribute_name
-                        if self.layer.providerType() == 'ogr':
-                            i_num_digits = len(str(i))
-                            # 10 = shapefile limit
-                            # 1 = underscore
-                            max_name_len = 10 - i_num_digits - 1
-                            proposed_attribute_name = '%s_%d' % (
-                                input_attribute_name[:max_name_len].upper(
-                                    ).replace(' ', '_'), i)
-                        else:
-                            proposed_attribute_name = '%s_%d' % (
-                                input_attribute_name, i)
-                        i += 1
-                    else:
-                        # If the attribute name is not already assigned,
-                        # add it to the proposed_attribute_dict
-                        proposed_attribute_dict[input_attribute_name] = \
-                            proposed_attribute_name
-                        input_attribute.setName(proposed_attribute_name)
-                        proposed_attribute_list.append(input_attribute)
-                        break
-                if proposed_attribute_name != input_attribute_name:
-                    aliases[proposed_attribute_name] = input_attribute_name
-            if not simulate:
-                added_ok = layer_pr.addAttributes(proposed_attribute_list)
-                if not added_ok:
-                    raise AttributeError(
-                        'Unable to add attributes %s' %
-                        proposed_attribute_list)
-        with edit(self.layer):
-            # add aliases
-            if not simulate:
-                for proposed_attribute_name in aliases:
-                    attribute_id = self.layer.fields().indexOf(
-                        proposed_attribute_name)
-                    self.layer.setFieldAlias(
-                        attribute_id, aliases[proposed_attribute_name])
+                    proposed_attribute_name = '%s_%d' % (
+                        input_attribute_name, i)
+                i += 1
+            # the attribute name is not already assigned, so add it to the
+            # proposed_attribute_dict
+            current_attribute_names.add(proposed_attribute_name)
+            proposed_attribute_dict[input_attribute_name] = \
+                proposed_attribute_name
+            input_attribute.setName(proposed_attribute_name)
+            proposed_attribute_list.append(input_attribute)
+            if proposed_attribute_name != input_attribute_name:
+                aliases[proposed_attribute_name] = input_attribute_name
+        if simulate:
+            return proposed_attribute_dict
+        # all the attributes are added at once through the data provider
+        added_ok = self.layer.dataProvider().addAttributes(
+            proposed_attribute_list)
+        if not added_ok:
+            raise AttributeError(
+                'Unable to add attributes %s' % proposed_attribute_list)
+        self.layer.updateFields()
+        # add aliases
+        fields = self.layer.fields()
+        for proposed_attribute_name in aliases:
+            attribute_id = fields.indexOf(proposed_attribute_name)
+            self.layer.setFieldAlias(
+                attribute_id, aliases[proposed_attribute_name])
         return proposed_attribute_dict
 
     def delete_attributes(self, attribute_list):
@@ -277,12 +265,23 @@ class ProcessLayer(object):
     def transform_attribute(
             self, input_attr_name, algorithm_name, variant="",
             inverse=False, new_attr_name=None, new_attr_alias=None,
-            simulate=False):
+            simulate=False, chunk_size=None, skip_undo=False,
+            progress_callback=None):
         """
         Use one of the available transformation algorithms to transform an
         attribute of the layer, and add a new attribute with the
         transformed data, or overwrite the input attribute with the results
 
+        If a chunk_size is given and the algorithm (and variant) can be
+        computed in two passes (see STREAMING_KERNELS and
+        streaming_accumulator), the layer is read in chunks of
+        features twice: the first time collecting the statistics needed by
+        the algorithm and the ids of the features, the second time reading,
+        transforming and writing one page of chunk_size ids at a time. This
+        way, besides the ids, only one chunk of values is kept in memory.
+        Chunks are always written directly through the data provider, so
+        skip_undo is ignored and the changes can not be undone.
+
         :param input_attr_name: name of the attribute to be transformed
         :param algorithm_name: name of the transformation algorithm
         :param variant: name of the algorithm variant
@@ -297,6 +296,16 @@ class ProcessLayer(object):
         :param simulate: if True, the method will just simulate the creation
                          of the target attribute and return the name that would
                          be assigned to it
+        :param chunk_size: if specified, the maximum number of features to be
+                           kept in memory at once (used only by the algorithms
+                           that support computation in two passes)
+        :param skip_undo: if True, the results are written in batches
+                          directly through the data provider, that is much
+                          faster, but the changes are not added to the undo
+                          stack (see :meth:`_write_attribute_values`). Results
+                          computed in chunks are always written this way
+        :param progress_callback: an (optional) function accepting the
+                                  percentage of values written so far
         :returns: (actual_new_attr_name, invalid_input_values)
         """
         caps = self.layer.dataProvider().capabilities()
@@ -305,60 +314,273 @@ class ProcessLayer(object):
                             ' (%s). Please consider saving the layer with an'
                             ' editable format before attempting to transform'
                             ' its attributes.' % self.layer.providerType())
-        # get the id of the attribute named input_attr_name
-        input_attr_id = self.find_attribute_id(input_attr_name)
-        overwrite = (new_attr_name is not None
-                     and new_attr_name == input_attr_name)
-        if simulate or not overwrite:
-            # add a new attribute to store the results of the transformation
-            # or simulate adding a new attribute and return the name of the
+        # make sure that the attribute named input_attr_name exists
+        self.find_attribute_id(input_attr_name)
+        if simulate:
+            # simulate adding a new attribute and return the name of the
             # name that would be assigned to the new attribute if it would be
             # added.
-            # NOTE: building the name of the output transformed attribute,
-            #       we take into account the chosen algorithm and variant and
-            #       we truncate the new name to 10 characters (max allowed for
-            #       shapefiles)
-            if not new_attr_name:
-                if variant:
-                    new_attr_name = algorithm_name[:5] + '_' + variant[:4]
-                else:
-                    new_attr_name = algorithm_name
-            field = QgsField(new_attr_name, DOUBLE_FIELD_TYPE)
-            field.setTypeName(DOUBLE_FIELD_TYPE_NAME)
-            if simulate:
-                attr_names_dict = self.add_attributes([field],
-                                                      simulate=simulate)
-                # get the name actually assigned to the new attribute
-                actual_new_attr_name = attr_names_dict[new_attr_name]
-                return actual_new_attr_name
-
-        # a dict will contain all the values for the chosen input attribute,
-        # keeping as key, for each value, the id of the corresponding feature
-        initial_dict = dict()
-        request = QgsFeatureRequest().setFlags(
-            QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(
-                [input_attr_name], self.layer.fields())
-        for feat in self.layer.getFeatures(request):
-            initial_dict[feat.id()] = feat[input_attr_id]
-
-        # get the transformation algorithm from the register
-        algorithm = TRANSFORMATION_ALGS[algorithm_name]
-
-        # transform the values in the dictionary with the chosen algorithm
+            new_attr_name, field = self._build_target_field(
+                algorithm_name, variant, new_attr_name)
+            attr_names_dict = self.add_attributes([field],
+                                                  simulate=simulate)
+            # get the name actually assigned to the new attribute
+            actual_new_attr_name = attr_names_dict[new_attr_name]
+            return actual_new_attr_name
+
+        stats = None
+        if chunk_size:
+            stats = streaming_accumulator(algorithm_name, variant)
+        streaming = stats is not None
         invalid_input_values = None
-        try:
-            transformed_dict, invalid_input_values = transform(
-                initial_dict, algorithm, variant, inverse)
-        except ValueError:
-            raise
-        except NotImplementedError:
-            raise
-
-        if overwrite:
+        if streaming:
+            # first pass: collect the statistics needed by the algorithm,
+            # one chunk of values at a time, and the ids of the features
+            chunk_ids = []
+            for feature_ids, values, valid_mask in \
+                    self.read_attribute_in_chunks(input_attr_name, chunk_size):
+                stats.update(values[valid_mask])
+                chunk_ids.append(feature_ids)
+            feature_ids = concatenate(chunk_ids)
+            del chunk_ids, values, valid_mask
+            # this also validates the statistics (e.g. a zero range), before
+            # adding the new attribute
+            transform_chunk = STREAMING_KERNELS[algorithm_name](
+                stats, variant, inverse)
+        else:
+            # read the ids of the features and the values of the chosen input
+            # attribute, that will be transformed as numpy arrays
+            feature_ids, values, valid_mask = next(
+                self.read_attribute_in_chunks(input_attr_name))
+
+            # transform the values with the chosen algorithm (the kernel
+            # implementing it is taken from the register), unless the same
+            # transformation was already applied to the same values
+            fingerprint = column_fingerprint(values, valid_mask)
+            transformation_result = TRANSFORMATION_CACHE.get(
+                self.layer.id(), input_attr_name, algorithm_name, variant,
+                inverse, fingerprint)
+            if transformation_result is None:
+                transformation_result = transform_array(
+                    values, valid_mask, algorithm_name, variant, inverse)
+                self._cache_transformation(
+                    input_attr_name, algorithm_name, variant, inverse,
+                    fingerprint, transformation_result)
+            transformed_values, invalid_input_values = transformation_result
+
+        actual_new_attr_name, new_attr_id = self._add_target_attribute(
+            input_attr_name, algorithm_name, variant, new_attr_name,
+            new_attr_alias)
+
+        if streaming:
+            # second pass: each page of ids is read completely, then it is
+            # transformed and written through the data provider, so the
+            # layer is never written while it is being read
+            n_features = len(feature_ids)
+            for start in range(0, n_features, chunk_size):
+                page_ids = feature_ids[start:start + chunk_size]
+                [(page_ids, values, valid_mask)] = \
+                    self.read_attribute_in_chunks(
+                        input_attr_name, feature_ids=page_ids)
+                transformed_values = ma.masked_all(values.shape)
+                transformed_values[valid_mask] = transform_chunk(
+                    values[valid_mask])
+                self._change_attribute_values(
+                    page_ids, {new_attr_id: transformed_values})
+                if progress_callback is not None:
+                    progress_callback(
+                        100 * min(start + chunk_size, n_features)
+                        // n_features)
+            # the features cached by the layer are outdated
+            self.layer.reload()
+        else:
+            self._write_attribute_values(
+                new_attr_id, feature_ids, transformed_values, skip_undo,
+                progress_callback)
+        return actual_new_attr_name, invalid_input_values
+
+    def transform_attributes(
+            self, input_attr_names, algorithm_name, variant="",
+            inverse=False, new_attr_names=None, new_attr_aliases=None,
+            max_workers=None, skip_undo=False, progress_callback=None):
+        """
+        Use one of the available transformation algorithms to transform
+        several attributes of the layer at once (see
+        :meth:`transform_attribute`)
+
+        All the attributes are read in a single pass over the features. The
+        transformations are computed by a pool of worker processes, one
+        attribute per worker (see
+        :func:`svir.calculations.parallel.transform_arrays`), then the
+        results are written to the layer one attribute at a time.
+
+        :param input_attr_names: names of the attributes to be transformed
+        :param algorithm_name: name of the transformation algorithm
+        :param variant: name of the algorithm variant
+        :param inverse: boolean indicating if the inverse transformation
+                        has to be performed
+        :param new_attr_names: list of names of the target attributes (see
+                               :meth:`transform_attribute`)
+        :param new_attr_aliases: list of aliases of the target attributes
+        :param max_workers: the maximum number of worker processes (if None,
+                            it is read from the settings)
+        :param skip_undo: if True, the results are written directly through
+                          the data provider (see :meth:`transform_attribute`)
+        :param progress_callback: an (optional) function accepting the
+                                  percentage of values written so far
+        :returns: a list containing, for each input attribute, a tuple
+                  (actual_new_attr_name, invalid_input_values), or the
+                  exception raised trying to transform it
+        """
+        caps = self.layer.dataProvider().capabilities()
+        if not (caps & QgsVectorDataProvider.ChangeAttributeValues):
+            raise TypeError('Unable to edit features of this kind of layer'
+                            ' (%s). Please consider saving the layer with an'
+                            ' editable format before attempting to transform'
+                            ' its attributes.' % self.layer.providerType())
+        if new_attr_names is None:
+            new_attr_names = [None] * len(input_attr_names)
+        if new_attr_aliases is None:
+            new_attr_aliases = [None] * len(input_attr_names)
+        feature_ids, arrays = next(
+            self.read_attributes_in_chunks(input_attr_names))
+        # only the attributes whose transformation is not cached yet are
+        # sent to the worker processes
+        fingerprints = [column_fingerprint(values, valid_mask)
+                        for values, valid_mask in arrays]
+        transformation_results = [
+            TRANSFORMATION_CACHE.get(
+                self.layer.id(), input_attr_name, algorithm_name, variant,
+                inverse, fingerprint)
+            for input_attr_name, fingerprint in zip(
+                input_attr_names, fingerprints)]
+        missing = [i for i, transformation_result
+                   in enumerate(transformation_results)
+                   if transformation_result is None]
+        computed_results = transform_arrays(
+            [arrays[i] for i in missing], algorithm_name, variant, inverse,
+            max_workers)
+        for i, transformation_result in zip(missing, computed_results):
+            transformation_results[i] = transformation_result
+            if not isinstance(transformation_result, Exception):
+                self._cache_transformation(
+                    input_attr_names[i], algorithm_name, variant, inverse,
+                    fingerprints[i], transformation_result)
+        results = []
+        for attr_idx, (input_attr_name, new_attr_name, new_attr_alias,
+                       transformation_result) in enumerate(zip(
+                input_attr_names, new_attr_names, new_attr_aliases,
+                transformation_results)):
+            if progress_callback is not None:
+                # the progress of the whole set of attributes
+                def attr_progress_callback(percentage, attr_idx=attr_idx):
+                    progress_callback(
+                        (100 * attr_idx + percentage) // len(input_attr_names))
+            else:
+                attr_progress_callback = None
+            if isinstance(transformation_result, Exception):
+                results.append(transformation_result)
+                continue
+            transformed_values, invalid_input_values = transformation_result
+            try:
+                actual_new_attr_name, new_attr_id = \
+                    self._add_target_attribute(
+                        input_attr_name, algorithm_name, variant,
+                        new_attr_name, new_attr_alias)
+                self._write_attribute_values(
+                    new_attr_id, feature_ids, transformed_values, skip_undo,
+                    attr_progress_callback)
+            except Exception as exc:
+                results.append(exc)
+            else:
+                results.append((actual_new_attr_name, invalid_input_values))
+        return results
+
+    def apply_pipeline(self, input_attr_name, pipeline, new_attr_name=None,
+                       new_attr_alias=None, skip_undo=False,
+                       progress_callback=None):
+        """
+        Apply a sequence of transformations to an attribute of the layer,
+        reading the attribute once and writing only the final results (see
+        :class:`svir.calculations.transformation_algs.TransformationPipeline`)
+
+        :param input_attr_name: name of the attribute to be transformed
+        :param pipeline: a TransformationPipeline
+        :param new_attr_name: name of the target attribute that will store the
+                              results (if it is equal to the input_attr_name,
+                              the attribute will be overwritten). If not
+                              specified, it is built from the last step
+        :param new_attr_alias: alias of the target attribute
+        :param skip_undo: if True, the results are written directly through
+                          the data provider (see :meth:`transform_attribute`)
+        :param progress_callback: an (optional) function accepting the
+                                  percentage of values written so far
+        :returns: (actual_new_attr_name, invalid_input_values)
+        """
+        caps = self.layer.dataProvider().capabilities()
+        if not (caps & QgsVectorDataProvider.ChangeAttributeValues):
+            raise TypeError('Unable to edit features of this kind of layer'
+                            ' (%s). Please consider saving the layer with an'
+                            ' editable format before attempting to transform'
+                            ' its attributes.' % self.layer.providerType())
+        feature_ids, values, valid_mask = next(
+            self.read_attribute_in_chunks(input_attr_name))
+        # the whole pipeline is cached as if it were a single algorithm
+        fingerprint = column_fingerprint(values, valid_mask)
+        transformation_result = TRANSFORMATION_CACHE.get(
+            self.layer.id(), input_attr_name, pipeline.key, "", False,
+            fingerprint)
+        if transformation_result is None:
+            transformation_result = pipeline.transform_array(
+                values, valid_mask)
+            self._cache_transformation(
+                input_attr_name, pipeline.key, "", False, fingerprint,
+                transformation_result)
+        transformed_values, invalid_input_values = transformation_result
+        last_algorithm_name, last_variant, _ = pipeline.steps[-1]
+        actual_new_attr_name, new_attr_id = self._add_target_attribute(
+            input_attr_name, last_algorithm_name, last_variant,
+            new_attr_name, new_attr_alias)
+        self._write_attribute_values(
+            new_attr_id, feature_ids, transformed_values, skip_undo,
+            progress_callback)
+        return actual_new_attr_name, invalid_input_values
+
+    def _cache_transformation(self, input_attr_name, algorithm_name, variant,
+                              inverse, fingerprint, transformation_result):
+        # NOTE: results have to be cached before they are written, so that
+        #       they are dropped if the input attribute is overwritten
+        TRANSFORMATION_CACHE.watch(self.layer)
+        TRANSFORMATION_CACHE.put(
+            self.layer.id(), input_attr_name, algorithm_name, variant,
+            inverse, fingerprint, transformation_result)
+
+    def _build_target_field(self, algorithm_name, variant, new_attr_name):
+        # NOTE: building the name of the output transformed attribute,
+        #       we take into account the chosen algorithm and variant and
+        #       we truncate the new name to 10 characters (max allowed for
+        #       shapefiles)
+        if not new_attr_name:
+            if variant:
+                new_attr_name = algorithm_name[:5] + '_' + variant[:4]
+            else:
+                new_attr_name = algorithm_name
+        field = QgsField(new_attr_name, DOUBLE_FIELD_TYPE)
+        field.setTypeName(DOUBLE_FIELD_TYPE_NAME)
+        return new_attr_name, field
+
+    def _add_target_attribute(self, input_attr_name, algorithm_name, variant,
+                              new_attr_name, new_attr_alias):
+        # add a new attribute to store the results of the transformation,
+        # unless the input attribute has to be overwritten, and return its
+        # actual name and its id
+        if new_attr_name is not None and new_attr_name == input_attr_name:
             actual_new_attr_name = input_attr_name
-            new_attr_id = input_attr_id
+            new_attr_id = self.find_attribute_id(input_attr_name)
         else:
-            attr_names_dict = self.add_attributes([field], simulate=simulate)
+            new_attr_name, field = self._build_target_field(
+                algorithm_name, variant, new_attr_name)
+            attr_names_dict = self.add_attributes([field])
             # get the name actually assigned to the new attribute
             actual_new_attr_name = attr_names_dict[new_attr_name]
             # get the id of the new attribute
@@ -366,25 +588,296 @@ class ProcessLayer(object):
         if new_attr_alias:
             with edit(self.layer):
                 self.layer.setFieldAlias(new_attr_id, new_attr_alias)
+        return actual_new_attr_name, new_attr_id
 
-        # TODO: perhaps there is a better way to get a list of feature ids.
-        #       Here we are retrieving no geometries and no fields, which
-        #       sounds the closest way to obtain it.
-        request = QgsFeatureRequest().setFlags(
-            QgsFeatureRequest.NoGeometry).setSubsetOfAttributes(
-                [], self.layer.fields())
+    def _write_attribute_values(self, attr_id, feature_ids, values,
+                                skip_undo=False, progress_callback=None,
+                                batch_size=WRITE_BATCH_SIZE):
+        # values is a masked array, and masked values are written as NULL.
+        # If skip_undo is True, values are written in batches of batch_size
+        # features through the data provider, bypassing the edit buffer and
+        # the undo stack, otherwise one at a time through the layer
+        n_features = len(feature_ids)
+        if skip_undo:
+            for start in range(0, n_features, batch_size):
+                stop = start + batch_size
+                self._change_attribute_values(
+                    feature_ids[start:stop], {attr_id: values[start:stop]})
+                if progress_callback is not None:
+                    progress_callback(
+                        100 * min(stop, n_features) // n_features)
+            # the features cached by the layer are outdated
+            self.layer.reload()
+            return
         with edit(self.layer):
             # write transformed values
-            for feat in self.layer.getFeatures(request):
-                feat_id = feat.id()
-                value = transformed_dict[feat_id]
-                try:
-                    converted_value = float(value)
-                except (TypeError, ValueError):
-                    converted_value = value
-                self.layer.changeAttributeValue(
-                    feat_id, new_attr_id, converted_value)
-        return actual_new_attr_name, invalid_input_values
+            for i, (feat_id, value) in enumerate(zip(feature_ids.tolist(),
+                                                     values.tolist())):
+                self.layer.changeAttributeValue(feat_id, attr_id, value)
+                if progress_callback is not None and not (i + 1) % batch_size:
+                    progress_callback(100 * (i + 1) // n_features)
+        if progress_callback is not None:
+            progress_callback(100)
+
+    def _change_attribute_values(self, feature_ids, columns):
+        # write a batch of values at once through the data provider. columns
+        # is a dict attr_id -> masked array of values (masked values are
+        # written as NULL)
+        attr_values = [(attr_id, values.tolist())
+                       for attr_id, values in columns.items()]
+        attr_map = {
+            feat_id: {attr_id: values[i] for attr_id, values in attr_values}
+            for i, feat_id in enumerate(feature_ids.tolist())}
+        if not self.layer.dataProvider().changeAttributeValues(attr_map):
+            raise AttributeError(
+                'Unable to change the values of attributes %s' % ', '.join(
+                    self.layer.fields().at(attr_id).name()
+                    for attr_id in columns))
+
+    def iter_numpy(self, field_names=None, geometry=None, feature_ids=None,
+                   chunk_size=None, source=None):
+        """
+        Read the features of the layer as numpy arrays, in chunks of at most
+        chunk_size features, retrieving only the requested attributes and no
+        geometries unless they are requested
+
+        :param field_names: names of the fields to be read (if None, all the
+                            fields of the layer)
+        :param geometry: if 'xy', the coordinates of the points (or of the
+                         centroids of other geometries) are read into the
+                         columns '$x' and '$y'. If 'wkb', the geometries are
+                         read into the column '$wkb', as WKB bytes
+        :param feature_ids: if specified, only the features with these ids
+                            are read
+        :param chunk_size: maximum number of features in each chunk (if None,
+                           all the features are yielded in a single chunk)
+        :param source: if specified, the features are read from this feature
+                       source (e.g. a QgsVectorLayerFeatureSource of the
+                       layer, built in the main thread), instead of from the
+                       layer, so that they can be read in a background thread
+        :returns: a generator of tuples (feature_ids, table), where table is a
+                  numpy masked structured array with a column for each field
+                  (float64 for numeric fields, object otherwise) and for the
+                  geometry, masked where values are NULL. At least one
+                  (possibly empty) chunk is yielded
+        """
+        fields = self.layer.fields()
+        if field_names is None:
+            field_names = [field.name() for field in fields]
+        attr_ids = _find_attribute_ids(fields, field_names)
+        dtype = [(field_name,
+                  float64 if fields.at(attr_id).isNumeric() else object)
+                 for field_name, attr_id in zip(field_names, attr_ids)]
+        if geometry == 'xy':
+            dtype.extend([('$x', float64), ('$y', float64)])
+        elif geometry == 'wkb':
+            dtype.append(('$wkb', object))
+        elif geometry is not None:
+            raise ValueError('Geometry format "%s" is not supported'
+                             % geometry)
+        dtype = numpy_dtype(dtype)
+        request = QgsFeatureRequest().setSubsetOfAttributes(
+            field_names, fields)
+        if geometry is None:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if feature_ids is not None:
+            request.setFilterFids(
+                [int(feature_id) for feature_id in feature_ids])
+        ids = []
+        columns = [[] for _ in attr_ids]
+        geometries = []
+        n_chunks = 0
+        if source is None:
+            source = self.layer
+        for feat in source.getFeatures(request):
+            ids.append(feat.id())
+            attributes = feat.attributes()
+            for column, attr_id in zip(columns, attr_ids):
+                column.append(attributes[attr_id])
+            if geometry is not None:
+                geometries.append(feat.geometry())
+            if len(ids) == chunk_size:
+                yield self._build_table(ids, columns, geometries, dtype,
+                                        geometry)
+                n_chunks += 1
+                ids = []
+                columns = [[] for _ in attr_ids]
+                geometries = []
+        if ids or not n_chunks:
+            yield self._build_table(ids, columns, geometries, dtype, geometry)
+
+    def to_numpy(self, field_names=None, geometry=None, feature_ids=None,
+                 source=None):
+        """
+        Read the features of the layer as numpy arrays, all at once (see
+        :meth:`iter_numpy`)
+
+        :returns: a tuple (feature_ids, table)
+        """
+        return next(self.iter_numpy(
+            field_names, geometry, feature_ids, source=source))
+
+    def from_numpy(self, table, feature_ids=None, batch_size=WRITE_BATCH_SIZE,
+                   progress_callback=None):
+        """
+        Write numpy arrays into the layer, through the data provider, in
+        batches of batch_size features (the changes are not added to the
+        undo stack)
+
+        :param table: a numpy (masked) structured array, with a column for
+                      each field to be written (masked values are written as
+                      NULL). Geometries of new features are read from the
+                      columns '$x' and '$y' (points) or '$wkb', if present
+                      (see :meth:`iter_numpy`)
+        :param feature_ids: if specified, the ids of the features whose
+                            attributes are updated, otherwise new features
+                            are added
+        :param progress_callback: an (optional) function accepting the
+                                  percentage of features written so far
+        :returns: the ids of the updated or added features
+        """
+        table = ma.asarray(table)
+        field_names = [name for name in table.dtype.names
+                       if name not in ('$x', '$y', '$wkb')]
+        attr_ids = _find_attribute_ids(self.layer.fields(), field_names)
+        n_features = len(table)
+        added_ids = []
+        for start in range(0, n_features, batch_size):
+            stop = start + batch_size
+            chunk = table[start:stop]
+            if feature_ids is not None:
+                self._change_attribute_values(
+                    asarray(feature_ids[start:stop], dtype=int64),
+                    {attr_id: chunk[field_name]
+                     for attr_id, field_name in zip(attr_ids, field_names)})
+            else:
+                added_ids.extend(self._add_features(
+                    chunk, field_names, attr_ids))
+            if progress_callback is not None:
+                progress_callback(100 * min(stop, n_features) // n_features)
+        if feature_ids is None:
+            self.layer.updateExtents()
+            feature_ids = added_ids
+        # the features cached by the layer are outdated
+        self.layer.reload()
+        return array(feature_ids, dtype=int64)
+
+    def _add_features(self, chunk, field_names, attr_ids):
+        # build the features of a chunk of a table and add them at once
+        # through the data provider
+        fields = self.layer.fields()
+        columns = [chunk[field_name].tolist() for field_name in field_names]
+        names = chunk.dtype.names
+        if '$wkb' in names:
+            geometries = []
+            for wkb in chunk['$wkb'].tolist():
+                geom = QgsGeometry()
+                if wkb is not None:
+                    geom.fromWkb(wkb)
+                geometries.append(geom)
+        elif '$x' in names and '$y' in names:
+            geometries = [
+                QgsGeometry.fromPointXY(QgsPointXY(x, y))
+                if x is not None and y is not None else QgsGeometry()
+                for x, y in zip(chunk['$x'].tolist(), chunk['$y'].tolist())]
+        else:
+            geometries = None
+        feats = []
+        for i in range(len(chunk)):
+            feat = QgsFeature(fields)
+            for attr_id, column in zip(attr_ids, columns):
+                feat.setAttribute(attr_id, column[i])
+            if geometries is not None:
+                feat.setGeometry(geometries[i])
+            feats.append(feat)
+        added_ok, added_feats = self.layer.dataProvider().addFeatures(feats)
+        if not added_ok:
+            raise AttributeError('Unable to add features to layer %s'
+                                 % self.layer.name())
+        return [feat.id() for feat in added_feats]
+
+    @staticmethod
+    def _build_table(ids, columns, geometries, dtype, geometry):
+        data = empty(len(ids), dtype=dtype)
+        mask = zeros(len(ids), dtype=ma.make_mask_descr(dtype))
+        for field_name, column in zip(dtype.names, columns):
+            if dtype[field_name] == float64:
+                data[field_name], valid_mask = values_to_array(column)
+                mask[field_name] = ~valid_mask
+            else:
+                data[field_name] = column
+                mask[field_name] = [value in (None, NULL)
+                                    for value in column]
+        if geometry == 'xy':
+            for i, geom in enumerate(geometries):
+                if geom.isNull():
+                    data['$x'][i] = data['$y'][i] = nan
+                    mask['$x'][i] = mask['$y'][i] = True
+                    continue
+                if (geom.type() == QgsWkbTypes.PointGeometry
+                        and not geom.isMultipart()):
+                    point = geom.asPoint()
+                else:
+                    point = geom.centroid().asPoint()
+                data['$x'][i] = point.x()
+                data['$y'][i] = point.y()
+        elif geometry == 'wkb':
+            for i, geom in enumerate(geometries):
+                if geom.isNull():
+                    data['$wkb'][i] = None
+                    mask['$wkb'][i] = True
+                else:
+                    data['$wkb'][i] = bytes(geom.asWkb())
+        return array(ids, dtype=int64), ma.array(data, mask=mask)
+
+    def read_attribute_in_chunks(self, attr_name, chunk_size=None,
+                                 feature_ids=None):
+        """
+        Read the values of an attribute, retrieving no geometries, and yield
+        them as numpy arrays, in chunks of at most chunk_size features
+
+        :param attr_name: name of the attribute to be read
+        :param chunk_size: maximum number of features in each chunk (if None,
+                           all the features are yielded in a single chunk)
+        :param feature_ids: if specified, only the features with these ids
+                            are read
+        :returns: a generator of tuples (feature_ids, values, valid_mask),
+                  where valid_mask is False where values are missing (see
+                  :func:`values_to_array`). At least one (possibly empty)
+                  chunk is yielded
+        """
+        for feature_ids, arrays in self.read_attributes_in_chunks(
+                [attr_name], chunk_size, feature_ids):
+            values, valid_mask = arrays[0]
+            yield feature_ids, values, valid_mask
+
+    def read_attributes_in_chunks(self, attr_names, chunk_size=None,
+                                  feature_ids=None):
+        """
+        Read the values of several attributes in a single pass over the
+        features (see :meth:`read_attribute_in_chunks` and
+        :meth:`iter_numpy`)
+
+        :param attr_names: names of the attributes to be read
+        :param chunk_size: maximum number of features in each chunk (if None,
+                           all the features are yielded in a single chunk)
+        :param feature_ids: if specified, only the features with these ids
+                            are read
+        :returns: a generator of tuples (feature_ids, arrays), where arrays
+                  contains a tuple (values, valid_mask) for each attribute
+        """
+        for feature_ids, table in self.iter_numpy(
+                attr_names, feature_ids=feature_ids, chunk_size=chunk_size):
+            arrays = []
+            for attr_name in attr_names:
+                column = table[attr_name]
+                if column.dtype == float64:
+                    arrays.append(
+                        (column.data, ~ma.getmaskarray(column)))
+                else:
+                    # non-numeric fields are converted, where possible
+                    arrays.append(values_to_array(column.data.tolist()))
+            yield feature_ids, arrays
 
     def find_attribute_id(self, attribute_name):
         """
@@ -401,9 +894,13 @@ class ProcessLayer(object):
         # In case the attribute has not been found, raise exception
         raise AttributeError('Attribute name %s not found' % attribute_name)
 
-    def duplicate_in_memory(self, new_name='', add_to_registry=False):
+    def duplicate_in_memory(self, new_name='', add_to_registry=False,
+                            field_names=None, copy_geometry=True,
+                            filter_expression=None, extent=None,
+                            batch_size=WRITE_BATCH_SIZE, feedback=None):
         """
-        Return a memory copy of the layer
+        Return a memory copy of the layer (or of a subset of it). Features
+        are added to the copy in batches of batch_size features
 
         :param new_name: The name of the copied layer.
         :type new_name: str
@@ -412,7 +909,30 @@ class ProcessLayer(object):
                                 the QgsMapRegistry
         :type: bool
 
-        :returns: An in-memory copy of a layer.
+        :param field_names: names of the fields to be copied (if None, all
+                            the fields are copied)
+        :type field_names: list
+
+        :param copy_geometry: if False, the copy has no geometries
+        :type copy_geometry: bool
+
+        :param filter_expression: if specified, only the features matching
+                                  this expression are copied
+        :type filter_expression: str
+
+        :param extent: if specified, only the features intersecting this
+                       rectangle (in the crs of the layer) are copied
+        :type extent: QgsRectangle
+
+        :param batch_size: maximum number of features added at once
+        :type batch_size: int
+
+        :param feedback: an (optional) feedback object, receiving the
+                         progress of the copy and allowing to cancel it
+        :type feedback: QgsFeedback
+
+        :returns: An in-memory copy of a layer, or None if the copy was
+                  canceled.
         :rtype: QgsMapLayer
 
         """
@@ -421,7 +941,9 @@ class ProcessLayer(object):
 
         if self.layer.type() == QgsMapLayer.VectorLayer:
             v_type = self.layer.wkbType()
-            if v_type == QgsWkbTypes.Point:
+            if not copy_geometry:
+                type_str = ""
+            elif v_type == QgsWkbTypes.Point:
                 type_str = "point"
             elif v_type == QgsWkbTypes.LineString:
                 type_str = "linestring"
@@ -446,20 +968,60 @@ class ProcessLayer(object):
         mem_layer = QgsVectorLayer(uri, new_name, 'memory')
 
         # duplicate layer
-        with edit(mem_layer):
-            mem_provider = mem_layer.dataProvider()
-
-            provider = self.layer.dataProvider()
-            v_fields = provider.fields()
-
-            fields = []
-            for i in v_fields:
-                fields.append(i)
-
-            mem_provider.addAttributes(fields)
+        mem_provider = mem_layer.dataProvider()
+        provider = self.layer.dataProvider()
+        v_fields = provider.fields()
+        if field_names is None:
+            attr_ids = list(range(v_fields.count()))
+        else:
+            attr_ids = []
+            for field_name in field_names:
+                attr_id = v_fields.indexOf(field_name)
+                if attr_id == -1:
+                    raise AttributeError('Field %s not found' % field_name)
+                attr_ids.append(attr_id)
+        if not mem_provider.addAttributes(
+                [v_fields.at(attr_id) for attr_id in attr_ids]):
+            raise AttributeError('Unable to add fields to layer %s'
+                                 % new_name)
+        mem_layer.updateFields()
+        mem_fields = mem_layer.fields()
 
-            for ft in provider.getFeatures():
-                mem_provider.addFeatures([ft])
+        request = QgsFeatureRequest().setSubsetOfAttributes(attr_ids)
+        if not copy_geometry:
+            request.setFlags(QgsFeatureRequest.NoGeometry)
+        if filter_expression is not None:
+            request.setFilterExpression(filter_expression)
+        if extent is not None:
+            request.setFilterRect(extent)
+        if feedback is not None:
+            request.setFeedback(feedback)
+        # NOTE: when a filter is applied, the progress is an underestimate
+        n_features = max(provider.featureCount(), 1)
+        n_copied = 0
+        feats = []
+        for ft in provider.getFeatures(request):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            feat = QgsFeature(mem_fields)
+            attributes = ft.attributes()
+            feat.setAttributes([attributes[attr_id] for attr_id in attr_ids])
+            if copy_geometry:
+                feat.setGeometry(ft.geometry())
+            feats.append(feat)
+            if len(feats) == batch_size:
+                n_copied += self._add_memory_features(mem_provider, feats)
+                feats = []
+                if feedback is not None:
+                    feedback.setProgress(
+                        min(100 * n_copied / n_features, 100))
+        if feedback is not None and feedback.isCanceled():
+            return None
+        if feats:
+            n_copied += self._add_memory_features(mem_provider, feats)
+        mem_layer.updateExtents()
+        if feedback is not None:
+            feedback.setProgress(100)
 
         if add_to_registry:
             if mem_layer.isValid():
@@ -469,6 +1031,12 @@ class ProcessLayer(object):
 
         return mem_layer
 
+    @staticmethod
+    def _add_memory_features(mem_provider, feats):
+        if not mem_provider.addFeatures(feats)[0]:
+            raise AttributeError('Unable to add features to the copy')
+        return len(feats)
+
     def is_type_in(self, type_list):
         """
         :param type_list: we want to check if the type of the layer is
@@ -495,49 +1063,88 @@ class ProcessLayer(object):
         else:
             return False
 
-    def count_vertices(self):
+    def count_vertices(self, per_feature=False, max_workers=None):
         """
-        Inspired by "https://github.com/GeospatialEnablingTechnologies/
-                             GET-Qgis-plugins/blob/master/Vertices_Counter/
-                             Vertices_Counter.py"
-
-        Count the total number of vertices in the layer.
+        Count the total number of vertices in the layer, using the number of
+        coordinates stored by each geometry, without converting them into
+        lists of points. Large layers are split in contiguous ranges of
+        feature ids, each read and counted by a separate thread through its
+        own feature source.
         In DEBUG mode, also print vertices count for each single feature
 
-        :return: The total number of vertices in the layer
+        :param per_feature: if True, return the number of vertices of each
+                            feature instead of the total
+        :param max_workers: the maximum number of threads (if None, it is read
+                            from the settings)
+        :return: The total number of vertices in the layer or, if per_feature
+                 is True, a tuple (feature_ids, vertex_counts) of numpy
+                 arrays
         """
-        layer_vertices = 0
-        for feat in self.layer.getFeatures():
-            feature_vertices = 0
-            geom = feat.geometry()
-            geom_type = geom.type()
-            if geom_type == QgsWkbTypes.PolygonGeometry:
-                if geom.isMultipart():
-                    polygons = geom.asMultiPolygon()
-                else:
-                    polygons = [geom.asPolygon()]
-                for polygon in polygons:
-                    for ring in polygon:
-                        feature_vertices += len(ring)
-            elif geom_type == QgsWkbTypes.LineGeometry:
-                if geom.isMultipart():
-                    lines = geom.asMultiPolyline()
-                else:
-                    lines = [geom.asPolyline()]
-                for line in lines:
-                    feature_vertices += len(line)
-            elif geom_type == QgsWkbTypes.PointGeometry:
-                if geom.isMultipart():
-                    points = geom.asMultiPoint()
-                else:
-                    points = [geom.asPoint()]
-                for point in points:
-                    feature_vertices += 1
-            else:
-                raise TypeError(
-                    'Geometry type %s can not be accepted' % geom_type)
-            layer_vertices += feature_vertices
-            if DEBUG:
+        geom_type = self.layer.geometryType()
+        if geom_type not in (QgsWkbTypes.PolygonGeometry,
+                             QgsWkbTypes.LineGeometry,
+                             QgsWkbTypes.PointGeometry):
+            raise TypeError(
+                'Geometry type %s can not be accepted' % geom_type)
+        if max_workers is None:
+            max_workers = get_max_workers()
+        n_chunks = min(max_workers,
+                       self.layer.featureCount() // MIN_PARALLEL_FEATURES)
+        if n_chunks > 1:
+            # reading only the ids is cheap, and it allows to give each
+            # thread an ordered range of features, so that the ranges are
+            # read forward without jumping back and forth in the data
+            request = QgsFeatureRequest().setFlags(
+                QgsFeatureRequest.NoGeometry).setNoAttributes()
+            all_ids = array([feat.id()
+                             for feat in self.layer.getFeatures(request)],
+                            dtype=int64)
+            all_ids.sort()
+            # feature sources are not thread-safe: each thread gets its own,
+            # built in this thread
+            sources = [QgsVectorLayerFeatureSource(self.layer)
+                       for _ in range(n_chunks)]
+            with ThreadPoolExecutor(n_chunks) as pool:
+                results = list(pool.map(
+                    _count_vertices, sources, array_split(all_ids, n_chunks)))
+            feature_ids = concatenate([ids for ids, _ in results])
+            vertex_counts = concatenate([counts for _, counts in results])
+        else:
+            feature_ids, vertex_counts = _count_vertices(
+                QgsVectorLayerFeatureSource(self.layer))
+        if DEBUG:
+            for feature_id, feature_vertices in zip(feature_ids.tolist(),
+                                                    vertex_counts.tolist()):
                 log_msg("Feature %d, %d vertices"
-                        % (feat.id(), feature_vertices))
-        return layer_vertices
+                        % (feature_id, feature_vertices))
+        if per_feature:
+            return feature_ids, vertex_counts
+        return int(vertex_counts.sum())
+
+
+def _find_attribute_ids(fields, field_names):
+    # resolve each name with a single lookup (see
+    # ProcessLayer.find_attribute_id), as layers can have thousands of fields
+    attr_ids = []
+    for field_name in field_names:
+        attr_id = fields.indexOf(field_name)
+        if attr_id == -1:
+            raise AttributeError('Attribute name %s not found' % field_name)
+        attr_ids.append(attr_id)
+    return attr_ids
+
+
+def _count_vertices(source, feature_ids=None):
+    # count the vertices of the features of a feature source (it can run in
+    # a thread other than the main one, that must be the only one using the
+    # source)
+    request = QgsFeatureRequest().setNoAttributes()
+    if feature_ids is not None:
+        request.setFilterFids(feature_ids.tolist())
+    ids = []
+    counts = []
+    for feat in source.getFeatures(request):
+        ids.append(feat.id())
+        geom = feat.geometry().constGet()
+        counts.append(0 if geom is None else geom.nCoordinates())
+    return array(ids, dtype=int64), array(counts, dtype=int64)
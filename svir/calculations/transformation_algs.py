@@ -23,17 +23,30 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import math
-from numpy import mean, std, argwhere, amax, amin, log10, log
+from numpy import (
+    log10, log, exp, asarray, argsort, empty, intp, arange, r_, nonzero,
+    fromiter, float64, nan, inf, isnan, isfinite, isinf, errstate, array,
+    ones, sqrt, isin, ceil, concatenate, sort, searchsorted, full, random,
+    ma)
 from qgis.core import NULL
 
 from svir.utilities.utils import Register
 
 TRANSFORMATION_ALGS = Register()
-RANK_VARIANTS = ('AVERAGE', 'MIN', 'MAX', 'DENSE', 'ORDINAL')
+# numpy implementations of the algorithms, working on arrays of valid values
+TRANSFORMATION_KERNELS = Register()
+# algorithms that can be computed in two passes over chunks of values: for
+# each of them, a function that, given the statistics collected in the
+# first pass (see streaming_accumulator), returns the function transforming
+# each chunk in the second pass
+STREAMING_KERNELS = Register()
+RANK_VARIANTS = ('AVERAGE', 'MIN', 'MAX', 'DENSE', 'ORDINAL', 'APPROXIMATE')
 QUADRATIC_VARIANTS = ('INCREASING', 'DECREASING')
 LOG10_VARIANTS = ('INCREMENT BY ONE IF ZEROS ARE FOUND',
                   'IGNORE ZEROS')
+# algorithms whose list and dict APIs give NaN, instead of NULL, for the
+# inputs that can not be transformed (e.g. the log10 of negative values)
+NAN_OUTPUT_ALGS = ('LOG10',)
 
 
 def transform(features_dict, algorithm, variant_name="", inverse=False):
@@ -43,6 +56,13 @@ def transform(features_dict, algorithm, variant_name="", inverse=False):
     return a dict containing the transformed values with the original ids
     and the list of invalid input values (or None)
 
+    The values are converted to numpy arrays and transformed through
+    :func:`transform_array`. Missing values (None or NULL) are kept as
+    they are in the output, whereas NULL (or NaN, for the algorithms in
+    NAN_OUTPUT_ALGS) is assigned to the features for which the algorithm
+    could not produce a valid output, and the invalid input values are
+    reported as they were given.
+
     :param features_dict: dictionary containing the features to transform
     :param algorithm: the function to be used to transform the data
     :param variant_name: the (optional) variant to be used
@@ -50,27 +70,371 @@ def transform(features_dict, algorithm, variant_name="", inverse=False):
                     if available
     :returns: (transformed_dict, invalid_input_values)
     """
-    # make a copy of the dictionary containing features (ids and values) and
-    # remove elements containing missing values, so the transformation is
-    # performed only on the subset of valid values
-    f_dict_copy = features_dict.copy()
-    # elements with null value will be saved in another dict, so they can be
-    # re-added afterwards
-    dict_of_null_values = {}
-    for key, value in f_dict_copy.items():
-        if type(value) in (NULL, type(None)):
-            dict_of_null_values[key] = value
-    for key in list(dict_of_null_values.keys()):
-        del f_dict_copy[key]
-    transformed_list, invalid_input_values = algorithm(
-        list(f_dict_copy.values()), variant_name, inverse)
-    transformed_dict = dict(
-        list(zip(list(f_dict_copy.keys()), transformed_list)))
-    # add to the transformed_dict the null elements that were removed
-    transformed_dict.update(dict_of_null_values)
+    algorithm_name = _get_algorithm_name(algorithm)
+    input_values = list(features_dict.values())
+    output_values, invalid_input_values = _list_transform(
+        algorithm_name, input_values, variant_name, inverse)
+    transformed_dict = dict(zip(features_dict.keys(), output_values))
     return transformed_dict, invalid_input_values
 
 
+def transform_array(values, valid_mask, algorithm_name, variant_name="",
+                    inverse=False):
+    """
+    Columnar counterpart of :func:`transform`. Use the numpy kernel
+    registered for the chosen algorithm to transform the valid elements of
+    an array of values
+
+    :param values: float64 numpy array containing the values to transform
+                   (elements corresponding to missing values are ignored)
+    :param valid_mask: boolean numpy array, False where values are missing
+    :param algorithm_name: the name of the algorithm, as registered in
+                           TRANSFORMATION_ALGS
+    :param variant_name: the (optional) variant to be used
+    :param inverse: a boolean (default False) to run the inverse function
+                    if available
+    :returns: (transformed_values, invalid_input_values), where
+              transformed_values is a numpy masked array, masked where the
+              input is missing or the algorithm could not produce a valid
+              output
+    """
+    kernel = TRANSFORMATION_KERNELS[algorithm_name]
+    transformed_values = ma.masked_all(values.shape, dtype=float64)
+    transformed_values[valid_mask], invalid_input_values = kernel(
+        values[valid_mask], variant_name, inverse)
+    return transformed_values, invalid_input_values
+
+
+def values_to_array(input_values):
+    """
+    Convert a list of values, possibly containing missing values (None or
+    NULL), into a float64 numpy array and a boolean validity mask
+
+    :param input_values: list of numbers
+    :returns: (values, valid_mask), where valid_mask is False where values
+              are missing (the corresponding elements of values are NaN)
+    """
+    try:
+        # fast path, for lists that do not contain NULL values (numpy
+        # converts None into NaN)
+        values = array(input_values, dtype=float64)
+    except (TypeError, ValueError):
+        count = len(input_values)
+        valid_mask = fromiter(
+            (value not in (None, NULL) for value in input_values),
+            dtype=bool, count=count)
+        values = fromiter(
+            (value if is_valid else nan
+             for value, is_valid in zip(input_values, valid_mask)),
+            dtype=float64, count=count)
+    else:
+        valid_mask = ones(values.shape, dtype=bool)
+        for i in nonzero(isnan(values))[0]:
+            valid_mask[i] = input_values[i] is not None
+    return values, valid_mask
+
+
+def _get_algorithm_name(algorithm):
+    for algorithm_name, registered_algorithm in TRANSFORMATION_ALGS.items():
+        if registered_algorithm is algorithm:
+            return algorithm_name
+    raise NotImplementedError(
+        "%s is not a registered transformation algorithm" % algorithm)
+
+
+def _list_transform(algorithm_name, input_values, variant_name, inverse):
+    # run the numpy kernel of the algorithm on a list of values, returning a
+    # list of transformed values and the list of the input values (as they
+    # were given, not converted to float) that could not be transformed
+    values, valid_mask = values_to_array(input_values)
+    transformed_values, invalid_input_values = transform_array(
+        values, valid_mask, algorithm_name, variant_name, inverse)
+    keep_nan = algorithm_name in NAN_OUTPUT_ALGS
+    output_values = transformed_values.data.tolist()
+    for i in nonzero(ma.getmaskarray(transformed_values))[0]:
+        if keep_nan and valid_mask[i] and isnan(output_values[i]):
+            continue
+        # missing inputs are kept as they are, whereas the inputs that
+        # could not be transformed produce NULL
+        output_values[i] = NULL if valid_mask[i] else input_values[i]
+    if invalid_input_values:
+        failed = valid_mask & isin(values, invalid_input_values)
+        invalid_input_values = [input_values[i] for i in nonzero(failed)[0]]
+    return output_values, invalid_input_values
+
+
+class RunningStats(object):
+    """
+    Accumulator of count, mean, variance, minimum and maximum of a stream of
+    values, that can be updated one chunk at a time and merged with other
+    accumulators (using the parallel variant of Welford's algorithm, by Chan
+    et al.), so the statistics of a layer can be collected in a single pass
+    without keeping all its values in memory
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared differences from the mean
+        self.min = inf
+        self.max = -inf
+
+    def update(self, values):
+        """
+        Add a chunk of values to the statistics
+
+        :param values: numpy array of (valid) values
+        """
+        if not values.size:
+            return
+        chunk_mean = values.mean()
+        chunk_m2 = ((values - chunk_mean) ** 2).sum()
+        self._merge(values.size, chunk_mean, chunk_m2,
+                    values.min(), values.max())
+
+    def merge(self, other):
+        """
+        Merge the statistics collected by another accumulator (e.g.
+        computed on a separate partition of the same data)
+
+        :param other: a RunningStats instance
+        """
+        if other.count:
+            self._merge(
+                other.count, other.mean, other.m2, other.min, other.max)
+
+    def _merge(self, count, mean_val, m2, min_val, max_val):
+        total_count = self.count + count
+        delta = mean_val - self.mean
+        self.mean += delta * count / total_count
+        self.m2 += m2 + delta ** 2 * self.count * count / total_count
+        self.count = total_count
+        self.min = min(self.min, min_val)
+        self.max = max(self.max, max_val)
+
+    @property
+    def std(self):
+        """
+        Population standard deviation (as numpy.std), or NaN if no values
+        have been added
+        """
+        if not self.count:
+            return nan
+        return sqrt(self.m2 / self.count)
+
+
+class QuantileSketch(object):
+    """
+    KLL quantile sketch (Karnin, Lang and Liberty, "Optimal Quantile
+    Approximation in Streams", 2016), used to estimate the ranks of values
+    without sorting and keeping all of them in memory.
+
+    Values are stored in a hierarchy of compactors: when a level exceeds its
+    capacity, its values are sorted and every other one is promoted to the
+    next level, where each value stands for twice as many inputs. The
+    memory used is O(k) regardless of the amount of values. Like
+    RunningStats, a sketch can be updated one chunk at a time, and sketches
+    of separate partitions of the same data (e.g. built by different worker
+    processes) can be merged, with the same accuracy.
+
+    Error bound: the estimated ranks of all the values differ from the
+    exact ones by at most about 3.3 / k * n (n being the amount of values
+    added to the sketch), with a probability of 99%. With the default
+    k = 200, this is about 1.65% of n. Up to k values, ranks are exact.
+
+    :param k: the size of the largest compactor, controlling the accuracy
+    :param seed: the seed of the random choices of the compactions (fixed,
+                 so results are reproducible)
+    """
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.count = 0
+        # the values stored at level h have weight 2 ** h
+        self.levels = [empty(0, dtype=float64)]
+        self._random = random.RandomState(seed)
+
+    def update(self, values):
+        """
+        Add a chunk of values to the sketch
+
+        :param values: numpy array of (valid) values
+        """
+        if not values.size:
+            return
+        self.count += values.size
+        self.levels[0] = concatenate(
+            [self.levels[0], asarray(values, dtype=float64)])
+        self._compress()
+
+    def merge(self, other):
+        """
+        Merge the sketch of another partition of the same data
+
+        :param other: a QuantileSketch instance
+        """
+        while len(self.levels) < len(other.levels):
+            self.levels.append(empty(0, dtype=float64))
+        for level, level_values in enumerate(other.levels):
+            self.levels[level] = concatenate(
+                [self.levels[level], level_values])
+        self.count += other.count
+        self._compress()
+
+    def _capacity(self, level):
+        # the capacity decreases geometrically going down from the top level
+        depth = len(self.levels) - level - 1
+        return max(int(ceil(self.k * (2.0 / 3.0) ** depth)), 2)
+
+    def _compress(self):
+        compacted = True
+        while compacted:
+            # adding a level reduces the capacity of the lower ones, so
+            # more passes can be needed
+            compacted = False
+            for level in range(len(self.levels)):
+                level_values = self.levels[level]
+                if level_values.size <= self._capacity(level):
+                    continue
+                if level + 1 == len(self.levels):
+                    self.levels.append(empty(0, dtype=float64))
+                level_values = sort(level_values)
+                # with an odd amount of values, the largest stays here
+                n_pairs = level_values.size // 2
+                offset = self._random.randint(2)
+                promoted = level_values[offset:2 * n_pairs:2]
+                self.levels[level] = level_values[2 * n_pairs:]
+                self.levels[level + 1] = concatenate(
+                    [self.levels[level + 1], promoted])
+                compacted = True
+
+    def rank(self, values):
+        """
+        Estimate the average rank (as the AVERAGE variant of RANK) that
+        each of the given values would have among the values added to the
+        sketch
+
+        :param values: numpy array of values
+        :returns: a numpy array of estimated ranks (floats from 1 to count)
+        """
+        items = concatenate(self.levels)
+        weights = concatenate([full(level_values.size, 2 ** level)
+                               for level, level_values
+                               in enumerate(self.levels)])
+        sorter = argsort(items, kind='mergesort')
+        items = items[sorter]
+        cumulative_weights = r_[0, weights[sorter].cumsum()]
+        # estimated amount of values smaller than each value, and smaller or
+        # equal to it
+        n_less = cumulative_weights[searchsorted(items, values, 'left')]
+        n_less_equal = cumulative_weights[
+            searchsorted(items, values, 'right')]
+        return (n_less + n_less_equal + 1) / 2.0
+
+
+def streaming_accumulator(algorithm_name, variant_name=""):
+    """
+    Build the accumulator of the statistics needed by the streaming kernel
+    of an algorithm (see STREAMING_KERNELS), to be updated one chunk of
+    valid values at a time
+
+    :param algorithm_name: the name of the algorithm
+    :param variant_name: the (optional) variant to be used
+    :returns: a RunningStats or a QuantileSketch, or None if the algorithm
+              (or its variant) can not be computed in two passes
+    """
+    if algorithm_name not in STREAMING_KERNELS:
+        return None
+    if algorithm_name == 'RANK':
+        # exact ranks need all the values to be sorted at once
+        if variant_name != 'APPROXIMATE':
+            return None
+        return QuantileSketch()
+    return RunningStats()
+
+
+class TransformationPipeline(object):
+    """
+    Sequence of transformations to be applied one after the other to the
+    same values (e.g. LOG10, then inverse MIN_MAX), evaluated in memory on
+    a single column, without storing the intermediate results
+
+    :param steps: an (optional) iterable of tuples
+                  (algorithm_name, variant_name, inverse), with the names
+                  registered in TRANSFORMATION_ALGS
+
+    An example of usage:
+
+    .. code-block:: python
+
+       pipeline = TransformationPipeline().add_step(
+           'LOG10', 'INCREMENT BY ONE IF ZEROS ARE FOUND').add_step(
+           'MIN_MAX', inverse=True)
+       transformed_values, invalid_input_values = pipeline.transform_array(
+           values, valid_mask)
+    """
+    def __init__(self, steps=()):
+        self.steps = []
+        for step in steps:
+            self.add_step(*step)
+
+    def add_step(self, algorithm_name, variant_name="", inverse=False):
+        """
+        Append a transformation to the pipeline
+
+        :param algorithm_name: the name of the algorithm
+        :param variant_name: the (optional) variant to be used
+        :param inverse: a boolean (default False) to run the inverse function
+                        if available
+        :returns: the pipeline itself, so that calls can be chained
+        """
+        if algorithm_name not in TRANSFORMATION_KERNELS:
+            raise NotImplementedError(
+                "%s is not a registered transformation algorithm"
+                % algorithm_name)
+        self.steps.append((algorithm_name, variant_name, bool(inverse)))
+        return self
+
+    @property
+    def key(self):
+        """
+        Hashable description of the pipeline
+        """
+        return tuple(self.steps)
+
+    def transform_array(self, values, valid_mask):
+        """
+        Apply all the steps of the pipeline (see :func:`transform_array`)
+
+        :param values: float64 numpy array containing the values to transform
+                       (elements corresponding to missing values are ignored)
+        :param valid_mask: boolean numpy array, False where values are missing
+        :returns: (transformed_values, invalid_input_values), where
+                  transformed_values is a numpy masked array, masked where
+                  the input is missing or any step could not produce a finite
+                  output, and invalid_input_values lists the input values
+                  that could not be transformed by some step (or None)
+        """
+        if not self.steps:
+            raise ValueError('The transformation pipeline has no steps')
+        input_values = values
+        invalid_input_values = []
+        for algorithm_name, variant_name, inverse in self.steps:
+            transformed_values, step_invalid_values = transform_array(
+                values, valid_mask, algorithm_name, variant_name, inverse)
+            # non-finite outputs (e.g. the log10 of negative values) can not
+            # be fed to the next step
+            output_valid_mask = (~ma.getmaskarray(transformed_values)
+                                 & isfinite(transformed_values.data))
+            transformed_values[~output_valid_mask] = ma.masked
+            if step_invalid_values:
+                # report the original inputs, not the intermediate values
+                failed = valid_mask & ~output_valid_mask & isin(
+                    values, step_invalid_values)
+                invalid_input_values.extend(input_values[failed].tolist())
+            values = transformed_values.data
+            valid_mask = output_valid_mask
+        return transformed_values, invalid_input_values or None
+
+
 @TRANSFORMATION_ALGS.add('RANK')
 def rank(input_values, variant_name="AVERAGE", inverse=False):
     """Assign ranks to data, dealing with ties appropriately.
@@ -80,102 +444,98 @@ def rank(input_values, variant_name="AVERAGE", inverse=False):
                          [AVERAGE, MIN, MAX, DENSE, ORDINAL]
                          and they correspond to
                          different strategies on how to cope with ties
-                         (default: AVERAGE)
+                         (default: AVERAGE). The APPROXIMATE variant
+                         estimates AVERAGE ranks using a QuantileSketch,
+                         with the error bound documented there
     :param inverse: instead of giving the highest rank to the biggest
                     input value, give the highest rank to the smallest
                     input value
     :returns: list of ranks corresponding to the input data
     :raises: NotImplementedError if variant_name is not implemented
     """
-    input_copy = input_values[:]
-    len_input_values = len(input_values)
-    rank_list = [0] * len_input_values
-    previous_ties = 0
-    if not inverse:  # high values get high ranks
-        # obtain a value above the maximum value contained in input_values,
-        # so it will never be picked as the minimum element of the list
-        above_max_input = max([value for value in input_values]) + 1
-        curr_idx = 1
-        while curr_idx <= len_input_values:
-            # get the list of indices of the min elements of input_copy.
-            # note that we might have ties.
-            bottom_indices = argwhere(
-                input_copy == amin(input_copy)).flatten().tolist()
-            bottom_amount = len(bottom_indices)
-            for bottom_idx in bottom_indices:
-                if variant_name == "AVERAGE":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 4.5
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = \
-                        (2 * curr_idx + bottom_amount - 1) / 2.0
-                elif variant_name == "MIN":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 3.
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = curr_idx
-                elif variant_name == "MAX":
-                    # e.g., if 4 inputs are equal, and they would receive
-                    # ranks from 3 to 6, all of them will obtain rank 6
-                    # Afterwards the ranks increase from 7 on.
-                    rank_list[bottom_idx] = curr_idx + bottom_amount - 1
-                elif variant_name == "DENSE":
-                    # the same as for "MIN", but instead of ranking the
-                    # next elements counting from 7 on, the ranks will
-                    # increase from 4 on (no "jumps").
-                    rank_list[bottom_idx] = curr_idx - previous_ties
-                elif variant_name == "ORDINAL":
-                    # the ties are ranked in a "ordinal" way, assigning
-                    # the smallest rank to the leftmost tie found, and so on.
-                    rank_list[bottom_idx] = curr_idx
-                    curr_idx += 1
-                else:
-                    raise NotImplementedError(
-                        "%s variant not implemented" % variant_name)
-                # "discard" the tie, so it will not be found as the min in
-                # the next iteration (instead of removing it, which would
-                # modify the list indices, I make it bigger than the
-                # biggest input)
-                input_copy[bottom_idx] = above_max_input
-            if variant_name != "ORDINAL":
-                # necessary adjustment in case of "ORDINAL"
-                curr_idx += bottom_amount
-            # necessary for the "DENSE" variant, to keep a count of ties
-            previous_ties += bottom_amount - 1
-
-    else:  # inverse, i.e., small inputs get high ranks
-        # same as the direct methods, but proceeding top->down
-        below_min_input = min([value if value not in (None, NULL) else None
-                              for value in input_values]) - 1
-        curr_idx = len_input_values
-        while curr_idx > 0:
-            top_indices = argwhere(
-                input_copy == amax(input_copy)).flatten().tolist()
-            top_amount = len(top_indices)
-            for top_idx in top_indices:
-                if variant_name == "AVERAGE":
-                    rank_list[top_idx] = (
-                        len_input_values - (2 * curr_idx - top_amount - 1) /
-                        2.0)
-                elif variant_name == "MIN":
-                    rank_list[top_idx] = len_input_values - curr_idx + 1
-                elif variant_name == "MAX":
-                    rank_list[top_idx] = (
-                        len_input_values - curr_idx + top_amount)
-                elif variant_name == "DENSE":
-                    rank_list[top_idx] = \
-                        len_input_values - curr_idx - previous_ties + 1
-                elif variant_name == "ORDINAL":
-                    rank_list[top_idx] = len_input_values - curr_idx + 1
-                    curr_idx -= 1
-                else:
-                    raise NotImplementedError(
-                        "%s variant not implemented" % variant_name)
-                input_copy[top_idx] = below_min_input
-            if variant_name != "ORDINAL":
-                curr_idx -= top_amount
-            previous_ties += top_amount - 1
-    return rank_list, None
+    return _rank_array(input_values, variant_name, inverse).tolist(), None
+
+
+@TRANSFORMATION_KERNELS.add('RANK')
+def _rank_kernel(values, variant_name="AVERAGE", inverse=False):
+    return _rank_array(values, variant_name, inverse), None
+
+
+@STREAMING_KERNELS.add('RANK')
+def _rank_streaming(sketch, variant_name="APPROXIMATE", inverse=False):
+    if variant_name != 'APPROXIMATE':
+        raise NotImplementedError(
+            "%s variant can not be computed in chunks" % variant_name)
+
+    def transform_chunk(values):
+        ranks = sketch.rank(values)
+        if inverse:
+            # the smallest value gets the highest rank
+            ranks = sketch.count + 1 - ranks
+        return ranks
+    return transform_chunk
+
+
+def _rank_array(input_values, variant_name="AVERAGE", inverse=False):
+    """
+    Sort-based ranking of input_values, in O(n log n)
+
+    Ties are detected comparing each value with the previous one in the
+    sorted array, so ranks can be computed for each group of ties at once,
+    instead of looking for the minimum value over and over again.
+
+    :param input_values: the list (or array) of numbers to rank
+    :param variant_name: one of RANK_VARIANTS
+    :param inverse: if True, the highest rank is given to the smallest value
+    :returns: a numpy array of ranks (floats for the AVERAGE variant,
+              integers otherwise)
+    """
+    values = asarray(input_values)
+    if variant_name == "APPROXIMATE":
+        sketch = QuantileSketch()
+        sketch.update(values)
+        return _rank_streaming(sketch, variant_name, inverse)(values)
+    if inverse:
+        # ranking the opposite values, small inputs get high ranks
+        values = -values
+    # a stable sort is needed by the ORDINAL variant, that gives the
+    # smallest rank to the leftmost tie
+    sorter = argsort(values, kind='mergesort')
+    # position of each input element inside the sorted array
+    inv_sorter = empty(sorter.size, dtype=intp)
+    inv_sorter[sorter] = arange(sorter.size)
+    if variant_name == "ORDINAL":
+        # e.g., if 4 inputs are equal, and they would receive ranks from 3
+        # to 6, the leftmost will get 3, the next one 4 and so on
+        return inv_sorter + 1
+    sorted_values = values[sorter]
+    # True where a new group of ties starts
+    is_first_of_group = r_[True, sorted_values[1:] != sorted_values[:-1]]
+    dense = is_first_of_group.cumsum()[inv_sorter]
+    if variant_name == "DENSE":
+        # e.g., if 4 inputs are equal, and they would receive ranks from 3
+        # to 6, all of them will obtain rank 3, and the ranks will increase
+        # from 4 on (no "jumps")
+        return dense
+    # cumulative count of elements preceding each group of ties (plus the
+    # total amount of elements, to close the last group)
+    group_bounds = r_[nonzero(is_first_of_group)[0], sorter.size]
+    if variant_name == "MIN":
+        # e.g., if 4 inputs are equal, and they would receive ranks from 3
+        # to 6, all of them will obtain rank 3. Afterwards the ranks
+        # increase from 7 on.
+        return group_bounds[dense - 1] + 1
+    if variant_name == "MAX":
+        # e.g., if 4 inputs are equal, and they would receive ranks from 3
+        # to 6, all of them will obtain rank 6. Afterwards the ranks
+        # increase from 7 on.
+        return group_bounds[dense]
+    if variant_name == "AVERAGE":
+        # e.g., if 4 inputs are equal, and they would receive ranks from 3
+        # to 6, all of them will obtain rank 4.5. Afterwards the ranks
+        # increase from 7 on.
+        return (group_bounds[dense] + group_bounds[dense - 1] + 1) / 2.0
+    raise NotImplementedError("%s variant not implemented" % variant_name)
 
 
 @TRANSFORMATION_ALGS.add('Z_SCORE')
@@ -186,27 +546,32 @@ def z_score(input_values, variant_name=None, inverse=False):
     Inverse:
         Multiply each input by -1, before doing exactly the same
     """
+    return _list_transform('Z_SCORE', input_values, variant_name, inverse)
+
+
+@TRANSFORMATION_KERNELS.add('Z_SCORE')
+def _z_score_kernel(values, variant_name=None, inverse=False):
+    stats = RunningStats()
+    stats.update(values)
+    return _z_score_streaming(stats, variant_name, inverse)(values), None
+
+
+@STREAMING_KERNELS.add('Z_SCORE')
+def _z_score_streaming(stats, variant_name=None, inverse=False):
     if variant_name:
         raise NotImplementedError("%s variant not implemented" % variant_name)
-    mean_val = mean([value for value in input_values
-                     if value not in (None, NULL)])
-    stddev_val = std([value for value in input_values
-                      if value not in (None, NULL)])
+    mean_val = stats.mean
+    stddev_val = stats.std
     if stddev_val == 0:
         raise ValueError("The Z-Score transformation can not be performed "
                          "if the standard deviation of the input values is 0")
-    input_copy = input_values[:]
-    if inverse:
-        # multiply each input_values element by -1
-        input_copy[:] = [-x
-                         if x not in (None, NULL)
-                         else None
-                         for x in input_values]
-    output_values = [
-        float((x - mean_val) / stddev_val)
-        if x not in (None, NULL) else None
-        for x in input_copy]
-    return output_values, None
+
+    def transform_chunk(values):
+        if inverse:
+            # multiply each input element by -1
+            values = -values
+        return (values - mean_val) / stddev_val
+    return transform_chunk
 
 
 @TRANSFORMATION_ALGS.add('MIN_MAX')
@@ -217,27 +582,36 @@ def min_max(input_values, variant_name=None, inverse=False):
     Inverse:
         :math:`f(x_i) = 1 - \frac{x_i - \min(x)}{\max(x) - \min(x)}`
     """
+    return _list_transform('MIN_MAX', input_values, variant_name, inverse)
+
+
+@TRANSFORMATION_KERNELS.add('MIN_MAX')
+def _min_max_kernel(values, variant_name=None, inverse=False):
+    stats = RunningStats()
+    stats.update(values)
+    return _min_max_streaming(stats, variant_name, inverse)(values), None
+
+
+@STREAMING_KERNELS.add('MIN_MAX')
+def _min_max_streaming(stats, variant_name=None, inverse=False):
     if variant_name:
         raise NotImplementedError("%s variant not implemented" % variant_name)
-    min_value = min((value for value in input_values
-                    if value not in (None, NULL)))
-    max_value = max((value for value in input_values
-                    if value not in (None, NULL)))
-    # Get the range of the list
-    min_max_range = float(max_value - min_value)
+    if not stats.count:
+        raise ValueError("The min_max transformation can not be performed"
+                         " if no valid values are available.")
+    min_value = stats.min
+    # Get the range of the values
+    min_max_range = float(stats.max - min_value)
     if min_max_range == 0:
         raise ValueError("The min_max transformation can not be performed"
                          " if the range of valid values (max-min) is zero.")
-    # Transform
-    if inverse:
-        output_values = [1.0 - ((x - min_value) / min_max_range)
-                         if x not in (None, NULL) else None
-                         for x in input_values]
-    else:
-        output_values = [(x - min_value) / min_max_range
-                         if x not in (None, NULL) else None
-                         for x in input_values]
-    return output_values, None
+
+    def transform_chunk(values):
+        output_values = (values - min_value) / min_max_range
+        if inverse:
+            output_values = 1.0 - output_values
+        return output_values
+    return transform_chunk
 
 
 @TRANSFORMATION_ALGS.add('LOG10')
@@ -254,36 +628,36 @@ def log10_(input_values,
       data by 1
 
     Then use numpy.log10 function to perform the log10 transformation on the
-    list of values
+    list of values. Negative inputs produce NaN, and they are returned in the
+    list of invalid input values (the columnar kernel masks their outputs)
     """
+    return _list_transform('LOG10', input_values, variant_name, inverse)
+
+
+@TRANSFORMATION_KERNELS.add('LOG10')
+def _log10_kernel(values, variant_name='IGNORE ZEROS', inverse=False):
     if inverse:
         raise NotImplementedError(
             "Inverse transformation for log10 is not implemented")
     if variant_name not in LOG10_VARIANTS:
         raise NotImplementedError(
             "%s variant not implemented" % variant_name)
-    if any(n == 0 for n in input_values):
-        if variant_name == 'INCREMENT BY ONE IF ZEROS ARE FOUND':
-            corrected_input = [input_value + 1 for input_value in input_values]
-            output_values = [
-                float(value) if value not in (None, NULL) else None
-                for value in list(log10(corrected_input))]
-            return output_values, None
-        elif variant_name == 'IGNORE ZEROS':
-            output_values = []
-            for input_value in input_values:
-                if input_value in (0, NULL):
-                    output_value = NULL
-                    output_values.append(output_value)
-                else:
-                    output_values.append(log10(input_value))
-            for i, value in enumerate(output_values):
-                if value in (NULL, None):
-                    continue
-                output_values[i] = float(value)
-            return output_values, None
-    output_values = [float(value) for value in list(log10(input_values))]
-    return output_values, None
+    zeros_mask = values == 0
+    incremented_values = values
+    if (variant_name == 'INCREMENT BY ONE IF ZEROS ARE FOUND'
+            and zeros_mask.any()):
+        incremented_values = values + 1
+    with errstate(divide='ignore', invalid='ignore'):
+        output_values = log10(incremented_values)
+    # negative inputs produce NaN (the original zeros are either ignored or
+    # incremented by one)
+    invalid_mask = ~isfinite(output_values) & ~zeros_mask
+    output_mask = invalid_mask
+    if variant_name == 'IGNORE ZEROS':
+        output_mask = output_mask | zeros_mask
+    # the invalid inputs are reported as they were given, not incremented
+    return (ma.array(output_values, mask=output_mask),
+            values[invalid_mask].tolist())
 
 
 @TRANSFORMATION_ALGS.add('QUADRATIC')
@@ -298,24 +672,27 @@ def simple_quadratic(input_values, variant_name="INCREASING", inverse=False):
     Inverse:
         For each output x, the final output will be 1 - x
     """
+    return _list_transform('QUADRATIC', input_values, variant_name, inverse)
+
+
+@TRANSFORMATION_KERNELS.add('QUADRATIC')
+def _simple_quadratic_kernel(values, variant_name="INCREASING",
+                             inverse=False):
     bottom = 0.0
-    max_input = max(input_values)
+    max_input = values.max()
     if max_input - bottom == 0:
         raise ZeroDivisionError("It is impossible to perform the "
                                 "transformation if the maximum "
                                 "input value is 0")
     squared_range = (max_input - bottom) ** 2
     if variant_name == "INCREASING":
-        output_values = [
-            (x - bottom) ** 2 / squared_range for x in input_values]
+        output_values = (values - bottom) ** 2 / squared_range
     elif variant_name == "DECREASING":
-        output_values = [(max_input - (x - bottom)) ** 2 / squared_range
-                         for x in input_values]
-
+        output_values = (max_input - (values - bottom)) ** 2 / squared_range
     else:
         raise NotImplementedError("%s variant not implemented" % variant_name)
     if inverse:
-        output_values[:] = [1.0 - x for x in output_values]
+        output_values = 1.0 - output_values
     return output_values, None
 
 
@@ -327,25 +704,29 @@ def sigmoid(input_values, variant_name="", inverse=False):
 
     Inverse function:
         :math:`f(x) = \ln(\frac{x}{1-x})`
+
+    Inputs for which the output can not be computed (i.e. inputs that make
+    the exponential overflow, or inputs outside the range (0, 1) for the
+    inverse function) produce NULL, and they are returned in the list of
+    invalid input values
     """
+    return _list_transform('SIGMOID', input_values, variant_name, inverse)
+
+
+@TRANSFORMATION_KERNELS.add('SIGMOID')
+def _sigmoid_kernel(values, variant_name="", inverse=False):
     if variant_name:
         raise NotImplementedError("%s variant not implemented" % variant_name)
-    output_values = []
-    invalid_input_values = []
-    if inverse:
-        for y in input_values:
-            try:
-                output = float(log(y / (1 - y)))
-            except Exception:
-                output = NULL
-                invalid_input_values.append(y)
-            output_values.append(output)
-    else:  # direct
-        for x in input_values:
-            try:
-                output = float(1 / (1 + math.exp(-x)))
-            except Exception:
-                output = NULL
-                invalid_input_values.append(x)
-            output_values.append(output)
-    return output_values, invalid_input_values
+    with errstate(divide='ignore', over='ignore', invalid='ignore'):
+        if inverse:
+            output_values = log(values / (1 - values))
+            # the logarithm is defined only for inputs between 0 and 1
+            # (excluded); NaN or infinite values are produced elsewhere
+            invalid_mask = ~isfinite(output_values)
+        else:  # direct
+            exp_values = exp(-values)
+            # very small inputs make the exponential overflow
+            invalid_mask = isinf(exp_values)
+            output_values = 1 / (1 + exp_values)
+    return (ma.array(output_values, mask=invalid_mask),
+            values[invalid_mask].tolist())
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+from collections import OrderedDict
+
+# maximum number of transformed columns kept in memory
+TRANSFORMATION_CACHE_SIZE = 16
+
+
+def column_fingerprint(values, valid_mask):
+    """
+    Compute a hash of the content of a column, as read by
+    :meth:`svir.calculations.process_layer.ProcessLayer.read_attribute_in_chunks`
+
+    :param values: a numpy array of floats
+    :param valid_mask: a numpy array of booleans, False where values are
+                       missing
+    :returns: a string containing the hexadecimal digest of the column
+    """
+    digest = hashlib.sha1(valid_mask.tobytes())
+    # missing values are ignored, whatever their placeholder is
+    digest.update(values[valid_mask].tobytes())
+    return digest.hexdigest()
+
+
+class TransformationCache(object):
+    """
+    Least recently used cache of the results of transformations of layer
+    attributes, keyed by (layer id, attribute name, algorithm, variant,
+    inverse, content fingerprint of the attribute).
+
+    Since the fingerprint of the content is part of the key, a stale result
+    can never be returned. Anyway, the entries of the watched layers (see
+    :meth:`watch`) are dropped as soon as the corresponding attributes are
+    modified, to release their memory.
+
+    :param max_entries: maximum number of results kept in memory
+    """
+    def __init__(self, max_entries=TRANSFORMATION_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._watched_layer_ids = set()
+        # layer id -> set of the ids of the attributes having cached results
+        # (computed when needed, and reset when entries or fields change)
+        self._cached_attr_ids = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, layer_id, attr_name, algorithm_name, variant, inverse,
+            fingerprint):
+        """
+        Get the result of a transformation, if it is cached
+
+        :returns: a tuple (transformed_values, invalid_input_values), or None
+        """
+        key = (layer_id, attr_name, algorithm_name, variant, bool(inverse),
+               fingerprint)
+        try:
+            transformed_values, invalid_input_values = self._entries[key]
+        except KeyError:
+            return None
+        self._entries.move_to_end(key)
+        if invalid_input_values is not None:
+            invalid_input_values = list(invalid_input_values)
+        return transformed_values.copy(), invalid_input_values
+
+    def put(self, layer_id, attr_name, algorithm_name, variant, inverse,
+            fingerprint, result):
+        """
+        Store the result of a transformation, evicting the least recently
+        used one if the cache is full
+
+        :param result: a tuple (transformed_values, invalid_input_values)
+        """
+        if self.max_entries <= 0:
+            return
+        key = (layer_id, attr_name, algorithm_name, variant, bool(inverse),
+               fingerprint)
+        transformed_values, invalid_input_values = result
+        if invalid_input_values is not None:
+            invalid_input_values = list(invalid_input_values)
+        self._entries[key] = (transformed_values.copy(), invalid_input_values)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._cached_attr_ids.clear()
+
+    def invalidate(self, layer_id=None, attr_names=None):
+        """
+        Drop cached results
+
+        :param layer_id: if specified, only the results obtained for the
+                         layer with this id are dropped
+        :param attr_names: if specified, only the results obtained for these
+                           attributes are dropped
+        """
+        for key in list(self._entries):
+            if layer_id is not None and key[0] != layer_id:
+                continue
+            if attr_names is not None and key[1] not in attr_names:
+                continue
+            del self._entries[key]
+        self._cached_attr_ids.clear()
+
+    def cached_attr_names(self, layer_id):
+        """
+        :returns: the set of names of the attributes of the layer having
+                  cached results
+        """
+        return {key[1] for key in self._entries if key[0] == layer_id}
+
+    def watch(self, layer):
+        """
+        Drop the cached results of the layer when its attributes are modified,
+        its features are added or removed, or the layer is deleted
+
+        :param layer: a QgsVectorLayer
+        """
+        layer_id = layer.id()
+        if layer_id in self._watched_layer_ids:
+            return
+        self._watched_layer_ids.add(layer_id)
+
+        def attr_names_from_ids(attr_ids):
+            fields = layer.fields()
+            return {fields.at(attr_id).name() for attr_id in attr_ids
+                    if 0 <= attr_id < fields.count()}
+
+        def on_attribute_value_changed(feat_id, attr_id, value):
+            # emitted for each changed value, so it has to be cheap: the ids
+            # of the attributes with cached results are looked up only once
+            if not self._entries:
+                return
+            cached_attr_ids = self._cached_attr_ids.get(layer_id)
+            if cached_attr_ids is None:
+                fields = layer.fields()
+                cached_attr_ids = {
+                    fields.indexOf(attr_name)
+                    for attr_name in self.cached_attr_names(layer_id)}
+                self._cached_attr_ids[layer_id] = cached_attr_ids
+            if attr_id in cached_attr_ids:
+                self.invalidate(layer_id, attr_names_from_ids([attr_id]))
+
+        def on_updated_fields():
+            # adding or removing fields can change the ids of the attributes
+            self._cached_attr_ids.pop(layer_id, None)
+
+        def on_committed_values(committed_layer_id, changed_values):
+            attr_ids = set()
+            for feat_changes in changed_values.values():
+                attr_ids.update(feat_changes.keys())
+            self.invalidate(layer_id, attr_names_from_ids(attr_ids))
+
+        def on_committed_features(*args):
+            self.invalidate(layer_id)
+
+        def on_will_be_deleted():
+            self.invalidate(layer_id)
+            self._watched_layer_ids.discard(layer_id)
+
+        layer.attributeValueChanged.connect(on_attribute_value_changed)
+        layer.updatedFields.connect(on_updated_fields)
+        layer.committedAttributeValuesChanges.connect(on_committed_values)
+        layer.committedFeaturesAdded.connect(on_committed_features)
+        layer.committedFeaturesRemoved.connect(on_committed_features)
+        layer.willBeDeleted.connect(on_will_be_deleted)
+
+
+# cache shared by all the transformations performed by the plugin
+TRANSFORMATION_CACHE = TransformationCache()
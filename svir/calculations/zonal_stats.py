@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from numpy import (
+    arange, argsort, array, asarray, bincount, concatenate, errstate, full,
+    int64, isnan, lexsort, ma, nan, nonzero, searchsorted, sqrt, unique,
+    zeros)
+from qgis.core import QgsGeometry, QgsPoint
+
+from svir.calculations.parallel import (
+    get_max_workers, get_process_pool, MIN_PARALLEL_POINTS)
+from svir.utilities.utils import log_msg
+
+# summaries that can be calculated by :func:`summarize_by_zone` (the names
+# are the same used by the processing algorithm 'qgis:joinbylocationsummary')
+NATIVE_SUMMARIES = ('count', 'sum', 'mean', 'min', 'max', 'range', 'median',
+                    'stddev', 'q1', 'q3', 'iqr')
+
+# maximum number of assignments of points to zones kept in memory
+ZONE_ASSIGNMENT_CACHE_SIZE = 8
+
+# number of tiles per worker process joining points with zones in parallel
+# (more tiles than workers balance the load when zones are denser in some
+# areas)
+TILES_PER_WORKER = 4
+
+
+def assign_points_to_zones(xs, ys, zone_geometries, feedback=None):
+    """
+    Find the zones intersecting each point. Points are indexed by sorting
+    their x coordinates, so that the candidate points of a zone (the ones
+    inside its bounding box) are found by binary search, then they are
+    tested against the prepared geometry of the zone. A point lying on the
+    border between zones is assigned to each of them.
+
+    :param xs: numpy array with the x coordinates of the points (NaN or
+               masked for points without geometry)
+    :param ys: numpy array with the y coordinates of the points
+    :param zone_geometries: list of the QgsGeometry of the zones, in the same
+                            crs of the points
+    :param feedback: an (optional) feedback object, receiving the progress
+                     and allowing to cancel the calculation
+    :type feedback: QgsFeedback
+    :returns: a tuple (point_idxs, zone_idxs) of numpy arrays, containing the
+              index of a point and the index of a zone for each match, or
+              None if the calculation was canceled
+    """
+    xs = ma.filled(xs, float('nan'))
+    ys = ma.filled(ys, float('nan'))
+    order, sorted_xs = _index_points(xs)
+    point_idxs = []
+    zone_idxs = []
+    n_zones = len(zone_geometries)
+    for zone_idx, geom in enumerate(zone_geometries):
+        if feedback is not None:
+            if feedback.isCanceled():
+                return None
+            feedback.setProgress(100 * zone_idx / n_zones)
+        if geom is None or geom.isNull():
+            continue
+        bbox = geom.boundingBox()
+        candidates = _points_in_bbox(
+            order, sorted_xs, ys, bbox.xMinimum(), bbox.yMinimum(),
+            bbox.xMaximum(), bbox.yMaximum())
+        if not len(candidates):
+            continue
+        engine = QgsGeometry.createGeometryEngine(geom.constGet())
+        engine.prepareGeometry()
+        hits = [engine.intersects(QgsPoint(x, y)) for x, y in zip(
+            xs[candidates].tolist(), ys[candidates].tolist())]
+        hits = candidates[array(hits, dtype=bool)]
+        point_idxs.append(hits)
+        zone_idxs.append(zeros(len(hits), dtype=int64) + zone_idx)
+    if feedback is not None:
+        feedback.setProgress(100)
+    if not point_idxs:
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    return concatenate(point_idxs), concatenate(zone_idxs)
+
+
+def _index_points(xs):
+    # points without geometry are left out of the index
+    order = argsort(xs, kind='stable')
+    order = order[~isnan(xs[order])]
+    return order, xs[order]
+
+
+def _points_in_bbox(order, sorted_xs, ys, xmin, ymin, xmax, ymax):
+    start = searchsorted(sorted_xs, xmin, side='left')
+    stop = searchsorted(sorted_xs, xmax, side='right')
+    candidates = order[start:stop]
+    return candidates[(ys[candidates] >= ymin) & (ys[candidates] <= ymax)]
+
+
+def partition_zones_into_tiles(bboxes, n_tiles):
+    """
+    Partition zones into spatial tiles, splitting recursively the most
+    populated tile in two halves with the same number of zones, across the
+    longest side of the extent of the centers of their bounding boxes. Each
+    zone belongs to exactly one tile.
+
+    :param bboxes: numpy array of shape (n_zones, 4) with the bounding box
+                   (xmin, ymin, xmax, ymax) of each zone, NaN for zones
+                   without geometry
+    :param n_tiles: the maximum number of tiles
+    :returns: a list of numpy arrays, with the indices of the zones in each
+              tile (zones without geometry are not in any tile)
+    """
+    bboxes = asarray(bboxes, dtype=float).reshape(-1, 4)
+    zone_idxs = nonzero(~isnan(bboxes).any(axis=1))[0]
+    if not len(zone_idxs):
+        return []
+    centers_x = (bboxes[:, 0] + bboxes[:, 2]) / 2
+    centers_y = (bboxes[:, 1] + bboxes[:, 3]) / 2
+    tiles = [zone_idxs]
+    while len(tiles) < n_tiles:
+        largest = max(range(len(tiles)), key=lambda idx: len(tiles[idx]))
+        tile = tiles[largest]
+        if len(tile) < 2:
+            break
+        xs = centers_x[tile]
+        ys = centers_y[tile]
+        if xs.max() - xs.min() >= ys.max() - ys.min():
+            tile = tile[argsort(xs, kind='stable')]
+        else:
+            tile = tile[argsort(ys, kind='stable')]
+        half = len(tile) // 2
+        tiles[largest:largest + 1] = [tile[:half], tile[half:]]
+    return tiles
+
+
+def assign_points_to_zones_in_parallel(
+        xs, ys, zone_geometries, feedback=None, max_workers=None,
+        tiles_per_worker=TILES_PER_WORKER):
+    """
+    Find the zones intersecting each point (see
+    :func:`assign_points_to_zones`), partitioning the zones into spatial
+    tiles (see :func:`partition_zones_into_tiles`) that are processed by
+    separate worker processes. Each worker receives the zones of a tile, as
+    WKB, and the coordinates of the points inside the bounding box of the
+    tile. As each zone belongs to only one tile, a point on the edge between
+    tiles can be sent to several workers, but each match of a point in a
+    zone is found only once, and the partial results of the tiles are merged
+    by concatenating them. With few points, or a single worker, or if the
+    worker processes fail (e.g. they can not be started), the points are
+    assigned sequentially.
+
+    :param xs: numpy array with the x coordinates of the points (NaN or
+               masked for points without geometry)
+    :param ys: numpy array with the y coordinates of the points
+    :param zone_geometries: list of the QgsGeometry of the zones, in the same
+                            crs of the points
+    :param feedback: an (optional) feedback object, receiving the progress
+                     (the fraction of processed tiles) and allowing to
+                     cancel the calculation
+    :type feedback: QgsFeedback
+    :param max_workers: the maximum number of worker processes (if None,
+                        it is read from the settings)
+    :param tiles_per_worker: number of tiles per worker process
+    :returns: a tuple (point_idxs, zone_idxs) of numpy arrays, containing the
+              index of a point and the index of a zone for each match, sorted
+              by zone and point, or None if the calculation was canceled
+    """
+    if max_workers is None:
+        max_workers = get_max_workers()
+    pool = None
+    if (max_workers > 1 and len(zone_geometries) > 1
+            and len(xs) >= MIN_PARALLEL_POINTS):
+        pool = get_process_pool(max_workers)
+    if pool is None:
+        return _sort_assignment(
+            assign_points_to_zones(xs, ys, zone_geometries, feedback))
+    futures = []
+    try:
+        xs = ma.filled(xs, float('nan'))
+        ys = ma.filled(ys, float('nan'))
+        bboxes = full((len(zone_geometries), 4), nan)
+        for zone_idx, geom in enumerate(zone_geometries):
+            if geom is None or geom.isNull():
+                continue
+            bbox = geom.boundingBox()
+            bboxes[zone_idx] = (bbox.xMinimum(), bbox.yMinimum(),
+                                bbox.xMaximum(), bbox.yMaximum())
+        order, sorted_xs = _index_points(xs)
+        for tile in partition_zones_into_tiles(
+                bboxes, max_workers * tiles_per_worker):
+            if feedback is not None and feedback.isCanceled():
+                return None
+            tile_bboxes = bboxes[tile]
+            tile_point_idxs = _points_in_bbox(
+                order, sorted_xs, ys,
+                tile_bboxes[:, 0].min(), tile_bboxes[:, 1].min(),
+                tile_bboxes[:, 2].max(), tile_bboxes[:, 3].max())
+            if not len(tile_point_idxs):
+                continue
+            zone_wkbs = [bytes(zone_geometries[zone_idx].asWkb())
+                         for zone_idx in tile.tolist()]
+            futures.append(pool.submit(
+                _assign_tile_points_to_zones, zone_wkbs, tile,
+                tile_point_idxs, xs[tile_point_idxs], ys[tile_point_idxs]))
+        point_idxs = [zeros(0, dtype=int64)]
+        zone_idxs = [zeros(0, dtype=int64)]
+        pending = set(futures)
+        while pending:
+            if feedback is not None:
+                if feedback.isCanceled():
+                    return None
+                feedback.setProgress(
+                    100 * (len(futures) - len(pending)) / len(futures))
+            done, pending = wait(
+                pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            for future in done:
+                tile_point_idxs, tile_zone_idxs = future.result()
+                point_idxs.append(tile_point_idxs)
+                zone_idxs.append(tile_zone_idxs)
+        if feedback is not None:
+            feedback.setProgress(100)
+        # the result does not depend on the order of completion of the tiles
+        return _sort_assignment(
+            (concatenate(point_idxs), concatenate(zone_idxs)))
+    except (BrokenProcessPool, OSError) as exc:
+        log_msg('Unable to join points and zones in parallel (%s): they will'
+                ' be joined sequentially' % exc, level='W')
+    finally:
+        for future in futures:
+            future.cancel()
+        # tiles that are already being processed are not waited for
+        pool.shutdown(wait=False)
+    return _sort_assignment(
+        assign_points_to_zones(xs, ys, zone_geometries, feedback))
+
+
+def _sort_assignment(assignment):
+    # sort the matches by zone and point (None if canceled)
+    if assignment is None:
+        return None
+    point_idxs, zone_idxs = assignment
+    order = lexsort((point_idxs, zone_idxs))
+    return point_idxs[order], zone_idxs[order]
+
+
+def _assign_tile_points_to_zones(zone_wkbs, zone_idxs, point_idxs, xs, ys):
+    # run in the worker processes
+    zone_geometries = []
+    for wkb in zone_wkbs:
+        geom = QgsGeometry()
+        geom.fromWkb(wkb)
+        zone_geometries.append(geom)
+    tile_point_idxs, tile_zone_idxs = assign_points_to_zones(
+        xs, ys, zone_geometries)
+    return point_idxs[tile_point_idxs], zone_idxs[tile_zone_idxs]
+
+
+def group_zones_by_code(codes):
+    """
+    Group zones by the code of their parent zone (e.g. the code of the
+    region containing each district), to aggregate values at a coarser
+    level without any further geometric operation
+
+    :param codes: numpy (masked) array with the parent code of each zone,
+                  masked or None for zones without parent
+    :returns: a tuple (group_idxs, group_codes), where group_idxs is a numpy
+              array with the index of the group of each zone (-1 for zones
+              without parent) and group_codes is the list of the distinct
+              codes, in order of first appearance
+    """
+    codes = ma.asarray(codes)
+    masked = ma.getmaskarray(codes).tolist()
+    group_by_code = OrderedDict()
+    group_idxs = full(len(codes), -1, dtype=int64)
+    for zone_idx, code in enumerate(codes.data.tolist()):
+        if masked[zone_idx] or code is None:
+            continue
+        group_idxs[zone_idx] = group_by_code.setdefault(
+            code, len(group_by_code))
+    return group_idxs, list(group_by_code)
+
+
+def roll_up_assignment(point_idxs, zone_idxs, group_idxs):
+    """
+    Derive the assignment of points to groups of zones (see
+    :func:`group_zones_by_code`) from the assignment of points to zones (see
+    :func:`assign_points_to_zones`). A point matching several zones of the
+    same group (e.g. lying on the border between them) is assigned to the
+    group only once
+
+    :param point_idxs: numpy array with the point index of each match
+    :param zone_idxs: numpy array with the zone index of each match
+    :param group_idxs: numpy array with the group index of each zone (-1 for
+                       zones that do not belong to any group)
+    :returns: a tuple (point_idxs, group_idxs) of numpy arrays, containing
+              the index of a point and the index of a group for each match,
+              sorted by group and point
+    """
+    match_group_idxs = group_idxs[zone_idxs]
+    valid = match_group_idxs >= 0
+    point_idxs = point_idxs[valid]
+    match_group_idxs = match_group_idxs[valid]
+    if not len(point_idxs):
+        return zeros(0, dtype=int64), zeros(0, dtype=int64)
+    n_points = int(point_idxs.max()) + 1
+    keys = unique(match_group_idxs * n_points + point_idxs)
+    return keys % n_points, keys // n_points
+
+
+def summarize_by_zone(zone_idxs, values, n_zones, summaries=('sum',)):
+    """
+    Calculate statistical summaries of the values of the points in each zone,
+    grouping them by zone with bincount or, for order statistics, sorting
+    them by zone and value. Missing values are ignored. Quartiles are the
+    medians of the lower and upper halves of the values (including the median
+    when their number is odd), as calculated by QgsStatisticalSummary
+
+    :param zone_idxs: numpy array with the zone index of each match of a
+                      point in a zone (see :func:`assign_points_to_zones`)
+    :param values: numpy (masked) array with the value of the point of each
+                   match, NaN or masked where missing
+    :param n_zones: total number of zones
+    :param summaries: names of the summaries to be calculated (see
+                      NATIVE_SUMMARIES)
+    :returns: an ordered dict summary -> numpy masked array with a value per
+              zone, masked for zones without points (or without values,
+              apart from count and sum)
+    """
+    for summary in summaries:
+        if summary not in NATIVE_SUMMARIES:
+            raise NotImplementedError(
+                'Summary "%s" is not implemented' % summary)
+    values = ma.filled(ma.asarray(values, dtype=float), float('nan'))
+    has_points = bincount(zone_idxs, minlength=n_zones) > 0
+    valid = ~isnan(values)
+    zone_idxs = zone_idxs[valid]
+    values = values[valid]
+    counts = bincount(zone_idxs, minlength=n_zones)
+    # zones without values get no statistics, apart from count and sum
+    no_values = counts == 0
+    with errstate(invalid='ignore', divide='ignore'):
+        sums = bincount(
+            zone_idxs, weights=values, minlength=n_zones).astype(float)
+        means = sums / counts
+        if 'stddev' in summaries:
+            deviations = bincount(
+                zone_idxs, weights=(values - means[zone_idxs]) ** 2,
+                minlength=n_zones)
+            stddevs = sqrt(deviations / counts)
+    order_stats = set(summaries) & set(
+        ('min', 'max', 'range', 'median', 'q1', 'q3', 'iqr'))
+    if order_stats:
+        order = lexsort((values, zone_idxs))
+        sorted_values = values[order]
+        starts = searchsorted(zone_idxs[order], arange(n_zones))
+        # indices of empty zones are clipped, their results are masked
+        last = len(sorted_values) - 1
+
+        def value_at(idxs):
+            if last < 0:
+                return zeros(n_zones)
+            return sorted_values[idxs.clip(0, last)]
+
+        def median(start, count):
+            return (value_at(start + (count - 1) // 2)
+                    + value_at(start + count // 2)) / 2
+        mins = value_at(starts)
+        maxs = value_at(starts + counts - 1)
+        half_counts = (counts + 1) // 2
+        q1s = median(starts, half_counts)
+        q3s = median(starts + counts // 2, half_counts)
+    results = OrderedDict()
+    for summary in summaries:
+        if summary == 'count':
+            results[summary] = ma.array(counts, mask=~has_points)
+            continue
+        elif summary == 'sum':
+            results[summary] = ma.array(sums, mask=~has_points)
+            continue
+        elif summary == 'mean':
+            result = means
+        elif summary == 'stddev':
+            result = stddevs
+        elif summary == 'min':
+            result = mins
+        elif summary == 'max':
+            result = maxs
+        elif summary == 'range':
+            result = maxs - mins
+        elif summary == 'median':
+            result = median(starts, counts)
+        elif summary == 'q1':
+            result = q1s
+        elif summary == 'q3':
+            result = q3s
+        elif summary == 'iqr':
+            result = q3s - q1s
+        results[summary] = ma.array(result, mask=no_values)
+    return results
+
+
+def coordinates_fingerprint(xs, ys):
+    """
+    Compute a hash of the coordinates of a set of points
+
+    :param xs: numpy (masked) array with the x coordinates of the points
+    :param ys: numpy (masked) array with the y coordinates of the points
+    :returns: a string containing the hexadecimal digest of the coordinates
+    """
+    digest = hashlib.sha1(ma.filled(xs, float('nan')).tobytes())
+    digest.update(ma.filled(ys, float('nan')).tobytes())
+    return digest.hexdigest()
+
+
+class ZoneAssignmentCache(object):
+    """
+    Least recently used cache of the assignments of points to zones (see
+    :func:`assign_points_to_zones`), keyed by (zonal layer id, modification
+    state of the zonal layer, crs of the points, fingerprint of the
+    coordinates of the points). Aggregating several layers of points located
+    on the same sites (e.g. realizations, statistics or loss types) against
+    the same zonal layer, the spatial join is performed only once.
+
+    The modification state of a watched zonal layer (see :meth:`watch`)
+    changes, and its entries are dropped, when its committed geometries or
+    features change. Entries can be read and stored from any thread.
+
+    :param max_entries: maximum number of assignments kept in memory
+    """
+    def __init__(self, max_entries=ZONE_ASSIGNMENT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def zonal_state(self, zonal_layer):
+        """
+        Get the modification state of a zonal layer, watching it if it was
+        not watched yet (it has to be called from the main thread)
+
+        :param zonal_layer: a QgsVectorLayer
+        :returns: a tuple (layer id, modification counter)
+        """
+        layer_id = zonal_layer.id()
+        if layer_id not in self._states:
+            self.watch(zonal_layer)
+        return layer_id, self._states[layer_id]
+
+    def get(self, zonal_state, points_crs, fingerprint):
+        """
+        Get an assignment of points to zones, if it is cached
+
+        :returns: a tuple (point_idxs, zone_idxs, n_zones), or None
+        """
+        key = (zonal_state, points_crs, fingerprint)
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, zonal_state, points_crs, fingerprint, assignment):
+        """
+        Store an assignment of points to zones, evicting the least recently
+        used one if the cache is full
+
+        :param assignment: a tuple (point_idxs, zone_idxs, n_zones)
+        """
+        if self.max_entries <= 0:
+            return
+        point_idxs, zone_idxs, n_zones = assignment
+        # cached arrays are shared by all the aggregations using them
+        point_idxs = point_idxs.copy()
+        zone_idxs = zone_idxs.copy()
+        point_idxs.flags.writeable = False
+        zone_idxs.flags.writeable = False
+        key = (zonal_state, points_crs, fingerprint)
+        with self._lock:
+            self._entries[key] = (point_idxs, zone_idxs, n_zones)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, layer_id=None):
+        """
+        Drop cached assignments
+
+        :param layer_id: if specified, only the assignments to the zones of
+                         the layer with this id are dropped
+        """
+        with self._lock:
+            for key in list(self._entries):
+                if layer_id is None or key[0][0] == layer_id:
+                    del self._entries[key]
+
+    def watch(self, layer):
+        """
+        Update the modification state of the zonal layer and drop its cached
+        assignments when its committed geometries or features change, or
+        the layer is deleted
+
+        :param layer: a QgsVectorLayer
+        """
+        layer_id = layer.id()
+        if layer_id in self._states:
+            return
+        self._states[layer_id] = 0
+
+        def on_committed_changes(*args):
+            self._states[layer_id] += 1
+            self.invalidate(layer_id)
+
+        def on_will_be_deleted():
+            self.invalidate(layer_id)
+            del self._states[layer_id]
+
+        layer.committedGeometriesChanges.connect(on_committed_changes)
+        layer.committedFeaturesAdded.connect(on_committed_changes)
+        layer.committedFeaturesRemoved.connect(on_committed_changes)
+        layer.willBeDeleted.connect(on_will_be_deleted)
+
+
+# cache shared by all the aggregations performed by the plugin
+ZONE_ASSIGNMENT_CACHE = ZoneAssignmentCache()
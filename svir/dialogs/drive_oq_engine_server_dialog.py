@@ -50,7 +50,6 @@ from qgis.PyQt.QtGui import QColor, QBrush, QRegExpValidator
 from qgis.gui import QgsMessageBar
 from qgis.core import QgsTask, QgsApplication
 
-from requests import Session
 from requests.exceptions import (ConnectionError,
                                  InvalidSchema,
                                  MissingSchema,
@@ -68,6 +67,8 @@ from svir.utilities.shared import (OQ_TO_LAYER_TYPES,
                                    OQ_ZIPPED_TYPES,
                                    OQ_CSV_TO_LAYER_TYPES,
                                    )
+from svir.utilities.engine_client import EngineSession, EXTRACT_PREFETCHER
+from svir.utilities.extract_cache import EXTRACT_CACHE
 from svir.utilities.utils import (WaitCursorManager,
                                   engine_login,
                                   log_msg,
@@ -278,7 +279,10 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
             log_msg(msg, level='W', message_bar=self.message_bar)
 
     def login(self):
-        self.session = Session()
+        if self.session is not None:
+            self.session.close()
+        # the session is shared with the threads of the loaders and tasks
+        self.session = EngineSession()
         if not self.forced_hostname:
             self.hostname, self.username, self.password = get_credentials()
         # try without authentication (if authentication is disabled server
@@ -359,6 +363,11 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         self.calc_list = json.loads(resp.text)
         if job_id != '':
             self.calc_list = [self.calc_list]
+        # extracts of calculations that were removed or run again are not
+        # valid anymore
+        EXTRACT_CACHE.update_calcs(self.hostname, self.calc_list)
+        EXTRACT_PREFETCHER.update_calcs(self.hostname, self.calc_list)
+        if job_id != '':
             self.current_calc_id = self.pointed_calc_id = int(job_id)
             self.update_output_list(int(job_id))
         selected_keys = [
@@ -521,6 +530,9 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
         self.clear_output_list()
         if calc_status['status'] not in ['complete', 'shared']:
             return
+        # download in background the extracts that the loaders and the viewer
+        # dock will need, while the user chooses what to load
+        EXTRACT_PREFETCHER.prefetch(self.session, self.hostname, calc_id)
         output_list = self.get_output_list(calc_id)
         if isinstance(output_list, Exception):
             # NOTE: the exception is managed by self._handle_exception
@@ -641,6 +653,8 @@ class DriveOqEngineServerDialog(QDialog, FORM_CLASS):
                 self._handle_exception(exc)
                 return exc
         if resp.ok:
+            EXTRACT_CACHE.invalidate(self.hostname, calc_id)
+            EXTRACT_PREFETCHER.clear(self.hostname, calc_id)
             verb = 'aborted' if abort else 'removed'
             msg = 'Calculation %s successfully %s' % (calc_id, verb)
             log_msg(msg, level='S', message_bar=self.message_bar)
@@ -222,6 +222,21 @@ class LoadDamagesAsLayerDialog(LoadOutputAsLayerDialog):
                     field_types[field_name] = 'F'
         return field_types
 
+    def get_zonal_join_fields(self, layer, default_field_name):
+        if (self.aggregate_by_site_ckb.isChecked()
+                or self.load_selected_only_ckb.isChecked()):
+            return super().get_zonal_join_fields(layer, default_field_name)
+        # the layer contains the fields of all the loss types and damage
+        # states (or consequences), that are all aggregated
+        if self.damage_or_consequences == 'Damage':
+            suffixes = self.dmg_states
+        else:  # 'Consequences'
+            suffixes = self.consequences
+        field_names = [field.name() for field in layer.fields()]
+        return ["%s-%s" % (loss_type, suffix)
+                for loss_type in self.loss_types for suffix in suffixes
+                if "%s-%s" % (loss_type, suffix) in field_names]
+
     def read_npz_into_layer(self, field_types, **kwargs):
         if self.aggregate_by_site_ckb.isChecked():
             self.layer = self.read_npz_into_layer_aggr_by_site(
@@ -169,14 +169,14 @@ class LoadDisaggRlzsAsLayerDialog(LoadOutputAsLayerDialog):
             field_types['custom_site_id'] = 'I'
         self.layer = QgsVectorLayer(
             "%s?crs=epsg:4326" % 'point', layer_name, "memory")
+        layer_field_types = {
+            field_name: field_type
+            for field_name, field_type in field_types.items()
+            if field_name not in ['lon', 'lat']}
+        added_field_names = self.add_fields_to_layer(layer_field_types)
         modified_field_types = copy.copy(field_types)
-        for field_name, field_type in field_types.items():
-            if field_name in ['lon', 'lat']:
-                continue
-            # log_msg('Adding field %s of type %s' % (field_name, field_type),
-            #         level='I', print_to_stdout=True)
-            added_field_name = self.add_field_to_layer(field_name, field_type)
-            # log_msg('\tDone adding field', level='I', print_to_stdout=True)
+        for field_name, field_type in layer_field_types.items():
+            added_field_name = added_field_names[field_name]
             if field_name != added_field_name:
                 # replace field_name with the actual added_field_name
                 del modified_field_types[field_name]
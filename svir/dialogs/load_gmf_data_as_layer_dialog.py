@@ -28,7 +28,7 @@ from qgis.PyQt.QtWidgets import QInputDialog, QDialog
 from qgis.core import (
     QgsFeature, QgsGeometry, QgsPointXY, edit, QgsTask, QgsApplication)
 from svir.dialogs.load_output_as_layer_dialog import LoadOutputAsLayerDialog
-from svir.calculations.calculate_utils import add_attribute
+from svir.calculations.calculate_utils import add_attributes
 from svir.utilities.utils import WaitCursorManager, log_msg, extract_npz
 from svir.tasks.extract_npz_task import ExtractNpzTask
 
@@ -273,11 +273,16 @@ class LoadGmfDataAsLayerDialog(LoadOutputAsLayerDialog):
                        for name in self.gmf_data.dtype.names}
         return field_types
 
-    def add_field_to_layer(self, field_name, field_type):
+    def add_fields_to_layer(self, field_types):
         # TODO: assuming all attributes are numeric (to be checked!)
-        field_name = "%s-%s" % (field_name, self.eid)
-        added_field_name = add_attribute(field_name, field_type, self.layer)
-        return added_field_name
+        field_names = {field_name: "%s-%s" % (field_name, self.eid)
+                       for field_name in field_types}
+        added_field_names = add_attributes(
+            {field_names[field_name]: field_type
+             for field_name, field_type in field_types.items()},
+            self.layer)
+        return {field_name: added_field_names[field_names[field_name]]
+                for field_name in field_types}
 
     def read_npz_into_layer(self, field_types, rlz_or_stat, **kwargs):
         with edit(self.layer):
@@ -67,10 +67,10 @@ from qgis.PyQt.QtWidgets import (
                                  QGroupBox,
                                  )
 from qgis.PyQt.QtGui import QColor
-from svir.calculations.calculate_utils import add_attribute
+from svir.calculations.calculate_utils import add_attributes
 from svir.calculations.process_layer import ProcessLayer
 from svir.calculations.aggregate_loss_by_zone import (
-    calculate_zonal_stats)
+    calculate_zonal_stats, calculate_multi_layer_zonal_stats)
 from svir.utilities.shared import (OQ_CSV_TO_LAYER_TYPES,
                                    OQ_TO_LAYER_TYPES,
                                    OQ_EXTRACT_TO_LAYER_TYPES,
@@ -118,6 +118,9 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         self.zonal_layer_path = zonal_layer_path
         self.engine_version = engine_version
         self.calculation_mode = calculation_mode
+        # (layer, default field name, user params) of each layer built while
+        # loading the output
+        self.loaded_layers = []
         QDialog.__init__(self)
         # Set up the user interface from Designer.
         self.setupUi(self)
@@ -342,12 +345,16 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         self.discard_nonmatching_chk = QCheckBox(
             'Discard zones with no points')
         self.discard_nonmatching_chk.setChecked(discard_nonmatching)
+        self.aggregate_all_chk = QCheckBox(
+            'Aggregate all the loaded layers into a single zonal layer')
+        self.aggregate_all_chk.setChecked(True)
         self.zonal_layer_h_layout = QHBoxLayout()
         self.zonal_layer_h_layout.addWidget(self.zonal_layer_cbx)
         self.zonal_layer_h_layout.addWidget(self.zonal_layer_tbn)
         self.zonal_layer_gbx_v_layout.addWidget(self.zonal_layer_lbl)
         self.zonal_layer_gbx_v_layout.addLayout(self.zonal_layer_h_layout)
         self.zonal_layer_gbx_v_layout.addWidget(self.discard_nonmatching_chk)
+        self.zonal_layer_gbx_v_layout.addWidget(self.aggregate_all_chk)
         self.vlayout.addWidget(self.zonal_layer_gbx)
         self.zonal_layer_tbn.clicked.connect(self.open_load_zonal_layer_dialog)
         self.zonal_layer_cbx.currentIndexChanged[int].connect(
@@ -463,11 +470,10 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
     def load_from_npz(self):
         raise NotImplementedError()
 
-    def add_field_to_layer(self, field_name, field_type):
-        # NOTE: add_attribute use the native qgis editing manager
-        added_field_name = add_attribute(
-            field_name, field_type, self.layer)
-        return added_field_name
+    def add_fields_to_layer(self, field_types):
+        # NOTE: all the fields are added at once, and the returned dict maps
+        # each field name to the name actually assigned to the field
+        return add_attributes(field_types, self.layer)
 
     def get_investigation_time(self):
         if self.output_type in ('hcurves', 'uhs', 'hmaps', 'ruptures'):
@@ -506,11 +512,14 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         # create layer
         self.layer = QgsVectorLayer(
             "%s?crs=epsg:4326" % geometry_type, layer_name, "memory")
+        layer_field_types = {
+            field_name: field_type
+            for field_name, field_type in field_types.items()
+            if field_name not in ['lon', 'lat', 'boundary']}
+        added_field_names = self.add_fields_to_layer(layer_field_types)
         modified_field_types = copy.copy(field_types)
-        for field_name, field_type in field_types.items():
-            if field_name in ['lon', 'lat', 'boundary']:
-                continue
-            added_field_name = self.add_field_to_layer(field_name, field_type)
+        for field_name, field_type in layer_field_types.items():
+            added_field_name = added_field_names[field_name]
             if field_name != added_field_name:
                 if field_name == self.default_field_name:
                     self.default_field_name = added_field_name
@@ -561,6 +570,9 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                        'imt': imt}
         write_metadata_to_layer(
             self.drive_engine_dlg, self.output_type, self.layer, user_params)
+        self.loaded_layers.append(
+            (self.layer, getattr(self, 'default_field_name', None),
+             user_params))
         # try:
         #     if (self.zonal_layer_cbx.currentText()
         #             and self.zonal_layer_gbx.isChecked()):
@@ -1016,6 +1028,7 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
             logger.debug(
                 "Handling currentLayerChanged signal: nothing to disconnect")
         self.hide()
+        self.loaded_layers = []
         if self.output_type in OQ_EXTRACT_TO_LAYER_TYPES:
             self.load_from_npz()
             if self.output_type in ('damages-rlzs',
@@ -1050,6 +1063,26 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
         if not have_same_projection:
             log_msg(check_projection_msg, level='W',
                     message_bar=self.iface.messageBar())
+        discard_nonmatching = self.discard_nonmatching_chk.isChecked()
+        inputs = self.get_zonal_inputs()
+        if (self.aggregate_all_chk.isChecked()
+                and sum(len(join_fields) for _, join_fields, _ in inputs) > 1):
+            # all the fields of all the loaded layers are aggregated into
+            # the same zonal layer
+            self.zonal_style_by = "%s%s_sum" % (inputs[0][2], inputs[0][1][0])
+            zonal_layer_plus_stats_name = "%s: %s" % (
+                zonal_layer.name(), self.output_type)
+            try:
+                calculate_multi_layer_zonal_stats(
+                    self.on_calculate_zonal_stats_completed,
+                    zonal_layer, inputs, zonal_layer_plus_stats_name,
+                    discard_nonmatching=discard_nonmatching,
+                    summaries=('sum',))
+            except Exception as exc:
+                log_msg(str(exc), level='C',
+                        message_bar=self.iface.messageBar(),
+                        exception=exc)
+            return
         loss_layer_fieldnames = [field.name() for field in loss_layer.fields()]
         if len(loss_layer_fieldnames) == 1:
             self.loss_attr_name = loss_layer_fieldnames[0]
@@ -1060,9 +1093,9 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                    f' aggregation was not found')
             log_msg(msg, level='C', message_bar=self.iface.messageBar())
             return
+        self.zonal_style_by = "%s_sum" % self.loss_attr_name
         zonal_layer_plus_sum_name = "%s: %s_sum" % (
             zonal_layer.name(), self.loss_attr_name)
-        discard_nonmatching = self.discard_nonmatching_chk.isChecked()
         try:
             calculate_zonal_stats(
                 self.on_calculate_zonal_stats_completed,
@@ -1075,6 +1108,50 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
                     message_bar=self.iface.messageBar(),
                     exception=exc)
 
+    def get_zonal_join_fields(self, layer, default_field_name):
+        """
+        Get the fields of a loaded layer to be aggregated by zone, when
+        aggregating all the loaded layers into a single zonal layer
+
+        :param layer: a layer built while loading the output
+        :param default_field_name: the default field name of the layer
+        :returns: a list of field names
+        """
+        field_names = [field.name() for field in layer.fields()]
+        if len(field_names) == 1:
+            return field_names
+        if default_field_name in field_names:
+            return [default_field_name]
+        return []
+
+    def get_zonal_inputs(self):
+        """
+        Get the fields of each loaded layer to be aggregated by zone, and the
+        prefix of the names of the corresponding zonal fields. The prefix
+        contains the parameters (e.g. realization, taxonomy, loss type) that
+        vary among the loaded layers, and it is empty if only one layer was
+        loaded
+
+        :returns: a list of tuples (layer, join_fields, prefix)
+        """
+        varying_params = []
+        if self.loaded_layers:
+            first_params = self.loaded_layers[0][2]
+            varying_params = [
+                param for param in first_params
+                if any(params.get(param) != first_params[param]
+                       for _, _, params in self.loaded_layers)]
+        inputs = []
+        for layer, default_field_name, params in self.loaded_layers:
+            join_fields = self.get_zonal_join_fields(
+                layer, default_field_name)
+            if not join_fields:
+                continue
+            prefix = ''.join(
+                '%s_' % params[param] for param in varying_params)
+            inputs.append((layer, join_fields, prefix))
+        return inputs
+
     def on_calculate_zonal_stats_completed(self, zonal_layer_plus_sum):
         if zonal_layer_plus_sum is None:
             msg = 'The calculation of zonal statistics was not completed'
@@ -1089,13 +1166,7 @@ class LoadOutputAsLayerDialog(QDialog, FORM_CLASS):
             msg = 'The layer aggregating data by zone is invalid.'
             log_msg(msg, level='C', message_bar=self.iface.messageBar())
             return None
-        # NOTE: in scenario damage, keys are like
-        #       u'structural_no_damage_mean', and not just
-        #       u'structural', therefore we can't just use the selected
-        #       loss type, but we must use the actual only key in the
-        #       dict
-        added_loss_attr = "%s_sum" % self.loss_attr_name
-        style_by = added_loss_attr
+        style_by = self.zonal_style_by
         try:
             perils = self.perils
         except AttributeError:
@@ -32,8 +32,9 @@ from qgis.core import (
     QgsGraduatedSymbolRenderer, QgsProject, Qgis, QgsApplication)
 from qgis.gui import QgsMessageBar
 
-from requests import Session
 from svir.dialogs.connection_profile_dialog import ConnectionProfileDialog
+from svir.utilities.engine_client import EngineSession
+from svir.utilities.extract_cache import EXTRACT_CACHE
 from svir.utilities.utils import (
                                   get_irmt_version,
                                   get_ui_class,
@@ -105,6 +106,21 @@ class SettingsDialog(QDialog, FORM_CLASS):
         self.log_level_cbx.setCurrentIndex(
             self.log_level_cbx.findData(log_level))
 
+        max_workers = (DEFAULT_SETTINGS['max_workers']
+                       if restore_defaults
+                       else mySettings.value(
+                           'irmt/max_workers',
+                           DEFAULT_SETTINGS['max_workers'], type=int))
+        self.max_workers_sbx.setValue(max_workers)
+
+        extract_cache_size_mb = (
+            DEFAULT_SETTINGS['extract_cache_size_mb']
+            if restore_defaults
+            else mySettings.value(
+                'irmt/extract_cache_size_mb',
+                DEFAULT_SETTINGS['extract_cache_size_mb'], type=int))
+        self.extract_cache_size_sbx.setValue(extract_cache_size_mb)
+
         style = get_style(
             self.iface.activeLayer(),
             self.iface.messageBar(),
@@ -156,6 +172,11 @@ class SettingsDialog(QDialog, FORM_CLASS):
         mySettings.setValue(
             'irmt/log_level',
             self.log_level_cbx.itemData(self.log_level_cbx.currentIndex()))
+        mySettings.setValue('irmt/max_workers', self.max_workers_sbx.value())
+        mySettings.setValue('irmt/extract_cache_size_mb',
+                            self.extract_cache_size_sbx.value())
+        # the cache is shrunk immediately if its maximum size was reduced
+        EXTRACT_CACHE.evict()
 
         cur_eng_profile = self.engine_profile_cbx.currentText()
 
@@ -204,7 +225,7 @@ class SettingsDialog(QDialog, FORM_CLASS):
         profiles = json.loads(mySettings.value(
             'irmt/engine_profiles', default_profiles))
         profile = profiles[profile_name]
-        session = Session()
+        session = EngineSession()
         hostname, username, password = (profile['hostname'],
                                         profile['username'],
                                         profile['password'])
@@ -28,9 +28,11 @@ from qgis.PyQt.QtWidgets import QDialog, QDialogButtonBox, QLabel, QHBoxLayout
 from svir.calculations.transformation_algs import (RANK_VARIANTS,
                                                    QUADRATIC_VARIANTS,
                                                    LOG10_VARIANTS,
-                                                   TRANSFORMATION_ALGS)
+                                                   TRANSFORMATION_ALGS,
+                                                   streaming_accumulator)
 from svir.utilities.utils import get_ui_class, log_msg
-from svir.utilities.shared import NUMERIC_FIELD_TYPES
+from svir.utilities.shared import (NUMERIC_FIELD_TYPES,
+                                   TRANSFORMATION_CHUNK_SIZE)
 from svir.calculations.process_layer import ProcessLayer
 from svir.ui.multi_select_combo_box import MultiSelectComboBox
 
@@ -50,6 +52,7 @@ class TransformationDialog(QDialog, FORM_CLASS):
         self.use_advanced = False
         # Set up the user interface from Designer.
         self.setupUi(self)
+        self.skip_undo_tooltip = self.skip_undo_ckb.toolTip()
         self.fields_lbl = QLabel('Fields to transform')
         self.fields_multiselect = MultiSelectComboBox(self)
         hlayout = QHBoxLayout()
@@ -66,6 +69,7 @@ class TransformationDialog(QDialog, FORM_CLASS):
             self.reload_variant_cbx()
         self.inverse_ckb.setDisabled(
             self.algorithm_cbx.currentText() in ['LOG10'])
+        self.update_skip_undo_ckb()
         self.warning_lbl.hide()
         self.warning_lbl.setText(
             "<font color='red'>"
@@ -120,10 +124,31 @@ class TransformationDialog(QDialog, FORM_CLASS):
     def on_algorithm_cbx_currentIndexChanged(self):
         self.reload_variant_cbx()
         self.update_default_fieldname()
+        self.update_skip_undo_ckb()
 
     @pyqtSlot(str)
     def on_variant_cbx_currentIndexChanged(self):
         self.update_default_fieldname()
+        self.update_skip_undo_ckb()
+
+    def update_skip_undo_ckb(self):
+        # big layers are transformed in chunks if the algorithm allows it,
+        # and chunks are always written directly to the data source
+        chunked = (
+            self.iface.activeLayer().featureCount()
+            > TRANSFORMATION_CHUNK_SIZE
+            and streaming_accumulator(self.algorithm_cbx.currentText(),
+                                      self.variant_cbx.currentText())
+            is not None)
+        if chunked:
+            self.skip_undo_ckb.setChecked(True)
+            self.skip_undo_ckb.setToolTip(
+                'The layer is too big to be transformed in memory: the'
+                ' values are transformed in chunks and written directly to'
+                ' the data source, so the changes can not be undone')
+        else:
+            self.skip_undo_ckb.setToolTip(self.skip_undo_tooltip)
+        self.skip_undo_ckb.setDisabled(chunked)
 
     @pyqtSlot()
     def on_new_field_name_txt_editingFinished(self):
@@ -61,6 +61,7 @@ from svir.utilities.utils import (get_ui_class,
                                   WaitCursorManager,
                                   )
 from svir.ui.multi_select_combo_box import MultiSelectComboBox
+from svir.calculations.process_layer import ProcessLayer
 
 from svir import IS_MATPLOTLIB_INSTALLED
 
@@ -1462,9 +1463,16 @@ class ViewerDock(QDockWidget, FORM_CLASS):
         if not selected_rlzs_or_stats or not self.current_selection:
             return
         self.current_abscissa = []
-        request = QgsFeatureRequest().setFlags(
-            QgsFeatureRequest.NoGeometry).setFilterFids(selected)
-        for feature in self.iface.activeLayer().getFeatures(request):
+        layer = self.iface.activeLayer()
+        layer_field_names = [
+            field.name() for field in layer.fields() if field.name() != 'fid']
+        # the selected curves are read all at once, as columns
+        feature_ids, table = ProcessLayer(layer).to_numpy(
+            layer_field_names, feature_ids=selected)
+        feature_ids = feature_ids.tolist()
+        columns = {field_name: table[field_name].tolist()
+                   for field_name in layer_field_names}
+        if feature_ids:
             if self.output_type == 'hcurves':
                 imt = self.imt_cbx.currentText()
                 imls = [field_name.split('_')[2]
@@ -1481,7 +1489,7 @@ class ViewerDock(QDockWidget, FORM_CLASS):
             elif self.output_type == 'uhs':
                 err_msg = ("The selected layer does not contain uniform"
                            " hazard spectra in the expected format.")
-                self.field_names = [field.name() for field in feature.fields()]
+                self.field_names = [field.name() for field in layer.fields()]
                 # reading from something like
                 # [u'rlz-000_PGA', u'rlz-000_SA(0.025)', ...]
                 # the first item can be PGA (but PGA can also be missing)
@@ -1507,21 +1515,16 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                     self.output_type_cbx.setCurrentIndex(-1)
                     return
                 self.current_abscissa = unique_periods
-                break
             else:
                 raise NotImplementedError(self.output_type)
 
-        for i, feature in enumerate(
-                self.iface.activeLayer().getFeatures(request)):
+        for i, feature_id in enumerate(feature_ids):
             if (self.was_imt_switched
                     or self.was_loss_type_switched
-                    or (feature.id() not in
+                    or (feature_id not in
                         self.current_selection[selected_rlzs_or_stats[0]])
                     or self.output_type == 'uhs'):
-                self.field_names = [
-                    field.name()
-                    for field in self.iface.activeLayer().fields()
-                    if field.name() != 'fid']
+                self.field_names = layer_field_names
                 ordinates = dict()
                 marker = dict()
                 line_style = dict()
@@ -1531,13 +1534,13 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                     if self.output_type == 'hcurves':
                         imt = self.imt_cbx.currentText()
                         ordinates[rlz_or_stat] = [
-                            feature[field_name]
+                            columns[field_name][i]
                             for field_name in self.field_names
                             if field_name.split('_')[0] == rlz_or_stat
                             and field_name.split('_')[1] == imt]
                     elif self.output_type == 'uhs':
                         ordinates[rlz_or_stat] = [
-                            feature[field_name]
+                            columns[field_name][i]
                             for field_name in self.field_names
                             if field_name.split('_')[0] == rlz_or_stat]
                     marker[rlz_or_stat] = self.markers[
@@ -1562,12 +1565,12 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                         # matching between a curve and the corresponding point
                         # in the map
                         color_name = self.color_names[
-                            (feature.id() + rlz_or_stat_idx)
+                            (feature_id + rlz_or_stat_idx)
                             % len(self.color_names)]
                         color = QColor(color_name)
                         color_hex[rlz_or_stat] = color.darker(120).name()
                         line_style[rlz_or_stat] = "-"  # solid
-                    self.current_selection[rlz_or_stat][feature.id()] = {
+                    self.current_selection[rlz_or_stat][feature_id] = {
                         'abscissa': self.current_abscissa,
                         'ordinates': ordinates[rlz_or_stat],
                         'color': color_hex[rlz_or_stat],
@@ -1874,15 +1877,13 @@ class ViewerDock(QDockWidget, FORM_CLASS):
                 headers = ['lon', 'lat']
                 headers.extend(field_names)
                 writer.writerow(headers)
-                for feature in self.iface.activeLayer().selectedFeatures():
-                    values = [feature[field_name]
-                              for field_name in field_names]
-                    lon = feature.geometry().asPoint().x()
-                    lat = feature.geometry().asPoint().y()
-                    row = [lon, lat]
-                    if values:
-                        row.extend(values)
-                    writer.writerow(row)
+                layer = self.iface.activeLayer()
+                _, table = ProcessLayer(layer).to_numpy(
+                    field_names, geometry='xy',
+                    feature_ids=layer.selectedFeatureIds())
+                columns = [table[name].tolist()
+                           for name in ['$x', '$y'] + field_names]
+                writer.writerows(zip(*columns))
             elif self.output_type in ('aggcurves', 'aggcurves-stats'):
                 if self.output_type == 'aggcurves':
                     rlzs = list(self.rlzs_multiselect.get_selected_items())
@@ -58,10 +58,12 @@ from svir.calculations.process_layer import ProcessLayer
 from svir.utilities.utils import (
                                   WaitCursorManager,
                                   clear_progress_message_bar,
+                                  create_progress_message_bar,
                                   log_msg,
                                   warn_missing_packages,
                                   )
-from svir.utilities.shared import DEBUG, OQ_XMARKER_TYPES
+from svir.utilities.shared import (
+    DEBUG, OQ_XMARKER_TYPES, TRANSFORMATION_CHUNK_SIZE)
 from svir.ui.tool_button_with_help_link import QToolButtonWithHelpLink
 from svir.processing_provider.provider import Provider
 
@@ -502,6 +504,14 @@ class Irmt(object):
         """
         SettingsDialog(self.iface, self).exec_()
 
+    def _progress_callback(self, progress):
+        # the returned function updates the progress bar while the main
+        # thread is busy writing values
+        def set_progress(percentage):
+            progress.setValue(percentage)
+            QApplication.processEvents()
+        return set_progress
+
     def transform_attributes(self):
         """
         A modal dialog is displayed to the user, enabling to transform one or
@@ -532,50 +542,95 @@ class Irmt(object):
             algorithm_name = dlg.algorithm_cbx.currentText()
             variant = dlg.variant_cbx.currentText()
             inverse = dlg.inverse_ckb.isChecked()
-            for input_attr_idx, input_attr_name in enumerate(input_attr_names):
-                target_attr_alias = input_attr_aliases[input_attr_idx]
+            skip_undo = dlg.skip_undo_ckb.isChecked()
+            # big layers are transformed in chunks, if the algorithm allows it
+            if layer.featureCount() > TRANSFORMATION_CHUNK_SIZE:
+                chunk_size = TRANSFORMATION_CHUNK_SIZE
+            else:
+                chunk_size = None
+            target_attr_names = []
+            for input_attr_name in input_attr_names:
                 if dlg.overwrite_ckb.isChecked():
-                    target_attr_name = input_attr_name
+                    target_attr_names.append(input_attr_name)
                 elif dlg.fields_multiselect.selected_count() == 1:
-                    target_attr_name = dlg.new_field_name_txt.text()
+                    target_attr_names.append(dlg.new_field_name_txt.text())
                 else:
                     # the limit of 10 chars for shapefiles is handled by
                     # ProcessLayer.add_attributes
-                    target_attr_name = '_' + input_attr_name
+                    target_attr_names.append('_' + input_attr_name)
+            if len(input_attr_names) > 1 and chunk_size is None:
+                # the attributes are transformed in parallel, one per worker
+                # process, then they are written to the layer
+                msg = "Applying '%s' transformation to %s fields" % (
+                    algorithm_name, len(input_attr_names))
+                msg_bar_item, progress = create_progress_message_bar(
+                    self.iface.messageBar(), msg)
                 try:
+                    with WaitCursorManager():
+                        results = ProcessLayer(layer).transform_attributes(
+                            input_attr_names, algorithm_name, variant,
+                            inverse, target_attr_names, input_attr_aliases,
+                            skip_undo=skip_undo,
+                            progress_callback=self._progress_callback(
+                                progress))
+                except (ValueError, NotImplementedError, TypeError) as e:
+                    results = [e] * len(input_attr_names)
+                finally:
+                    clear_progress_message_bar(
+                        self.iface.messageBar(), msg_bar_item)
+            else:
+                results = []
+                for input_attr_name, target_attr_name, target_attr_alias in \
+                        zip(input_attr_names, target_attr_names,
+                            input_attr_aliases):
                     msg = "Applying '%s' transformation to field '%s'" % (
                         algorithm_name, input_attr_name)
-                    with WaitCursorManager(msg, self.iface.messageBar()):
-                        res_attr_name, invalid_input_values = ProcessLayer(
-                            layer).transform_attribute(input_attr_name,
-                                                       algorithm_name,
-                                                       variant,
-                                                       inverse,
-                                                       target_attr_name,
-                                                       target_attr_alias)
-                    msg = ('Transformation %s has been applied to attribute %s'
-                           ' of layer %s.') % (algorithm_name,
-                                               input_attr_name,
-                                               layer.name())
-                    if target_attr_name == input_attr_name:
-                        msg += (' The original values of the attribute have'
-                                ' been overwritten by the transformed values.')
-                    else:
-                        msg += (' The results of the transformation'
-                                ' have been saved into the new'
-                                ' attribute %s (%s).') % (res_attr_name,
-                                                          target_attr_alias)
-                    if invalid_input_values:
-                        msg += (' The transformation could not'
-                                ' be performed for the following'
-                                ' input values: %s' % invalid_input_values)
-                    level = 'S' if not invalid_input_values else 'W'
-                    log_msg(msg, level=level,
-                            message_bar=self.iface.messageBar())
-                except (ValueError, NotImplementedError, TypeError) as e:
-                    log_msg(str(e), level='C',
+                    msg_bar_item, progress = create_progress_message_bar(
+                        self.iface.messageBar(), msg)
+                    try:
+                        with WaitCursorManager():
+                            results.append(ProcessLayer(
+                                layer).transform_attribute(
+                                    input_attr_name, algorithm_name, variant,
+                                    inverse, target_attr_name,
+                                    target_attr_alias,
+                                    chunk_size=chunk_size,
+                                    skip_undo=skip_undo,
+                                    progress_callback=self._progress_callback(
+                                        progress)))
+                    except (ValueError, NotImplementedError, TypeError) as e:
+                        results.append(e)
+                    finally:
+                        clear_progress_message_bar(
+                            self.iface.messageBar(), msg_bar_item)
+            for (input_attr_name, target_attr_name, target_attr_alias,
+                 result) in zip(input_attr_names, target_attr_names,
+                                input_attr_aliases, results):
+                if isinstance(result, Exception):
+                    log_msg(str(result), level='C',
                             message_bar=self.iface.messageBar(),
-                            exception=e)
+                            exception=result)
+                    continue
+                res_attr_name, invalid_input_values = result
+                msg = ('Transformation %s has been applied to attribute %s'
+                       ' of layer %s.') % (algorithm_name,
+                                           input_attr_name,
+                                           layer.name())
+                if target_attr_name == input_attr_name:
+                    msg += (' The original values of the attribute have'
+                            ' been overwritten by the transformed values.')
+                else:
+                    msg += (' The results of the transformation'
+                            ' have been saved into the new'
+                            ' attribute %s (%s).') % (res_attr_name,
+                                                      target_attr_alias)
+                if invalid_input_values:
+                    msg += (' The transformation could not'
+                            ' be performed for the following'
+                            ' input values: %s' % invalid_input_values)
+                level = 'S' if not invalid_input_values else 'W'
+                log_msg(msg, level=level,
+                        message_bar=self.iface.messageBar())
         elif dlg.use_advanced:
             layer = self.iface.activeLayer()
             if layer.isModified():
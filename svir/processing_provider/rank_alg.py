@@ -66,7 +66,10 @@ class RankAlgorithm(TransformFieldsAlgorithm):
             ('MIN', self.tr('Standard competition - Minimum (1224)')),
             ('MAX', self.tr('Modified competition - Maximum (1334)')),
             ('DENSE', self.tr('Dense (1223)')),
-            ('ORDINAL', self.tr('Ordinal (1234)')))
+            ('ORDINAL', self.tr('Ordinal (1234)')),
+            ('APPROXIMATE', self.tr(
+                'Approximate average, for very large layers'
+                ' (rank error within about 2% of the number of values)')))
         variant = QgsProcessingParameterEnum(
             self.VARIANT,
             self.tr('Tie strategy'),
@@ -26,17 +26,11 @@ import os
 from time import sleep
 from qgis.core import QgsTask
 from qgis.PyQt.QtCore import QThread, pyqtSignal, pyqtSlot
+from svir.utilities.engine_client import (
+    stream_to_file, DownloadFailed, TaskCanceled)
 from svir.utilities.utils import log_msg
 
 
-class TaskCanceled(Exception):
-    pass
-
-
-class DownloadFailed(Exception):
-    pass
-
-
 class DownloadOqOutputTask(QgsTask):
 
     is_canceled_sig = pyqtSignal()
@@ -153,21 +147,14 @@ class DownloadThread(QThread):
             'filename=')[1]
         filepath = os.path.join(self.dest_folder, filename)
         self.filepath_sig.emit(filepath)
-        tot_len = resp.headers.get('content-length')
-        with open(filepath, "wb") as f:
-            if tot_len is None:
-                f.write(resp.content)
-            else:
-                tot_len = int(tot_len)
-                dl = 0
-                chunk_size = max(tot_len//100, 100)  # avoid size 0
-                for data in resp.iter_content(chunk_size=chunk_size):
-                    if self.is_canceled:
-                        raise TaskCanceled
-                    dl += len(data)
-                    f.write(data)
-                    progress = dl / tot_len * 100
-                    self.progress_sig.emit(progress)
+        try:
+            stream_to_file(resp, filepath, self.progress_sig.emit,
+                           lambda: self.is_canceled)
+        except TaskCanceled:
+            # the task is notified by its own cancellation
+            return
+        finally:
+            resp.close()
 
     def set_canceled(self):
         self.is_canceled = True
@@ -22,28 +22,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
 
-import io
-import numpy
 import tempfile
-import json
 from time import sleep
 from qgis.core import QgsTask
 from qgis.PyQt.QtCore import QThread, pyqtSignal, pyqtSlot
-from numpy.lib.npyio import NpzFile
+from svir.utilities.engine_client import (
+    fetch_extract, TaskCanceled, EXTRACT_PREFETCHER)
 from svir.utilities.utils import log_msg
 
 
-class TaskCanceled(Exception):
-    pass
-
-
-class ExtractFailed(Exception):
-    pass
-
-
 class ExtractNpzTask(QgsTask):
-    # NOTE: there is also a synchronous extract_npz utility that contains some
-    # duplicated code
+    # NOTE: the synchronous extract_npz utility shares the same implementation
+    # (see svir.utilities.engine_client.fetch_extract)
 
     is_canceled_sig = pyqtSignal()
 
@@ -91,9 +81,10 @@ class ExtractNpzTask(QgsTask):
             self.is_canceled_sig.emit()
             raise TaskCanceled
         self.extract_thread = ExtractThread(
-            session, extract_url, extract_params, self.dest_folder)
+            session, self.hostname, self.calc_id, self.output_type,
+            extract_params, self.dest_folder)
         self.extract_thread.progress_sig[float].connect(self.set_progress)
-        self.extract_thread.extracted_npz_sig[dict].connect(
+        self.extract_thread.extracted_npz_sig[object].connect(
             self.set_extracted_npz)
         self.extract_thread.exception_sig[Exception].connect(
             self.on_exception)
@@ -104,6 +95,9 @@ class ExtractNpzTask(QgsTask):
             if self.extract_thread.isFinished():
                 return True
             if self.isCanceled():
+                # stop streaming the extract, so that fetch_extract removes
+                # the folder it was being unpacked into
+                self.extract_thread.set_canceled()
                 # NOTE: deleteLater would be a cleaner way, but it does not
                 # actually kill the get, so the machine remains busy until a
                 # response is produced
@@ -115,7 +109,7 @@ class ExtractNpzTask(QgsTask):
     def set_progress(self, progress):
         self.setProgress(progress)
 
-    @pyqtSlot(NpzFile)
+    @pyqtSlot(object)
     def set_extracted_npz(self, extracted_npz):
         self.extracted_npz = extracted_npz
 
@@ -127,84 +121,40 @@ class ExtractNpzTask(QgsTask):
 class ExtractThread(QThread):
 
     progress_sig = pyqtSignal(float)
-    extracted_npz_sig = pyqtSignal(dict)
+    extracted_npz_sig = pyqtSignal(object)
     exception_sig = pyqtSignal(Exception)
 
-    def __init__(self, session, url, params, dest_folder):
+    def __init__(self, session, hostname, calc_id, output_type, params,
+                 dest_folder):
         self.session = session
-        self.url = url
+        self.hostname = hostname
+        self.calc_id = calc_id
+        self.output_type = output_type
         self.params = params
         self.dest_folder = dest_folder
         self.is_canceled = False
         super().__init__()
 
     def run(self):
-        # FIXME: enable the user to set verify=True
-        # FIXME: stream = True breaks things unexpectedly in some cases
-        #        (content-length differs from len(resp.content)
-        resp = self.session.get(self.url, params=self.params, verify=False)
-        # , stream=True)
-        err_msg = "Unable to extract %s with parameters %s" % (
-            self.url, self.params)
-
-        if not resp.ok:
-            self.exception_sig.emit(ExtractFailed(
-                "%s (%s):\n%s" % (err_msg, resp.reason,
-                                  resp.content.decode('utf8'))))
-            return
-
-        # FIXME: use stream=True
-        # filename = resp.headers['content-disposition'].split(
-        #     'filename=')[1]
-        # filepath = os.path.join(self.dest_folder, filename)
-        # tot_len = resp.headers.get('content-length')
-        # with open(filepath, "wb") as f:
-        #     if tot_len is None:
-        #         f.write(resp.content)
-        #     else:
-        #         tot_len = int(tot_len)
-        #         dl = 0
-        #         chunk_size = max(tot_len // 10000, 10)  # avoid size 0
-        #         for data in resp.iter_content(chunk_size=chunk_size):
-        #             if self.is_canceled:
-        #                 raise TaskCanceled
-        #             dl += len(data)
-        #             f.write(data)
-        #             progress = dl / tot_len * 100
-        #             self.progress_sig.emit(progress)
-        # extracted_npz = numpy.load(filepath, allow_pickle=False)
-        if not resp.content:
-            self.exception_sig.emit(ExtractFailed(
-                "%s: returned an empty content" % err_msg))
+        extracted_npz = EXTRACT_PREFETCHER.get(
+            self.hostname, self.calc_id, self.output_type, self.params)
+        if extracted_npz is not None:
+            self.progress_sig.emit(100.0)
+            self.extracted_npz_sig.emit(extracted_npz)
             return
         try:
-            if numpy.__version__ >= '1.24.0':
-                extracted_npz = numpy.load(
-                    io.BytesIO(resp.content), allow_pickle=False,
-                    max_header_size=100000)
-            else:
-                extracted_npz = numpy.load(
-                    io.BytesIO(resp.content), allow_pickle=False)
+            # FIXME: enable the user to set verify=True
+            extracted_npz = fetch_extract(
+                self.session, self.hostname, self.calc_id, self.output_type,
+                params=self.params, dest_folder=self.dest_folder,
+                progress_callback=self.progress_sig.emit,
+                is_canceled=lambda: self.is_canceled, verify=False)
+        except TaskCanceled:
+            return
         except Exception as exc:
             self.exception_sig.emit(exc)
             return
-        if not isinstance(extracted_npz, NpzFile):
-            self.exception_sig.emit(
-                ExtractFailed("%s: not a valid NPZ. Response: (%s) %s" % (
-                    err_msg, resp.reason, resp.content)))
-            return
-
-        dic = {}
-        for k, v in extracted_npz.items():
-            if k == 'json':
-                dic.update(json.loads(bytes(v)))
-            else:
-                dic[k] = v
-
-        self.extracted_npz_sig.emit(dic)
-
-        # FIXME: use stream=True
-        # os.remove(filepath)
+        self.extracted_npz_sig.emit(extracted_npz)
 
     def set_canceled(self):
         self.is_canceled = True
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks of the transformation algorithms and of the ProcessLayer read and
+# write phases. They are not run together with the unit tests:
+#
+#     pytest svir/test/benchmark/
+#
+# The timings are collected into a JSON report (by default
+# irmt_benchmark.json in the current directory, or the path specified by the
+# environment variable IRMT_BENCHMARK_REPORT), that can be diffed between
+# versions. The sizes of the synthetic layers can be set through the
+# environment variable IRMT_BENCHMARK_SIZES (e.g. "1000,100000").
+
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import numpy
+import pytest
+from qgis.core import QgsApplication, Qgis
+
+
+# Update sys.path BEFORE any svir or processing imports
+standard_plugin_path = '/usr/share/qgis/python/plugins'
+if (os.path.exists(standard_plugin_path)
+        and standard_plugin_path not in sys.path):
+    sys.path.append(standard_plugin_path)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def qgis_app():
+    """Initialize QGIS."""
+    qgs = QgsApplication([], False)
+    if not os.path.exists(qgs.prefixPath()):
+        qgs.setPrefixPath('/usr', True)
+    qgs.initQgis()
+    yield qgs
+    qgs.exitQgis()
+
+
+@pytest.fixture(scope="session")
+def benchmark_report():
+    """
+    Collect the results of all the benchmarks and write them to the JSON
+    report at the end of the session
+    """
+    report = {
+        'metadata': {
+            'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'qgis': Qgis.QGIS_VERSION,
+            'platform': platform.platform(),
+        },
+        'benchmarks': [],
+    }
+    yield report
+    report_path = os.environ.get(
+        'IRMT_BENCHMARK_REPORT', 'irmt_benchmark.json')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+@pytest.fixture
+def measure(benchmark_report):
+    """
+    Time a function, calling it a number of rounds, and add the statistics
+    to the report. Usage::
+
+        result = measure(group, name, func, *args, rounds=3, setup=None,
+                         params=None)
+
+    where setup is an optional function called before each round (not
+    timed), and params is a dict of parameters describing the benchmark
+    """
+    def run(group, name, func, *args, rounds=3, setup=None, params=None):
+        timings = []
+        for _ in range(rounds):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = func(*args)
+            timings.append(time.perf_counter() - start)
+        benchmark_report['benchmarks'].append({
+            'group': group,
+            'name': name,
+            'params': params or {},
+            'rounds': rounds,
+            'min': min(timings),
+            'mean': sum(timings) / rounds,
+            'max': max(timings),
+        })
+        return result
+    return run
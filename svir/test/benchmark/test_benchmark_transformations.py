@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy
+import pytest
+from qgis.core import (
+    QgsVectorLayer, QgsFeature, QgsGeometry, QgsPointXY)
+
+from svir.calculations.process_layer import ProcessLayer
+from svir.calculations.transformation_algs import (
+    transform_array, TRANSFORMATION_ALGS, RANK_VARIANTS, QUADRATIC_VARIANTS,
+    LOG10_VARIANTS)
+from svir.calculations.transformation_cache import TRANSFORMATION_CACHE
+from svir.utilities.shared import TRANSFORMATION_CHUNK_SIZE
+from svir.utilities.utils import save_layer_as
+
+# the sizes can be set through the environment variable IRMT_BENCHMARK_SIZES
+BENCHMARK_SIZES = [
+    int(size) for size in os.environ.get(
+        'IRMT_BENCHMARK_SIZES', '1000,100000,1000000').split(',')]
+PROVIDERS = ('memory', 'ogr')
+VARIANTS = {
+    'RANK': RANK_VARIANTS,
+    'QUADRATIC': QUADRATIC_VARIANTS,
+    'LOG10': LOG10_VARIANTS,
+}
+# algorithms that do not implement the inverse function
+DIRECT_ONLY = ('LOG10',)
+
+
+def synthetic_values(n_features, null_ratio=0.1, seed=42):
+    """
+    Generate positive values with many ties (they are rounded to one
+    decimal) and some zeros, and a mask of valid values, False for about
+    null_ratio of the values
+    """
+    rng = numpy.random.RandomState(seed)
+    values = numpy.round(rng.lognormal(0, 1, n_features), 1)
+    values[rng.rand(n_features) < 0.05] = 0
+    valid_mask = rng.rand(n_features) >= null_ratio
+    return values, valid_mask
+
+
+def transformation_params():
+    params = []
+    for algorithm_name in TRANSFORMATION_ALGS:
+        for variant in VARIANTS.get(algorithm_name, ('',)):
+            for inverse in (False, True):
+                if inverse and algorithm_name in DIRECT_ONLY:
+                    continue
+                params.append((algorithm_name, variant, inverse))
+    return params
+
+
+@pytest.fixture(scope="session")
+def synthetic_layers(tmp_path_factory):
+    """
+    Factory of layers with a 'value' attribute containing synthetic values
+    (see synthetic_values), built once per session for each provider and
+    size
+    """
+    layers = {}
+
+    def get_layer(provider, n_features):
+        if (provider, n_features) in layers:
+            return layers[(provider, n_features)]
+        layer = QgsVectorLayer(
+            'Point?crs=epsg:4326&field=value:double',
+            'synthetic_%s' % n_features, 'memory')
+        values, valid_mask = synthetic_values(n_features)
+        fields = layer.fields()
+        feats = []
+        for i, (value, valid) in enumerate(zip(values.tolist(),
+                                               valid_mask.tolist())):
+            feat = QgsFeature(fields)
+            feat.setGeometry(QgsGeometry.fromPointXY(
+                QgsPointXY(i % 360 - 180, (i // 360) % 180 - 90)))
+            feat.setAttribute('value', value if valid else None)
+            feats.append(feat)
+        layer.dataProvider().addFeatures(feats)
+        if provider == 'ogr':
+            path = str(tmp_path_factory.mktemp('benchmark') / (
+                'synthetic_%s.gpkg' % n_features))
+            save_layer_as(layer, path, 'GPKG')
+            layer = QgsVectorLayer(path, 'synthetic_%s' % n_features, 'ogr')
+        layers[(provider, n_features)] = layer
+        return layer
+    return get_layer
+
+
+@pytest.mark.parametrize("n_features", BENCHMARK_SIZES)
+@pytest.mark.parametrize(
+    "algorithm_name, variant, inverse", transformation_params())
+def test_transformation_algorithm(
+        measure, n_features, algorithm_name, variant, inverse):
+    values, valid_mask = synthetic_values(n_features)
+    measure('transform_array', algorithm_name, transform_array,
+            values, valid_mask, algorithm_name, variant, inverse,
+            params=dict(n_features=n_features, variant=variant,
+                        inverse=inverse))
+
+
+@pytest.mark.parametrize("n_features", BENCHMARK_SIZES)
+@pytest.mark.parametrize("provider", PROVIDERS)
+def test_read_phase(measure, synthetic_layers, provider, n_features):
+    proc = ProcessLayer(synthetic_layers(provider, n_features))
+
+    def read_attribute():
+        return next(proc.read_attribute_in_chunks('value'))
+
+    feature_ids, _, _ = measure(
+        'read', 'read_attribute_in_chunks', read_attribute,
+        params=dict(provider=provider, n_features=n_features))
+    assert len(feature_ids) == n_features
+
+
+@pytest.mark.parametrize("n_features", BENCHMARK_SIZES)
+@pytest.mark.parametrize("provider", PROVIDERS)
+@pytest.mark.parametrize("skip_undo", [False, True])
+def test_write_phase(
+        measure, synthetic_layers, provider, n_features, skip_undo):
+    # writing through the edit buffer (and undo stack) one value at a time,
+    # or in batches through the data provider
+    proc = ProcessLayer(synthetic_layers(provider, n_features))
+    feature_ids, values, valid_mask = next(
+        proc.read_attribute_in_chunks('value'))
+    transformed_values, _ = transform_array(values, valid_mask, 'MIN_MAX')
+    attr_name, attr_id = proc._add_target_attribute(
+        'value', 'MIN_MAX', '', 'write_%s' % n_features, None)
+    measure('write', '_write_attribute_values', proc._write_attribute_values,
+            attr_id, feature_ids, transformed_values, skip_undo, rounds=1,
+            params=dict(provider=provider, n_features=n_features,
+                        skip_undo=skip_undo))
+    proc.delete_attributes([attr_name])
+
+
+@pytest.mark.parametrize("n_features", BENCHMARK_SIZES)
+@pytest.mark.parametrize("provider", PROVIDERS)
+@pytest.mark.parametrize("chunked", [False, True])
+def test_transform_attribute(
+        measure, synthetic_layers, provider, n_features, chunked):
+    layer = synthetic_layers(provider, n_features)
+    proc = ProcessLayer(layer)
+    chunk_size = TRANSFORMATION_CHUNK_SIZE // 10 if chunked else None
+    attr_name, _ = measure(
+        'transform_attribute', 'Z_SCORE', proc.transform_attribute,
+        'value', 'Z_SCORE', '', False, 'transformed', None, False,
+        chunk_size, rounds=1, setup=TRANSFORMATION_CACHE.invalidate,
+        params=dict(provider=provider, n_features=n_features,
+                    chunk_size=chunk_size))
+    proc.delete_attributes([attr_name])
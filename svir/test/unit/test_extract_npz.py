@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from svir.utilities import engine_client
+from svir.utilities.engine_client import (
+    EngineSession, ExtractFailed, ExtractPrefetcher, LazyNpz, fetch_extract,
+    stream_to_file, TaskCanceled)
+from svir.utilities.extract_cache import ExtractCache
+
+
+@pytest.fixture
+def npz_path(tmp_path):
+    """Fixture to provide the path of a npz file, as extracted by the
+    engine."""
+    path = str(tmp_path / 'extract.npz')
+    metadata = json.dumps({'investigation_time': 50, 'kind': ['mean']})
+    np.savez_compressed(
+        path, json=np.frombuffer(metadata.encode('utf8'), dtype=np.uint8),
+        array=np.array([(1, 2.5), (2, 3.5)],
+                       dtype=[('id', np.int64), ('value', np.float64)]),
+        **{'rlz-000': np.arange(10.), 'empty': np.zeros(0)})
+    return path
+
+
+def test_lazy_npz(npz_path):
+    """Test that the json member is parsed eagerly, and the other members are
+    loaded only when accessed, and can be released."""
+    with open(npz_path, 'rb') as f:
+        npz = LazyNpz(io.BytesIO(f.read()))
+    assert npz['investigation_time'] == 50
+    assert npz['kind'] == ['mean']
+    assert sorted(npz) == [
+        'array', 'empty', 'investigation_time', 'kind', 'rlz-000']
+    assert len(npz) == 5
+    assert 'json' not in npz
+    assert not npz.is_loaded('rlz-000')
+    rlz = npz['rlz-000']
+    assert rlz.tolist() == list(range(10))
+    assert npz.is_loaded('rlz-000')
+    assert npz['rlz-000'] is rlz
+    assert not npz.is_loaded('array')
+    npz.release('rlz-000')
+    assert not npz.is_loaded('rlz-000')
+    assert npz['rlz-000'] is not rlz
+    assert npz.get('missing') is None
+
+
+def test_lazy_npz_memory_mapped(npz_path, tmp_path):
+    """Test that members unpacked into a folder are memory-mapped
+    copy-on-write."""
+    npz = LazyNpz(npz_path, str(tmp_path))
+    assert isinstance(npz['rlz-000'], np.memmap)
+    assert npz['array']['value'].tolist() == [2.5, 3.5]
+    assert len(npz['empty']) == 0
+    npz['rlz-000'][0] = 42
+    npz.release('rlz-000')
+    assert npz['rlz-000'][0] == 0
+    npz.close()
+
+
+def test_lazy_npz_reopened_concurrently(tmp_path):
+    """Test that mappings of the same file can unpack the same members at
+    the same time, never reading partially unpacked files."""
+    npz_path = str(tmp_path / 'big.npz')
+    np.savez(npz_path, array=np.arange(10 ** 6, dtype=np.float64))
+    for trial in range(5):
+        cache_dir = tmp_path / str(trial)
+        cache_dir.mkdir()
+        npz = LazyNpz(npz_path, str(cache_dir))
+        mappings = [npz] + [npz.reopen() for _ in range(3)]
+        barrier = threading.Barrier(len(mappings), timeout=10)
+
+        def read(mapping):
+            barrier.wait()
+            return float(mapping['array'].sum())
+
+        with ThreadPoolExecutor(len(mappings)) as pool:
+            results = list(pool.map(read, mappings))
+        assert results == [(10 ** 6 - 1) * 10 ** 6 / 2] * len(mappings)
+        assert sorted(os.listdir(str(cache_dir))) == ['0.npy']
+        for mapping in mappings:
+            mapping.close()
+
+
+class FakeResponse(object):
+    def __init__(self, content, content_length=None):
+        self.raw = io.BytesIO(content)
+        self.headers = {}
+        if content_length is not None:
+            self.headers['content-length'] = str(content_length)
+
+    def iter_content(self, chunk_size):
+        while True:
+            data = self.raw.read(3)
+            if not data:
+                return
+            yield data
+
+
+def test_stream_to_file(tmp_path):
+    """Test that responses are written to disk chunk by chunk, reporting the
+    progress, and that downloads can be interrupted."""
+    filepath = str(tmp_path / 'body')
+    progress = []
+    stream_to_file(FakeResponse(b'0123456789', 10), filepath,
+                   progress.append)
+    with open(filepath, 'rb') as f:
+        assert f.read() == b'0123456789'
+    assert progress == [30, 60, 90, 100]
+    with pytest.raises(TaskCanceled):
+        stream_to_file(FakeResponse(b'0123456789'), filepath,
+                       is_canceled=lambda: True)
+
+
+def test_extract_cache(npz_path, tmp_path):
+    """Test that only the extracts of complete calculations are cached, that
+    entries are invalidated when calculations are run again or removed, and
+    that the least recently used entries are evicted."""
+    cache = ExtractCache(str(tmp_path / 'cache'), max_size=10 ** 6)
+    hostname = 'http://localhost:8800'
+    assert cache.put(hostname, 1, 'realizations', None, npz_path) is None
+    calc = {'id': 1, 'status': 'complete', 'description': 'calc',
+            'calculation_mode': 'event_based'}
+    cache.update_calcs(hostname, [calc, {'id': 2, 'status': 'executing'}])
+    path = cache.put(hostname, 1, 'realizations', {'b': 1, 'a': [2]},
+                     npz_path)
+    assert path is not None
+    assert cache.get(hostname, 1, 'realizations', {'a': [2], 'b': 1}) == path
+    assert cache.get(hostname, 1, 'realizations', {'a': [3], 'b': 1}) is None
+    assert cache.get(hostname + '/', 1, '/realizations/',
+                     {'a': [2], 'b': 1}) == path
+    assert LazyNpz(path)['investigation_time'] == 50
+    assert cache.put(hostname, 2, 'realizations', None, npz_path) is None
+    # listing the calculation again does not invalidate its extracts
+    cache.update_calcs(hostname, [dict(calc)])
+    assert cache.get(hostname, 1, 'realizations', {'a': [2], 'b': 1}) == path
+    # running the calculation again does
+    cache.update_calcs(hostname, [dict(calc, status='executing')])
+    assert cache.get(hostname, 1, 'realizations', {'a': [2], 'b': 1}) is None
+    cache.update_calcs(hostname, [calc])
+    for extract_path in ('events', 'sitecol'):
+        assert cache.put(hostname, 1, extract_path, None, npz_path)
+    cache.invalidate(hostname, 1)
+    assert cache.get(hostname, 1, 'events') is None
+    # least recently used entries are evicted
+    cache.update_calcs(hostname, [calc])
+    npz_size = os.path.getsize(npz_path)
+    cache.max_size = 2 * npz_size
+    for extract_path in ('events', 'sitecol'):
+        cache.put(hostname, 1, extract_path, None, npz_path)
+    events_path = cache.get(hostname, 1, 'events')
+    os.utime(events_path, (time.time() + 10, time.time() + 10))
+    cache.put(hostname, 1, 'realizations', None, npz_path)
+    assert cache.get(hostname, 1, 'sitecol') is None
+    assert cache.get(hostname, 1, 'events') is not None
+    assert cache.get(hostname, 1, 'realizations') is not None
+
+
+class FakeSession(object):
+    def __init__(self, content):
+        self.content = content
+        self.n_requests = 0
+
+    def get(self, url, params=None, verify=True, stream=False):
+        self.n_requests += 1
+        resp = FakeResponse(self.content)
+        resp.ok = True
+        resp.close = lambda: None
+        return resp
+
+
+def test_fetch_extract_removes_unused_folders(
+        npz_path, tmp_path, monkeypatch):
+    """Test that the folders of the extracts are removed when the extracts
+    are not used anymore, and that the members of a cached extract are
+    unpacked only once while it is used."""
+    cache = ExtractCache(str(tmp_path / 'cache'), max_size=10 ** 6)
+    hostname = 'http://localhost:8800'
+    cache.update_calcs(hostname, [{'id': 1, 'status': 'complete'}])
+    monkeypatch.setattr(engine_client, 'EXTRACT_CACHE', cache)
+    dest_folder = tmp_path / 'extracts'
+    dest_folder.mkdir()
+    with open(npz_path, 'rb') as f:
+        session = FakeSession(f.read())
+    downloaded = fetch_extract(
+        session, hostname, 1, 'realizations', dest_folder=str(dest_folder))
+    rlz = downloaded['rlz-000']
+    hit = fetch_extract(
+        session, hostname, 1, 'realizations', dest_folder=str(dest_folder))
+    assert session.n_requests == 1
+    assert hit.cache_dir == downloaded.cache_dir
+    assert hit['rlz-000'].tolist() == rlz.tolist()
+    hit.close()
+    downloaded.close()
+    del hit, downloaded
+    # the folder is used until the arrays are released
+    assert len(os.listdir(str(dest_folder))) == 1
+    values = rlz[2:5]
+    del rlz
+    assert values.tolist() == [2, 3, 4]
+    del values
+    assert os.listdir(str(dest_folder)) == []
+    # a new folder is created for the next hit
+    hit = fetch_extract(
+        session, hostname, 1, 'realizations', dest_folder=str(dest_folder))
+    assert hit['rlz-000'].tolist() == list(range(10))
+    assert session.n_requests == 1
+    del hit
+    assert os.listdir(str(dest_folder)) == []
+
+
+def test_engine_session_pools_sessions():
+    """Test that requests sent by different threads go through separate
+    sessions, that are reused, and share cookies and connections."""
+    engine_session = EngineSession(pool_maxsize=4)
+    first = engine_session._checkout()
+    second = engine_session._checkout()
+    assert first is not second
+    assert first.cookies is second.cookies is engine_session.cookies
+    assert first.get_adapter('http://localhost:8800') is engine_session.adapter
+    assert second.get_adapter('https://example.com') is engine_session.adapter
+    engine_session._checkin(second)
+    assert engine_session._checkout() is second
+    first.cookies.set('sessionid', 'abc')
+    assert second.cookies.get('sessionid') == 'abc'
+    engine_session.close()
+
+
+def test_extract_prefetcher(npz_path, tmp_path, monkeypatch):
+    """Test that the extracts of a calculation are downloaded concurrently,
+    that each caller gets its own copy, and that extracts are dropped when
+    calculations are removed or run again."""
+    barrier = threading.Barrier(2, timeout=10)
+    requested = []
+
+    def fake_fetch_extract(session, hostname, calc_id, output_type):
+        requested.append((calc_id, output_type))
+        # both downloads have to be in progress at the same time
+        barrier.wait()
+        if output_type == 'events':
+            raise ExtractFailed('not available')
+        return LazyNpz(npz_path, str(tmp_path))
+
+    monkeypatch.setattr(engine_client, 'fetch_extract', fake_fetch_extract)
+    prefetcher = ExtractPrefetcher(max_workers=2, max_calcs=1)
+    hostname = 'http://localhost:8800'
+    prefetcher.prefetch(None, hostname, 1, ('realizations', 'events'))
+    first = prefetcher.get(hostname, 1, 'realizations')
+    second = prefetcher.get(hostname + '/', 1, 'realizations')
+    assert first['investigation_time'] == 50
+    assert first is not second
+    assert first['rlz-000'] is not second['rlz-000']
+    assert prefetcher.get(hostname, 1, 'events') is None
+    assert prefetcher.get(hostname, 1, 'realizations', {'kind': 'mean'}) \
+        is None
+    assert prefetcher.get(hostname, 1, 'sitecol') is None
+    # extracts already prefetched are not requested again
+    prefetcher.prefetch(None, hostname, 1, ('realizations', 'events'))
+    assert len(requested) == 2
+    prefetcher.update_calcs(hostname, [{'id': 1, 'status': 'complete'}])
+    assert prefetcher.get(hostname, 1, 'realizations') is not None
+    prefetcher.update_calcs(hostname, [{'id': 1, 'status': 'executing'}])
+    assert prefetcher.get(hostname, 1, 'realizations') is None
+    barrier = threading.Barrier(1)
+    prefetcher.prefetch(None, hostname, 1, ('realizations',))
+    prefetcher.prefetch(None, hostname, 2, ('realizations',))
+    assert prefetcher.get(hostname, 1, 'realizations') is None
+    assert prefetcher.get(hostname, 2, 'realizations') is not None
+    prefetcher.clear(hostname, 2)
+    assert prefetcher.get(hostname, 2, 'realizations') is None
@@ -26,11 +26,20 @@ import os
 import shutil
 import time
 import gc
+import numpy as np
 import pytest
 
-from qgis.core import QgsVectorLayer
+from qgis.core import QgsVectorLayer, QgsGeometry, QgsFeature
 from svir.calculations.process_layer import ProcessLayer
-from svir.calculations.aggregate_loss_by_zone import calculate_zonal_stats
+from svir.calculations.aggregate_loss_by_zone import (
+    calculate_zonal_stats, calculate_multi_layer_zonal_stats,
+    calculate_rollup_zonal_stats)
+from svir.calculations import zonal_stats
+from svir.calculations.zonal_stats import (
+    assign_points_to_zones, assign_points_to_zones_in_parallel,
+    partition_zones_into_tiles, summarize_by_zone, coordinates_fingerprint,
+    group_zones_by_code, roll_up_assignment, ZoneAssignmentCache,
+    NATIVE_SUMMARIES)
 
 
 @pytest.fixture
@@ -44,8 +53,11 @@ def data_dir():
     )
 
 
-def test_sum_point_values_by_zone(qgis_app, data_dir, tmp_path):
-    """Test the aggregation of point values into zones."""
+@pytest.mark.parametrize("use_processing", [False, True])
+def test_sum_point_values_by_zone(qgis_app, data_dir, tmp_path,
+                                  use_processing):
+    """Test the aggregation of point values into zones, both with the native
+    task and with the processing algorithm."""
     loss_attr_names = ['PEOPLE', 'STRUCTURAL']
 
     # Define paths
@@ -83,7 +95,8 @@ def test_sum_point_values_by_zone(qgis_app, data_dir, tmp_path):
         'output',
         discard_nonmatching=False,
         predicates=('intersects',),
-        summaries=('sum',)
+        summaries=('sum',),
+        use_processing=use_processing
     )
 
     # Wait for the async process to finish
@@ -113,3 +126,253 @@ def test_sum_point_values_by_zone(qgis_app, data_dir, tmp_path):
     if 'output_layer' in state:
         del state['output_layer']
     gc.collect()
+
+
+def test_aggregate_several_layers_by_zone(qgis_app, data_dir):
+    """Test that the fields of several layers are aggregated into the same
+    zonal layer, with the same results of aggregating them one by one."""
+    points_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'loss_points.gpkg'), 'Loss points', 'ogr')
+    zonal_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'svi_zones.gpkg'), 'SVI zones', 'ogr')
+    expected_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'svi_zones_plus_loss_stats.gpkg'),
+        'Expected', 'ogr')
+    state = {'output_layer': None}
+
+    def on_finished(output_zonal_layer):
+        state['output_layer'] = output_zonal_layer
+        state['is_complete'] = True
+
+    calculate_multi_layer_zonal_stats(
+        on_finished, zonal_layer,
+        [(points_layer, ['PEOPLE', 'STRUCTURAL'], 'a_'),
+         (points_layer, ['STRUCTURAL'], 'b_')],
+        'output')
+    start_time = time.time()
+    while time.time() - start_time < 5 and 'is_complete' not in state:
+        qgis_app.processEvents()
+        time.sleep(0.01)
+    output_layer = state['output_layer']
+    assert output_layer is not None
+    _, actual = ProcessLayer(output_layer).to_numpy(
+        ['a_PEOPLE_sum', 'a_STRUCTURAL_sum', 'b_STRUCTURAL_sum'])
+    _, expected = ProcessLayer(expected_layer).to_numpy(
+        ['PEOPLE_sum', 'STRUCTURAL_sum'])
+    for actual_name, expected_name in [('a_PEOPLE_sum', 'PEOPLE_sum'),
+                                       ('a_STRUCTURAL_sum', 'STRUCTURAL_sum'),
+                                       ('b_STRUCTURAL_sum', 'STRUCTURAL_sum')]:
+        assert (actual[actual_name].mask.tolist()
+                == expected[expected_name].mask.tolist())
+        assert actual[actual_name].compressed() == pytest.approx(
+            expected[expected_name].compressed())
+    del points_layer, zonal_layer, expected_layer
+    state.clear()
+    gc.collect()
+
+
+def test_rollup_by_parent_code(qgis_app, data_dir):
+    """Test that the statistics of a coarser level, grouping the zones by
+    the code of their parent, are added to a separate output layer."""
+    points_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'loss_points.gpkg'), 'Loss points', 'ogr')
+    zonal_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'svi_zones.gpkg'), 'SVI zones', 'ogr')
+    expected_layer = QgsVectorLayer(
+        os.path.join(data_dir, 'svi_zones_plus_loss_stats.gpkg'),
+        'Expected', 'ogr')
+    state = {'output_layers': None}
+
+    def on_finished(output_layers):
+        state['output_layers'] = output_layers
+        state['is_complete'] = True
+
+    # each zone is the only child of the parent with the same name
+    calculate_rollup_zonal_stats(
+        on_finished, zonal_layer, [(points_layer, ['PEOPLE'], '')],
+        ['ZONE_NAME'], 'output')
+    start_time = time.time()
+    while time.time() - start_time < 5 and 'is_complete' not in state:
+        qgis_app.processEvents()
+        time.sleep(0.01)
+    zones_layer, parents_layer = state['output_layers']
+    assert parents_layer.name() == 'output by ZONE_NAME'
+    _, expected = ProcessLayer(expected_layer).to_numpy(
+        ['ZONE_NAME', 'PEOPLE_sum'])
+    for output_layer in (zones_layer, parents_layer):
+        _, actual = ProcessLayer(output_layer).to_numpy(
+            ['ZONE_NAME', 'PEOPLE_sum'])
+        assert actual['ZONE_NAME'].tolist() == expected['ZONE_NAME'].tolist()
+        assert (actual['PEOPLE_sum'].mask.tolist()
+                == expected['PEOPLE_sum'].mask.tolist())
+        assert actual['PEOPLE_sum'].compressed() == pytest.approx(
+            expected['PEOPLE_sum'].compressed())
+    del points_layer, zonal_layer, expected_layer
+    state.clear()
+    gc.collect()
+
+
+def test_roll_up_assignment():
+    """Test that points are assigned once to the parent of the zones they
+    intersect, and not to zones without parent."""
+    group_idxs, group_codes = group_zones_by_code(
+        np.ma.masked_values([10., 10., 20., -1.], -1.))
+    assert group_idxs.tolist() == [0, 0, 1, -1]
+    assert group_codes == [10., 20.]
+    # point 1 is on the border between zones 0 and 1, point 2 is on the
+    # border between zones 1 and 2, point 3 is in the zone without parent
+    point_idxs = np.array([0, 1, 1, 2, 2, 3])
+    zone_idxs = np.array([0, 0, 1, 1, 2, 3])
+    point_idxs, parent_idxs = roll_up_assignment(
+        point_idxs, zone_idxs, group_idxs)
+    assert list(zip(point_idxs.tolist(), parent_idxs.tolist())) == [
+        (0, 0), (1, 0), (2, 0), (2, 1)]
+
+
+def test_assign_points_to_zones(qgis_app):
+    """Test that points on the border between zones are assigned to both,
+    and that points outside the zones or without geometry are not."""
+    zones = [QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+             QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))'),
+             QgsGeometry.fromWkt('Polygon((5 5, 6 5, 6 6, 5 5))')]
+    xs = np.array([0.5, 1.0, 1.5, 3.0, np.nan, 0.9])
+    ys = np.array([0.5, 0.5, 0.5, 0.5, np.nan, 1.5])
+    point_idxs, zone_idxs = assign_points_to_zones(xs, ys, zones)
+    assert sorted(zip(point_idxs.tolist(), zone_idxs.tolist())) == [
+        (0, 0), (1, 0), (1, 1), (2, 1)]
+
+
+def test_partition_zones_into_tiles():
+    """Test that each zone with geometry belongs to exactly one tile."""
+    rng = np.random.default_rng(42)
+    mins = rng.random((100, 2)) * 100
+    bboxes = np.hstack([mins, mins + rng.random((100, 2))])
+    bboxes[7] = np.nan
+    tiles = partition_zones_into_tiles(bboxes, 8)
+    assert len(tiles) == 8
+    assert sorted(np.concatenate(tiles).tolist()) == [
+        idx for idx in range(100) if idx != 7]
+    assert max(len(tile) for tile in tiles) <= 13
+    assert partition_zones_into_tiles(np.full((3, 4), np.nan), 8) == []
+
+
+def test_assign_points_to_zones_in_parallel(qgis_app, monkeypatch):
+    """Test that joining tiles of zones in parallel gives the same matches
+    of the sequential join, counting only once the points on the edges
+    between tiles."""
+    monkeypatch.setattr(zonal_stats, 'MIN_PARALLEL_POINTS', 0)
+    zones = [QgsGeometry.fromWkt(
+        'Polygon((%s %s, %s %s, %s %s, %s %s, %s %s))' % (
+            i, j, i + 1, j, i + 1, j + 1, i, j + 1, i, j))
+        for i in range(6) for j in range(6)]
+    rng = np.random.default_rng(42)
+    xs = rng.random(1000) * 6
+    ys = rng.random(1000) * 6
+    # points on the edges and corners of the zones
+    xs[:12] = np.repeat(np.arange(6), 2)
+    ys[:12] = np.tile([3.0, 3.5], 6)
+    xs[12] = np.nan
+    expected = sorted(zip(*[idxs.tolist() for idxs in
+                            assign_points_to_zones(xs, ys, zones)]))
+    point_idxs, zone_idxs = assign_points_to_zones_in_parallel(
+        xs, ys, zones, max_workers=2)
+    assert sorted(zip(point_idxs.tolist(), zone_idxs.tolist())) == expected
+
+
+def test_assign_points_to_zones_without_workers(qgis_app, monkeypatch):
+    """Test that points are joined sequentially if the worker processes
+    fail."""
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+
+    class BrokenPool(object):
+        def submit(self, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool('no workers'))
+            return future
+
+        def shutdown(self, wait=True):
+            pass
+
+    monkeypatch.setattr(zonal_stats, 'MIN_PARALLEL_POINTS', 0)
+    monkeypatch.setattr(
+        zonal_stats, 'get_process_pool', lambda max_workers: BrokenPool())
+    monkeypatch.setattr(
+        zonal_stats, 'log_msg', lambda *args, **kwargs: None)
+    zones = [QgsGeometry.fromWkt('Polygon((0 0, 1 0, 1 1, 0 1, 0 0))'),
+             QgsGeometry.fromWkt('Polygon((1 0, 2 0, 2 1, 1 1, 1 0))')]
+    xs = np.array([0.5, 1.5, 3.0])
+    ys = np.array([0.5, 0.5, 0.5])
+    point_idxs, zone_idxs = assign_points_to_zones_in_parallel(
+        xs, ys, zones, max_workers=2)
+    assert point_idxs.tolist() == [0, 1]
+    assert zone_idxs.tolist() == [0, 1]
+
+
+def _tukey_stats(values):
+    # reference implementation of the order statistics, one zone at a time
+    values = sorted(values)
+    count = len(values)
+
+    def median(vals):
+        return (vals[(len(vals) - 1) // 2] + vals[len(vals) // 2]) / 2
+    lower = values[:(count + 1) // 2]
+    upper = values[count // 2:]
+    return {'median': median(values), 'q1': median(lower),
+            'q3': median(upper), 'iqr': median(upper) - median(lower),
+            'min': values[0], 'max': values[-1],
+            'range': values[-1] - values[0]}
+
+
+def test_summarize_by_zone():
+    rng = np.random.default_rng(42)
+    n_zones = 6
+    zone_idxs = rng.integers(0, 4, 500)
+    values = rng.normal(size=500)
+    values[rng.random(500) < 0.1] = np.nan
+    # zone 4 contains only missing values and zone 5 contains no points
+    zone_idxs[:5] = 4
+    values[:5] = np.nan
+    stats = summarize_by_zone(zone_idxs, values, n_zones, NATIVE_SUMMARIES)
+    assert list(stats) == list(NATIVE_SUMMARIES)
+    for zone_idx in range(4):
+        zone_values = values[(zone_idxs == zone_idx) & ~np.isnan(values)]
+        expected = _tukey_stats(zone_values.tolist())
+        expected.update(count=len(zone_values), sum=zone_values.sum(),
+                        mean=zone_values.mean(), stddev=zone_values.std())
+        for summary, expected_value in expected.items():
+            assert stats[summary][zone_idx] == pytest.approx(expected_value)
+    assert stats['count'][4] == 0 and stats['sum'][4] == 0
+    for summary in NATIVE_SUMMARIES:
+        assert stats[summary][5] is np.ma.masked
+        if summary not in ('count', 'sum'):
+            assert stats[summary][4] is np.ma.masked
+
+
+def test_zone_assignment_cache(qgis_app):
+    """Test that cached assignments are dropped when features are added to
+    the zonal layer, and that the least recently used one is evicted."""
+    zonal_layer = QgsVectorLayer('Polygon?crs=epsg:4326', 'zones', 'memory')
+    cache = ZoneAssignmentCache(max_entries=2)
+    state = cache.zonal_state(zonal_layer)
+    xs = np.array([0.5, 1.5])
+    ys = np.array([0.5, 0.5])
+    fingerprint = coordinates_fingerprint(xs, ys)
+    assignment = (np.array([0, 1]), np.array([0, 0]), 1)
+    cache.put(state, 'EPSG:4326', fingerprint, assignment)
+    point_idxs, zone_idxs, n_zones = cache.get(
+        state, 'EPSG:4326', fingerprint)
+    assert point_idxs.tolist() == [0, 1] and n_zones == 1
+    assert cache.get(state, 'EPSG:3857', fingerprint) is None
+    assert cache.get(state, 'EPSG:4326', coordinates_fingerprint(
+        xs + 1, ys)) is None
+    zonal_layer.startEditing()
+    zonal_layer.addFeature(QgsFeature(zonal_layer.fields()))
+    zonal_layer.commitChanges()
+    assert cache.zonal_state(zonal_layer) != state
+    assert len(cache) == 0
+    state = cache.zonal_state(zonal_layer)
+    for fingerprint in ('a', 'b', 'c'):
+        cache.put(state, 'EPSG:4326', fingerprint, assignment)
+    assert len(cache) == 2
+    assert cache.get(state, 'EPSG:4326', 'a') is None
@@ -24,13 +24,21 @@
 
 import os
 import gc
+import numpy as np
 import pytest
-from qgis.core import QgsVectorLayer, QgsField
+from qgis.core import (
+    QgsVectorLayer, QgsField, QgsFeature, QgsFeedback, QgsGeometry,
+    QgsWkbTypes)
 
+from svir.calculations.calculate_utils import add_attributes
+from svir.calculations.layer_diff import diff_layers
+from svir.calculations import process_layer
 from svir.calculations.process_layer import ProcessLayer
+from svir.calculations.transformation_algs import TransformationPipeline
 from svir.utilities.shared import (
     INT_FIELD_TYPE, INT_FIELD_TYPE_NAME,
-    STRING_FIELD_TYPE, STRING_FIELD_TYPE_NAME
+    STRING_FIELD_TYPE, STRING_FIELD_TYPE_NAME,
+    DOUBLE_FIELD_TYPE, DOUBLE_FIELD_TYPE_NAME,
 )
 
 
@@ -88,6 +96,21 @@ def memory_layer():
     return QgsVectorLayer(uri, 'TestLayer', 'memory')
 
 
+@pytest.fixture
+def values_layer(memory_layer):
+    """Memory layer with a numeric attribute, containing missing values."""
+    field = QgsField('value', DOUBLE_FIELD_TYPE)
+    field.setTypeName(DOUBLE_FIELD_TYPE_NAME)
+    ProcessLayer(memory_layer).add_attributes([field])
+    feats = []
+    for value in [3.5, None, 0, 12, -4, 3.5, None, 7.25, 1, 9]:
+        feat = QgsFeature(memory_layer.fields())
+        feat.setAttribute('value', value)
+        feats.append(feat)
+    memory_layer.dataProvider().addFeatures(feats)
+    return memory_layer
+
+
 # Projection Tests
 
 def test_same_projections(projection_layers):
@@ -125,6 +148,26 @@ def test_different_content(compare_layers, primary, secondary):
     assert res is False
 
 
+def test_diff_layers(values_layer):
+    """Test that the report lists the fields and features that differ,
+    ignoring differences below the tolerance."""
+    copy = ProcessLayer(values_layer).duplicate_in_memory()
+    report = diff_layers(values_layer, copy, chunk_size=4)
+    assert report.is_equal
+    assert report.hashes['value'][0] == report.hashes['value'][1]
+    copy_proc = ProcessLayer(copy)
+    feature_ids, table = copy_proc.to_numpy()
+    table['value'][0] += 1e-9
+    table['value'][3] += 1
+    table['value'][5] = np.ma.masked
+    copy_proc.from_numpy(table, feature_ids=feature_ids)
+    report = diff_layers(values_layer, copy, chunk_size=4)
+    assert not report.is_equal
+    assert list(report.differences) == ['value']
+    expected_ids = ProcessLayer(values_layer).to_numpy()[0][[3, 5]]
+    assert report.differing_feature_ids.tolist() == expected_ids.tolist()
+
+
 # Attribute Tests
 
 def test_find_attribute_id(memory_layer):
@@ -166,3 +209,252 @@ def test_add_attributes_duplicate_handling(memory_layer):
     # Triplicate names: expects 'first_2', 'second_2'
     res3 = proc.add_attributes(get_fields())
     assert res3 == {'first': 'first_2', 'second': 'second_2'}
+
+
+def test_add_attributes_in_bulk(memory_layer):
+    """Test that many fields are added at once, with laundered names and
+    aliases."""
+    field_types = {'poe-%s' % i: 'F' for i in range(500)}
+    field_types['first'] = 'S'
+    ProcessLayer(memory_layer).add_attributes(
+        [QgsField('first', STRING_FIELD_TYPE)])
+    added_names = add_attributes(field_types, memory_layer)
+    assert added_names['poe-0'] == 'poe-0'
+    assert added_names['first'] == 'first_1'
+    fields = memory_layer.fields()
+    assert len(fields) == 502
+    assert memory_layer.attributeAlias(fields.indexOf('first_1')) == 'first'
+
+
+# Transformation Tests
+
+@pytest.mark.parametrize("algorithm_name, variant", [
+    ("Z_SCORE", ""), ("MIN_MAX", ""), ("RANK", "APPROXIMATE")])
+@pytest.mark.parametrize("inverse", [False, True])
+def test_transform_attribute_in_chunks(
+        values_layer, algorithm_name, variant, inverse):
+    """Test that the two-pass chunked transformation matches the
+    in-memory one."""
+    proc = ProcessLayer(values_layer)
+    in_memory_attr, _ = proc.transform_attribute(
+        'value', algorithm_name, variant, inverse=inverse,
+        new_attr_name='in_memory')
+    chunked_attr, _ = proc.transform_attribute(
+        'value', algorithm_name, variant, inverse=inverse,
+        new_attr_name='chunked', chunk_size=3)
+    _, expected, expected_valid = next(
+        proc.read_attribute_in_chunks(in_memory_attr))
+    _, actual, actual_valid = next(
+        proc.read_attribute_in_chunks(chunked_attr))
+    assert actual_valid.tolist() == expected_valid.tolist()
+    assert expected_valid.sum() == 8
+    assert actual[actual_valid] == pytest.approx(expected[expected_valid])
+
+
+def test_transform_attribute_in_chunks_bounded(values_layer, monkeypatch):
+    """Test that the chunked transformation keeps in memory only one chunk
+    of values at a time, writing each chunk when it has been read
+    completely."""
+    proc = ProcessLayer(values_layer)
+    open_readers = []
+    chunk_sizes = []
+    writes = []
+    iter_numpy = proc.iter_numpy
+
+    def tracking_iter_numpy(*args, **kwargs):
+        open_readers.append(None)
+        try:
+            for feature_ids, table in iter_numpy(*args, **kwargs):
+                chunk_sizes.append(len(feature_ids))
+                yield feature_ids, table
+        finally:
+            open_readers.pop()
+
+    change_attribute_values = proc._change_attribute_values
+
+    def tracking_change_attribute_values(feature_ids, columns):
+        writes.append((len(open_readers), len(feature_ids)))
+        change_attribute_values(feature_ids, columns)
+
+    monkeypatch.setattr(proc, 'iter_numpy', tracking_iter_numpy)
+    monkeypatch.setattr(
+        proc, '_change_attribute_values', tracking_change_attribute_values)
+    proc.transform_attribute(
+        'value', 'MIN_MAX', new_attr_name='chunked', chunk_size=3)
+    assert max(chunk_sizes) == 3
+    assert writes == [(0, 3), (0, 3), (0, 3), (0, 1)]
+
+
+def test_read_attribute_in_chunks(values_layer):
+    chunks = list(
+        ProcessLayer(values_layer).read_attribute_in_chunks('value', 4))
+    assert [len(feature_ids) for feature_ids, _, _ in chunks] == [4, 4, 2]
+    assert [valid_mask.sum() for _, _, valid_mask in chunks] == [3, 3, 2]
+
+
+def test_transform_attributes(values_layer):
+    """Test that transforming several attributes at once matches
+    transforming them one at a time."""
+    proc = ProcessLayer(values_layer)
+    expected_attr, _ = proc.transform_attribute(
+        'value', 'RANK', 'AVERAGE', new_attr_name='single')
+    results = proc.transform_attributes(
+        ['value', 'value'], 'RANK', 'AVERAGE',
+        new_attr_names=['multi_1', 'multi_2'], max_workers=1)
+    _, expected, expected_valid = next(
+        proc.read_attribute_in_chunks(expected_attr))
+    for actual_attr, invalid_input_values in results:
+        assert invalid_input_values is None
+        _, actual, actual_valid = next(
+            proc.read_attribute_in_chunks(actual_attr))
+        assert actual_valid.tolist() == expected_valid.tolist()
+        assert actual[actual_valid] == pytest.approx(
+            expected[expected_valid])
+
+
+def test_apply_pipeline(values_layer):
+    """Test that a pipeline writes the same values as its steps applied
+    one at a time, adding only the final attribute."""
+    proc = ProcessLayer(values_layer)
+    rank_attr, _ = proc.transform_attribute(
+        'value', 'RANK', 'DENSE', new_attr_name='rank')
+    expected_attr, _ = proc.transform_attribute(
+        rank_attr, 'MIN_MAX', inverse=True, new_attr_name='expected')
+    n_fields = len(values_layer.fields())
+    pipeline = TransformationPipeline(
+        [('RANK', 'DENSE', False), ('MIN_MAX', '', True)])
+    actual_attr, invalid_input_values = proc.apply_pipeline(
+        'value', pipeline, new_attr_name='actual')
+    assert invalid_input_values is None
+    assert len(values_layer.fields()) == n_fields + 1
+    _, expected, expected_valid = next(
+        proc.read_attribute_in_chunks(expected_attr))
+    _, actual, actual_valid = next(
+        proc.read_attribute_in_chunks(actual_attr))
+    assert actual_valid.tolist() == expected_valid.tolist()
+    assert actual[actual_valid] == pytest.approx(expected[expected_valid])
+
+
+def test_transform_attribute_skipping_undo(values_layer):
+    """Test that batched writes through the data provider match the writes
+    through the edit buffer, reporting the progress."""
+    proc = ProcessLayer(values_layer)
+    expected_attr, _ = proc.transform_attribute(
+        'value', 'MIN_MAX', new_attr_name='edit_buffer')
+    progress = []
+    actual_attr, _ = proc.transform_attribute(
+        'value', 'MIN_MAX', new_attr_name='provider', skip_undo=True,
+        progress_callback=progress.append)
+    assert progress == [100]
+    _, expected, expected_valid = next(
+        proc.read_attribute_in_chunks(expected_attr))
+    _, actual, actual_valid = next(
+        proc.read_attribute_in_chunks(actual_attr))
+    assert actual_valid.tolist() == expected_valid.tolist()
+    assert actual[actual_valid] == pytest.approx(expected[expected_valid])
+
+
+def test_write_attribute_values_in_batches(values_layer):
+    proc = ProcessLayer(values_layer)
+    feature_ids, values, valid_mask = next(
+        proc.read_attribute_in_chunks('value'))
+    attr_name, attr_id = proc._add_target_attribute(
+        'value', 'COPY', '', 'copy', None)
+    progress = []
+    proc._write_attribute_values(
+        attr_id, feature_ids, np.ma.array(values, mask=~valid_mask),
+        skip_undo=True,
+        progress_callback=progress.append, batch_size=3)
+    assert progress == [30, 60, 90, 100]
+    _, copied, copied_valid = next(proc.read_attribute_in_chunks(attr_name))
+    assert copied_valid.tolist() == valid_mask.tolist()
+    assert copied[copied_valid].tolist() == values[valid_mask].tolist()
+
+
+def test_to_numpy_in_chunks(values_layer):
+    proc = ProcessLayer(values_layer)
+    feature_ids, table = proc.to_numpy(['value'], geometry='xy')
+    assert table.dtype.names == ('value', '$x', '$y')
+    assert table['value'].count() == 8
+    # features without geometry have masked coordinates
+    assert table['$x'].count() == 0
+    chunks = list(proc.iter_numpy(['value'], chunk_size=4))
+    assert [len(ids) for ids, _ in chunks] == [4, 4, 2]
+    assert np.concatenate(
+        [ids for ids, _ in chunks]).tolist() == feature_ids.tolist()
+    with pytest.raises(AttributeError):
+        proc.to_numpy(['value', 'missing'])
+
+
+def test_from_numpy_round_trip(values_layer):
+    """Test that features written from numpy arrays are read back
+    unchanged, both adding features and updating attributes."""
+    proc = ProcessLayer(values_layer)
+    _, table = proc.to_numpy(['value'])
+    table = np.ma.concatenate([table, table])
+    other_layer = QgsVectorLayer('Point?crs=epsg:4326', 'other', 'memory')
+    field = QgsField('value', DOUBLE_FIELD_TYPE)
+    field.setTypeName(DOUBLE_FIELD_TYPE_NAME)
+    other = ProcessLayer(other_layer)
+    other.add_attributes([field])
+    progress = []
+    new_ids = other.from_numpy(
+        table, batch_size=8, progress_callback=progress.append)
+    assert progress == [40, 80, 100]
+    assert len(new_ids) == other_layer.featureCount() == 20
+    _, actual = other.to_numpy(['value'])
+    assert actual['value'].mask.tolist() == table['value'].mask.tolist()
+    assert actual['value'].tolist() == table['value'].tolist()
+    table['value'] *= 2
+    other.from_numpy(table, feature_ids=new_ids)
+    _, actual = other.to_numpy(['value'], feature_ids=new_ids)
+    assert actual['value'].tolist() == table['value'].tolist()
+
+
+def test_duplicate_in_memory_subset(values_layer):
+    """Test copying a subset of the fields and of the features of a layer,
+    in batches, without geometries."""
+    proc = ProcessLayer(values_layer)
+    proc.add_attributes([QgsField('other', DOUBLE_FIELD_TYPE)])
+    feedback = QgsFeedback()
+    progress = []
+    feedback.progressChanged.connect(progress.append)
+    copy = proc.duplicate_in_memory(
+        field_names=['value'], copy_geometry=False,
+        filter_expression='"value" > 0', batch_size=2, feedback=feedback)
+    assert [field.name() for field in copy.fields()] == ['value']
+    assert copy.wkbType() == QgsWkbTypes.NoGeometry
+    _, table = ProcessLayer(copy).to_numpy()
+    assert sorted(table['value'].tolist()) == [1, 3.5, 3.5, 7.25, 9, 12]
+    assert progress[-1] == 100
+
+
+def test_duplicate_in_memory_canceled(values_layer):
+    feedback = QgsFeedback()
+    feedback.cancel()
+    assert ProcessLayer(values_layer).duplicate_in_memory(
+        feedback=feedback) is None
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_count_vertices(monkeypatch, max_workers):
+    # split even a small layer in chunks, when using several threads
+    monkeypatch.setattr(process_layer, 'MIN_PARALLEL_FEATURES', 1)
+    layer = QgsVectorLayer('MultiPolygon?crs=epsg:4326', 'zones', 'memory')
+    wkts = ['MultiPolygon(((0 0, 1 0, 1 1, 0 0)))',
+            'MultiPolygon(((0 0, 4 0, 4 4, 0 4, 0 0),'
+            ' (1 1, 2 1, 2 2, 1 1)), ((5 5, 6 5, 6 6, 5 5)))',
+            None]
+    feats = []
+    for wkt in wkts:
+        feat = QgsFeature()
+        if wkt is not None:
+            feat.setGeometry(QgsGeometry.fromWkt(wkt))
+        feats.append(feat)
+    layer.dataProvider().addFeatures(feats)
+    proc = ProcessLayer(layer)
+    assert proc.count_vertices(max_workers=max_workers) == 17
+    feature_ids, vertex_counts = proc.count_vertices(
+        per_feature=True, max_workers=max_workers)
+    assert len(feature_ids) == 3
+    assert sorted(vertex_counts.tolist()) == [0, 4, 13]
@@ -37,14 +37,24 @@ def logic(qgis_app):
     """
     from qgis.core import NULL
     from svir.calculations.transformation_algs import (
-        transform, TRANSFORMATION_ALGS
+        transform, transform_array, values_to_array, RunningStats,
+        QuantileSketch, TransformationPipeline, TRANSFORMATION_ALGS
     )
+    from svir.calculations.transformation_cache import (
+        TransformationCache, column_fingerprint)
 
     class LogicNamespace:
         def __init__(self):
             self.NULL = NULL
             self.transform = transform
+            self.transform_array = transform_array
+            self.values_to_array = values_to_array
+            self.RunningStats = RunningStats
+            self.QuantileSketch = QuantileSketch
+            self.TransformationPipeline = TransformationPipeline
             self.algs = TRANSFORMATION_ALGS
+            self.TransformationCache = TransformationCache
+            self.column_fingerprint = column_fingerprint
 
     return LogicNamespace()
 
@@ -84,6 +94,268 @@ def test_transform_with_missing_values(logic, null_value_type):
     assert transformed_dict == expected_dict
 
 
+# Columnar Transformation Tests
+
+def test_values_to_array(logic):
+    values, valid_mask = logic.values_to_array([7, None, 0.5, None])
+    assert values.dtype == np.float64
+    assert valid_mask.tolist() == [True, False, True, False]
+    assert values[[0, 2]].tolist() == [7, 0.5]
+
+
+@pytest.mark.parametrize("algorithm_name, variant", [
+    ("RANK", "AVERAGE"),
+    ("RANK", "ORDINAL"),
+    ("Z_SCORE", ""),
+    ("MIN_MAX", ""),
+    ("QUADRATIC", "DECREASING"),
+])
+@pytest.mark.parametrize("inverse", [False, True])
+def test_transform_array_matches_list_api(
+        logic, input_list, algorithm_name, variant, inverse):
+    values = np.array(input_list + [0.0], dtype=np.float64)
+    valid_mask = np.array([True] * len(input_list) + [False])
+    result, _ = logic.transform_array(
+        values, valid_mask, algorithm_name, variant, inverse)
+    expected, _ = logic.algs[algorithm_name](
+        input_list, variant_name=variant, inverse=inverse)
+    assert result.mask.tolist() == [False] * len(input_list) + [True]
+    assert result.compressed().tolist() == pytest.approx(expected)
+
+
+def test_transform_array_masks_invalid_outputs(logic):
+    values = np.array([100, 0, 10, 1000], dtype=np.float64)
+    valid_mask = np.array([True, True, False, True])
+    result, _ = logic.transform_array(
+        values, valid_mask, "LOG10", "IGNORE ZEROS")
+    assert result.mask.tolist() == [False, True, True, False]
+    assert result.compressed().tolist() == pytest.approx([2, 3])
+
+
+# Streaming Statistics Tests
+
+def test_running_stats_chunks_and_merge(logic):
+    values = np.random.default_rng(42).normal(10, 3, 1000)
+    chunked = logic.RunningStats()
+    for chunk in np.array_split(values, 7):
+        chunked.update(chunk)
+    chunked.update(values[:0])
+    merged = logic.RunningStats()
+    merged.update(values[:300])
+    partition = logic.RunningStats()
+    partition.update(values[300:])
+    merged.merge(partition)
+    for stats in (chunked, merged):
+        assert stats.count == 1000
+        assert stats.mean == pytest.approx(values.mean())
+        assert stats.std == pytest.approx(values.std())
+        assert stats.min == values.min()
+        assert stats.max == values.max()
+
+
+def test_running_stats_empty(logic):
+    stats = logic.RunningStats()
+    assert stats.count == 0
+    assert np.isnan(stats.std)
+
+
+@pytest.mark.parametrize("inverse", [False, True])
+def test_rank_approximate_small_input_is_exact(logic, input_list, inverse):
+    expected, _ = logic.transform(
+        dict(enumerate(input_list)), logic.algs['RANK'], 'AVERAGE', inverse)
+    actual, _ = logic.transform(
+        dict(enumerate(input_list)), logic.algs['RANK'], 'APPROXIMATE',
+        inverse)
+    assert list(actual.values()) == list(expected.values())
+
+
+def test_quantile_sketch_error_bound(logic):
+    rng = np.random.RandomState(7)
+    values = np.round(rng.lognormal(0, 1, 100000), 2)
+    exact, _ = logic.transform_array(
+        values, np.ones(values.size, dtype=bool), 'RANK', 'AVERAGE')
+    # sketches of separate partitions, updated one chunk at a time
+    partitions = [logic.QuantileSketch() for _ in range(3)]
+    for i, chunk in enumerate(np.array_split(values, 30)):
+        partitions[i % 3].update(chunk)
+    sketch = partitions[0]
+    for partition in partitions[1:]:
+        sketch.merge(partition)
+    assert sketch.count == values.size
+    assert sum(level.size for level in sketch.levels) < 1000
+    max_error = np.abs(sketch.rank(values) - exact.data).max()
+    assert max_error <= 3.3 / sketch.k * values.size
+
+
+# Transformation Pipeline Tests
+
+def test_pipeline_matches_separate_steps(logic):
+    values, valid_mask = logic.values_to_array([1, None, 10, 0, 100, 50])
+    pipeline = logic.TransformationPipeline([
+        ('LOG10', 'INCREMENT BY ONE IF ZEROS ARE FOUND', False),
+        ('MIN_MAX', '', True)])
+    actual, invalid = pipeline.transform_array(values, valid_mask)
+    expected, _ = logic.transform_array(
+        values, valid_mask, 'LOG10', 'INCREMENT BY ONE IF ZEROS ARE FOUND')
+    expected, _ = logic.transform_array(
+        expected.filled(0), ~np.ma.getmaskarray(expected), 'MIN_MAX',
+        inverse=True)
+    assert invalid is None
+    assert np.ma.getmaskarray(actual).tolist() == \
+        np.ma.getmaskarray(expected).tolist()
+    assert actual.compressed() == pytest.approx(expected.compressed())
+
+
+def test_pipeline_reports_original_invalid_inputs(logic):
+    values, valid_mask = logic.values_to_array([-5, 1, 10, 100])
+    pipeline = logic.TransformationPipeline().add_step(
+        'LOG10', 'IGNORE ZEROS').add_step('MIN_MAX')
+    transformed, invalid = pipeline.transform_array(values, valid_mask)
+    assert invalid == [-5]
+    assert transformed.tolist() == [None, 0, 0.5, 1]
+
+
+def test_log10_increment_reports_original_negative_inputs(logic):
+    values, valid_mask = logic.values_to_array([-5, 0, 9, 99])
+    result, invalid = logic.transform_array(
+        values, valid_mask, 'LOG10', 'INCREMENT BY ONE IF ZEROS ARE FOUND')
+    assert invalid == [-5]
+    assert result.mask.tolist() == [True, False, False, False]
+    assert result.compressed().tolist() == pytest.approx([0, 1, 2])
+    pipeline = logic.TransformationPipeline().add_step(
+        'LOG10', 'INCREMENT BY ONE IF ZEROS ARE FOUND').add_step('MIN_MAX')
+    transformed, invalid = pipeline.transform_array(values, valid_mask)
+    assert invalid == [-5]
+    assert transformed.tolist() == [None, 0, 0.5, 1]
+
+
+def test_pipeline_unknown_algorithm(logic):
+    with pytest.raises(NotImplementedError):
+        logic.TransformationPipeline().add_step('NOT_AN_ALGORITHM')
+
+
+def test_transform_arrays_without_workers(logic, monkeypatch):
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    from svir.calculations import parallel
+
+    class BrokenPool(object):
+        def submit(self, *args):
+            future = Future()
+            future.set_exception(BrokenProcessPool('no workers'))
+            return future
+
+        def shutdown(self):
+            pass
+
+    monkeypatch.setattr(parallel, 'MIN_PARALLEL_VALUES', 0)
+    monkeypatch.setattr(parallel, 'get_process_pool', lambda n: BrokenPool())
+    monkeypatch.setattr(parallel, 'log_msg', lambda *args, **kwargs: None)
+    arrays = [logic.values_to_array([1, None, 3]),
+              logic.values_to_array([-1, 9])]
+    results = parallel.transform_arrays(
+        arrays, 'LOG10', 'IGNORE ZEROS', max_workers=2)
+    assert results[0][0].tolist() == [0, None, pytest.approx(np.log10(3))]
+    assert results[1][1] == [-1]
+
+
+# Transformation Cache Tests
+
+def test_column_fingerprint(logic):
+    values, valid_mask = logic.values_to_array([1, None, 3])
+    fingerprint = logic.column_fingerprint(values, valid_mask)
+    # placeholders of missing values do not affect the fingerprint
+    values[1] = 42
+    assert logic.column_fingerprint(values, valid_mask) == fingerprint
+    values, valid_mask = logic.values_to_array([1, 2, 3])
+    assert logic.column_fingerprint(values, valid_mask) != fingerprint
+
+
+def test_transformation_cache(logic):
+    cache = logic.TransformationCache(max_entries=2)
+    values, valid_mask = logic.values_to_array([1, None, 3])
+    result = logic.transform_array(values, valid_mask, 'MIN_MAX')
+    key = ('layer', 'attr', 'MIN_MAX', '', False)
+    assert cache.get(*key, 'fingerprint') is None
+    cache.put(*key, 'fingerprint', result)
+    cached_values, invalid_input_values = cache.get(*key, 'fingerprint')
+    assert cached_values.tolist() == [0, None, 1]
+    assert invalid_input_values is None
+    # the least recently used entry is evicted
+    cache.put('layer', 'other', 'MIN_MAX', '', False, 'fingerprint', result)
+    cache.get(*key, 'fingerprint')
+    cache.put('layer', 'attr', 'MIN_MAX', '', True, 'fingerprint', result)
+    assert len(cache) == 2
+    assert cache.get(
+        'layer', 'other', 'MIN_MAX', '', False, 'fingerprint') is None
+    assert cache.get(*key, 'fingerprint') is not None
+    cache.invalidate('layer', {'attr'})
+    assert len(cache) == 0
+
+
+def test_transformation_cache_watch(logic):
+    class FakeField(object):
+        def __init__(self, name):
+            self._name = name
+
+        def name(self):
+            return self._name
+
+    class FakeFields(list):
+        def at(self, idx):
+            return self[idx]
+
+        def count(self):
+            return len(self)
+
+        def indexOf(self, name):
+            names = [field.name() for field in self]
+            return names.index(name) if name in names else -1
+
+    class FakeSignal(object):
+        def __init__(self):
+            self.slots = []
+
+        def connect(self, slot):
+            self.slots.append(slot)
+
+        def emit(self, *args):
+            for slot in self.slots:
+                slot(*args)
+
+    class FakeLayer(object):
+        def __init__(self):
+            self._fields = FakeFields([FakeField('attr'),
+                                       FakeField('other')])
+            self.n_fields_calls = 0
+            for signal in ('attributeValueChanged', 'updatedFields',
+                           'committedAttributeValuesChanges',
+                           'committedFeaturesAdded',
+                           'committedFeaturesRemoved', 'willBeDeleted'):
+                setattr(self, signal, FakeSignal())
+
+        def id(self):
+            return 'layer'
+
+        def fields(self):
+            self.n_fields_calls += 1
+            return self._fields
+
+    cache = logic.TransformationCache()
+    layer = FakeLayer()
+    cache.watch(layer)
+    values, valid_mask = logic.values_to_array([1, None, 3])
+    result = logic.transform_array(values, valid_mask, 'MIN_MAX')
+    cache.put('layer', 'attr', 'MIN_MAX', '', False, 'fingerprint', result)
+    # changing other attributes looks up the fields only once
+    for feat_id in range(100):
+        layer.attributeValueChanged.emit(feat_id, 1, 0.5)
+    assert layer.n_fields_calls == 1
+    assert len(cache) == 1
+    layer.attributeValueChanged.emit(0, 0, 0.5)
+    assert len(cache) == 0
+
+
 # Rank Transformation Tests
 
 @pytest.mark.parametrize("variant, inverse, expected", [
@@ -105,6 +377,25 @@ def test_rank_variants(logic, input_list, variant, inverse, expected):
     assert result == expected
 
 
+@pytest.mark.parametrize("variant, expected", [
+    ("AVERAGE", [1.5, 4.5, 4.5, 3, 1.5, 6]),
+    ("MIN", [1, 4, 4, 3, 1, 6]),
+    ("MAX", [2, 5, 5, 3, 2, 6]),
+    ("DENSE", [1, 3, 3, 2, 1, 4]),
+    ("ORDINAL", [1, 4, 5, 3, 2, 6]),
+])
+def test_rank_floats_and_negatives(logic, variant, expected):
+    alg = logic.algs["RANK"]
+    result, _ = alg([-1.5, 3, 3, 0, -1.5, 7], variant_name=variant)
+    assert result == expected
+
+
+def test_rank_unknown_variant(logic, input_list):
+    alg = logic.algs["RANK"]
+    with pytest.raises(NotImplementedError):
+        alg(input_list, variant_name="FOO")
+
+
 # Min-Max Transformation Tests
 
 def test_min_max_direct(logic, input_list):
@@ -153,9 +444,18 @@ def test_log10_negative_values(logic):
     with warnings.catch_warnings():
         msg = "invalid value encountered in log10"
         warnings.filterwarnings('ignore', message=msg)
-        result, _ = alg(input_vals)
-    assert pytest.approx(result[0], abs=1e-6) == 5.005390
-    assert np.isnan(result[1])
+        result, invalid = alg(input_vals)
+        result_dict, invalid_dict = logic.transform(
+            dict(enumerate(input_vals)), alg, 'IGNORE ZEROS')
+    # the list and the dict APIs agree
+    for output_values, invalid_values in ((result, invalid),
+                                          (list(result_dict.values()),
+                                           invalid_dict)):
+        assert pytest.approx(output_values[0], abs=1e-6) == 5.005390
+        assert np.isnan(output_values[1])
+        # the invalid inputs are reported as they were given
+        assert invalid_values == [-94062]
+        assert type(invalid_values[0]) is int
 
 
 @pytest.mark.parametrize("variant, expect_null", [
@@ -203,3 +503,19 @@ def test_sigmoid_inverse_with_null(logic):
     result, invalid = alg([0.5, 1.0], inverse=True)
     assert invalid == [1.0]
     assert result[1] == logic.NULL
+
+
+def test_sigmoid_inverse_out_of_domain(logic):
+    alg = logic.algs["SIGMOID"]
+    result, invalid = alg([0.5, 0, -1, 2], inverse=True)
+    assert result[0] == 0
+    assert result[1:] == [logic.NULL] * 3
+    assert invalid == [0, -1, 2]
+
+
+def test_sigmoid_direct_overflow(logic):
+    alg = logic.algs["SIGMOID"]
+    result, invalid = alg([-1000, 1000])
+    assert result[0] == logic.NULL
+    assert result[1] == 1.0
+    assert invalid == [-1000]
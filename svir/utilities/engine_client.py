@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from requests import Session
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+from svir.utilities.extract_cache import (
+    EXTRACT_CACHE, CACHEABLE_CALC_STATUSES)
+
+# size of the chunks in which responses are written to disk and npz members
+# are unpacked
+CHUNK_SIZE = 1024 * 1024
+
+# maximum number of connections to the same host kept alive, for reuse, by
+# an EngineSession
+POOL_MAXSIZE = 16
+
+# extracts needed by most loaders and by the viewer dock, that are downloaded
+# in advance when a completed calculation is selected
+PREFETCHED_EXTRACTS = ('oqparam', 'realizations', 'events',
+                       'composite_risk_model.attrs', 'exposure_metadata',
+                       'sitecol')
+
+# maximum number of calculations whose prefetched extracts are kept
+PREFETCHED_CALCS = 4
+
+# folders containing the unpacked members of the files in the
+# EXTRACT_CACHE, by (path, inode, size) of the cached file, as long as they
+# are used
+_EXTRACT_DIRS = weakref.WeakValueDictionary()
+_EXTRACT_DIRS_LOCK = threading.Lock()
+
+
+class TaskCanceled(Exception):
+    pass
+
+
+class ExtractFailed(Exception):
+    pass
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+class EngineSession(object):
+    """
+    Thread-safe HTTP session with the OpenQuake Engine server, that can be
+    shared by the GUI thread and by the threads of the tasks, exposing the
+    methods of a requests.Session that are used by the plugin. As a
+    requests.Session is not thread-safe, each request is sent through a
+    session checked out of a pool of idle sessions (a new one is created if
+    none is idle), that is returned to the pool as soon as the response
+    headers are received (the body of a streamed response is read through
+    its connection). All the sessions share the same cookie jar, so a login
+    through any of them authenticates all of them, and the same adapter,
+    whose thread-safe pools keep alive up to pool_maxsize connections per
+    host, reused by all the threads.
+
+    :param pool_maxsize: the maximum number of connections per host kept
+                         alive
+    :param max_retries: the maximum number of retries of failed connections
+    """
+    def __init__(self, pool_maxsize=POOL_MAXSIZE, max_retries=0):
+        self.cookies = RequestsCookieJar()
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_maxsize, pool_maxsize=pool_maxsize,
+            max_retries=max_retries)
+        self._idle_sessions = []
+        self._lock = threading.Lock()
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle_sessions:
+                return self._idle_sessions.pop()
+        session = Session()
+        session.cookies = self.cookies
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        return session
+
+    def _checkin(self, session):
+        with self._lock:
+            self._idle_sessions.append(session)
+
+    def request(self, method, url, **kwargs):
+        session = self._checkout()
+        try:
+            return session.request(method, url, **kwargs)
+        finally:
+            self._checkin(session)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('POST', url, data=data, json=json, **kwargs)
+
+    def close(self):
+        """
+        Close all the connections kept alive
+        """
+        self.adapter.close()
+
+
+def stream_to_file(resp, filepath, progress_callback=None, is_canceled=None):
+    """
+    Write the body of a streamed response to a file, chunk by chunk, so the
+    whole body is never held in memory
+
+    :param resp: a response obtained with stream=True
+    :param filepath: path of the file to be written
+    :param progress_callback: an (optional) function accepting the percentage
+        of the body downloaded so far (only if the content-length is known)
+    :param is_canceled: an (optional) function returning True if the
+        download has to be interrupted
+    :raises TaskCanceled: if the download is interrupted
+    """
+    tot_len = resp.headers.get('content-length')
+    tot_len = int(tot_len) if tot_len else None
+    with open(filepath, 'wb') as f:
+        for data in resp.iter_content(chunk_size=CHUNK_SIZE):
+            if is_canceled is not None and is_canceled():
+                raise TaskCanceled
+            f.write(data)
+            if progress_callback is not None and tot_len:
+                # the content-length is the size of the body as it is
+                # transferred (possibly gzipped), that can differ from the
+                # size of the decoded chunks
+                progress_callback(min(100 * resp.raw.tell() / tot_len, 100))
+
+
+def fetch_extract(session, hostname, calc_id, output_type, params=None,
+                  dest_folder=None, progress_callback=None, is_canceled=None,
+                  verify=True):
+    """
+    Extract an output of a calculation from the OpenQuake Engine server, or
+    read it from the EXTRACT_CACHE. The response is streamed to disk,
+    stored in the cache, and its members are loaded lazily (see
+    :class:`LazyNpz`), unpacked into the same folder and memory-mapped. The
+    folder is removed as soon as the LazyNpz and its arrays are not used
+    anymore (see :class:`ExtractDir`)
+
+    :param session: a session with the server (see :class:`EngineSession`)
+    :param hostname: the url of the server
+    :param calc_id: the id of the calculation
+    :param output_type: the path of the extract (e.g. 'realizations')
+    :param params: the (optional) parameters of the extract
+    :param dest_folder: the folder where a folder is created, containing the
+        npz file and its unpacked members (by default, the temporary folder)
+    :param progress_callback: an (optional) function accepting the
+        percentage of the response downloaded so far
+    :param is_canceled: an (optional) function returning True if the
+        download has to be interrupted
+    :param verify: whether to verify the certificate of the server
+    :returns: a :class:`LazyNpz`
+    :raises ExtractFailed: if the server returns an error or an invalid npz
+    :raises TaskCanceled: if the download is interrupted
+    """
+    url = '%s/v1/calc/%s/extract/%s' % (hostname, calc_id, output_type)
+    cached_path = EXTRACT_CACHE.get(hostname, calc_id, output_type, params)
+    if cached_path is not None:
+        try:
+            extracted_npz = _open_cached_npz(cached_path, dest_folder)
+        except (OSError, zipfile.BadZipFile):
+            # e.g. the file was evicted in the meantime
+            pass
+        else:
+            if progress_callback is not None:
+                progress_callback(100)
+            return extracted_npz
+    extract_dir = ExtractDir(dest_folder)
+    try:
+        extracted_npz = _download_npz(
+            session, url, params, extract_dir, progress_callback,
+            is_canceled, verify)
+    except BaseException:
+        extract_dir.remove()
+        raise
+    cached_path = EXTRACT_CACHE.put(
+        hostname, calc_id, output_type, params,
+        os.path.join(extract_dir.path, 'extract.npz'))
+    if cached_path is not None:
+        # the members unpacked so far are reused by the next hits
+        try:
+            with _EXTRACT_DIRS_LOCK:
+                _EXTRACT_DIRS[_file_key(cached_path)] = extract_dir
+        except OSError:
+            pass
+    return extracted_npz
+
+
+def _file_key(path):
+    # the same path can be used by another file, after the cached file is
+    # evicted, or invalidated and cached again
+    stat = os.stat(path)
+    return path, stat.st_ino, stat.st_size
+
+
+def _open_cached_npz(cached_path, dest_folder):
+    # the members of the same cached file are unpacked into the same folder,
+    # as long as it is used
+    with _EXTRACT_DIRS_LOCK:
+        key = _file_key(cached_path)
+        extract_dir = _EXTRACT_DIRS.get(key)
+        if extract_dir is None:
+            extract_dir = ExtractDir(dest_folder)
+            _EXTRACT_DIRS[key] = extract_dir
+    return LazyNpz(cached_path, extract_dir.path, owner=extract_dir)
+
+
+def _download_npz(session, url, params, extract_dir, progress_callback,
+                  is_canceled, verify):
+    err_msg = "Unable to extract %s with parameters %s" % (url, params)
+    resp = session.get(url, params=params, verify=verify, stream=True)
+    try:
+        if not resp.ok:
+            raise ExtractFailed("%s (%s):\n%s" % (
+                err_msg, resp.reason, resp.content.decode('utf8')))
+        npz_path = os.path.join(extract_dir.path, 'extract.npz')
+        stream_to_file(resp, npz_path, progress_callback, is_canceled)
+    finally:
+        resp.close()
+    if not os.path.getsize(npz_path):
+        raise ExtractFailed("%s: returned an empty content" % err_msg)
+    try:
+        return LazyNpz(npz_path, extract_dir.path, owner=extract_dir)
+    except zipfile.BadZipFile:
+        with open(npz_path, 'rb') as f:
+            content = f.read(1000)
+        raise ExtractFailed("%s: not a valid NPZ. Response: (%s) %s" % (
+            err_msg, resp.reason, content))
+
+
+class ExtractPrefetcher(object):
+    """
+    Download in advance, with a pool of background threads, the extracts
+    needed to open the loaders and the viewer dock (see PREFETCHED_EXTRACTS)
+    of the last selected calculations, so they are available without any
+    network wait when they are requested (see :meth:`get`). Extracts that
+    fail to be prefetched (e.g. because they are not available for the
+    calculation mode) are requested again when they are needed, so the
+    error can be reported.
+
+    :param max_workers: the number of extracts downloaded concurrently
+    :param max_calcs: the maximum number of calculations whose extracts are
+                      kept
+    """
+    def __init__(self, max_workers=len(PREFETCHED_EXTRACTS),
+                 max_calcs=PREFETCHED_CALCS):
+        self.max_workers = max_workers
+        self.max_calcs = max_calcs
+        self._executor = None
+        # (hostname, calc_id) -> {output_type: future}
+        self._calcs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefetch(self, session, hostname, calc_id,
+                 output_types=PREFETCHED_EXTRACTS):
+        """
+        Start downloading the extracts of a (completed) calculation that were
+        not prefetched yet
+
+        :param session: a session with the server (see
+                        :class:`EngineSession`)
+        """
+        key = (hostname.rstrip('/'), calc_id)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            futures = self._calcs.setdefault(key, {})
+            self._calcs.move_to_end(key)
+            for output_type in output_types:
+                if output_type not in futures:
+                    futures[output_type] = self._executor.submit(
+                        fetch_extract, session, hostname, calc_id,
+                        output_type)
+            while len(self._calcs) > self.max_calcs:
+                _, evicted = self._calcs.popitem(last=False)
+                for future in evicted.values():
+                    future.cancel()
+
+    def get(self, hostname, calc_id, output_type, params=None):
+        """
+        Get a prefetched extract, waiting for it if it is still being
+        downloaded
+
+        :returns: a :class:`LazyNpz`, not shared with other callers, or None
+                  if the extract was not prefetched or could not be
+                  downloaded
+        """
+        if params:
+            return None
+        with self._lock:
+            future = self._calcs.get(
+                (hostname.rstrip('/'), calc_id), {}).get(output_type)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result().reopen()
+        except Exception:
+            return None
+
+    def clear(self, hostname, calc_id):
+        """
+        Drop the extracts prefetched for a calculation (e.g. because it was
+        removed)
+        """
+        with self._lock:
+            futures = self._calcs.pop((hostname.rstrip('/'), calc_id), {})
+        for future in futures.values():
+            future.cancel()
+
+    def update_calcs(self, hostname, calc_list):
+        """
+        Drop the extracts prefetched for the calculations that are not
+        complete anymore (e.g. because they are run again)
+
+        :param calc_list: a list of dicts describing the calculations, as
+            returned by the server
+        """
+        for calc in calc_list:
+            if ('id' in calc
+                    and calc.get('status') not in CACHEABLE_CALC_STATUSES):
+                self.clear(hostname, calc['id'])
+
+
+# prefetcher shared by the engine dialog, the loaders and the viewer dock
+EXTRACT_PREFETCHER = ExtractPrefetcher()
+
+
+class ExtractDir(object):
+    """
+    Temporary folder containing an extracted npz file and its unpacked
+    members. It is removed when the object is garbage-collected (i.e. when
+    the LazyNpz objects and the memory-mapped arrays referencing it are not
+    used anymore), or when python exits
+
+    :param dest_folder: the folder where the folder is created (by default,
+        the temporary folder)
+    """
+    def __init__(self, dest_folder=None):
+        self.path = tempfile.mkdtemp(prefix='irmt_extract_', dir=dest_folder)
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.path, ignore_errors=True)
+
+    def remove(self):
+        """
+        Remove the folder immediately
+        """
+        self._finalizer()
+
+
+def load_npy(file, mmap_mode=None):
+    if numpy.__version__ >= '1.24.0':
+        return numpy.load(file, mmap_mode=mmap_mode, allow_pickle=False,
+                          max_header_size=100000)
+    return numpy.load(file, mmap_mode=mmap_mode, allow_pickle=False)
+
+
+class LazyNpz(Mapping):
+    """
+    Read-only mapping giving access to the members of a npz file extracted
+    from the OpenQuake Engine, loading each of them only when it is accessed
+    for the first time. The items of the 'json' member are parsed eagerly and
+    are accessed as the other members. Loaded members are cached, and they
+    can be released with :meth:`release`. Members can be loaded from any
+    thread.
+
+    If cache_dir is specified, members are decompressed into uncompressed
+    .npy files in that folder, and opened as memory-mapped arrays
+    (copy-on-write, so they can be modified in memory without changing the
+    files), so only the parts of the arrays that are actually read are
+    loaded into memory.
+
+    :param file: the path of the npz file, or a file-like object
+    :param cache_dir: the (optional) folder where members are unpacked
+    :param owner: an (optional) object kept alive as long as this mapping
+        or any of its memory-mapped arrays is used (e.g. the
+        :class:`ExtractDir` of cache_dir)
+    :raises zipfile.BadZipFile: if the file is not a valid npz
+    """
+    def __init__(self, file, cache_dir=None, owner=None):
+        self._zip = zipfile.ZipFile(file)
+        self.file = file
+        self.cache_dir = cache_dir
+        self._owner = owner
+        self._lock = threading.Lock()
+        self._members = OrderedDict()
+        self._arrays = {}
+        self.metadata = {}
+        for member in self._zip.namelist():
+            key = member[:-4] if member.endswith('.npy') else member
+            if key == 'json':
+                self.metadata = json.loads(bytes(load_npy(
+                    io.BytesIO(self._zip.read(member)))))
+            else:
+                self._members[key] = member
+
+    def __getitem__(self, key):
+        if key not in self._members:
+            return self.metadata[key]
+        with self._lock:
+            try:
+                return self._arrays[key]
+            except KeyError:
+                pass
+            member = self._members[key]
+            if self.cache_dir is None:
+                array = load_npy(io.BytesIO(self._zip.read(member)))
+            else:
+                array = load_npy(self._unpack(key), mmap_mode='c')
+                if isinstance(array, numpy.memmap):
+                    # views of the array keep a reference to it
+                    array._owner = self._owner
+            self._arrays[key] = array
+            return array
+
+    def __iter__(self):
+        for key in self.metadata:
+            if key not in self._members:
+                yield key
+        yield from self._members
+
+    def __len__(self):
+        return len(self._members) + sum(
+            1 for key in self.metadata if key not in self._members)
+
+    def __contains__(self, key):
+        return key in self._members or key in self.metadata
+
+    def _npy_path(self, key):
+        # member names are not necessarily valid file names
+        return os.path.join(self.cache_dir, '%s.npy' % list(
+            self._members).index(key))
+
+    def _unpack(self, key):
+        npy_path = self._npy_path(key)
+        if not os.path.isfile(npy_path):
+            # other mappings of the same file (see :meth:`reopen`) can unpack
+            # the same member at the same time: the member is unpacked next
+            # to its destination, then renamed, so it is never read while it
+            # is partially written
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+            try:
+                with self._zip.open(self._members[key]) as src, os.fdopen(
+                        fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.replace(tmp_path, npy_path)
+            except OSError:
+                os.remove(tmp_path)
+                # e.g. on Windows, a file that was unpacked in the meantime
+                # and is already memory-mapped can not be replaced
+                if not os.path.isfile(npy_path):
+                    raise
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return npy_path
+
+    def reopen(self):
+        """
+        Open the same npz file again, so the arrays loaded from the new
+        mapping are not shared with the ones loaded from this one (members
+        that were already unpacked are not unpacked again)
+
+        :returns: a new LazyNpz, or this one if it was not read from a path
+        """
+        if not isinstance(self.file, str):
+            return self
+        return LazyNpz(self.file, self.cache_dir, self._owner)
+
+    def is_loaded(self, key):
+        """
+        :returns: True if the member is loaded and cached
+        """
+        return key in self._arrays
+
+    def release(self, key=None):
+        """
+        Drop the cached arrays of one member (or of all the members), that
+        will be loaded again if accessed. Arrays that are still referenced
+        elsewhere are not freed.
+
+        :param key: the name of the member (if None, all the members are
+                    released)
+        """
+        with self._lock:
+            if key is None:
+                self._arrays.clear()
+            else:
+                self._arrays.pop(key, None)
+
+    def close(self):
+        """
+        Release all the members and close the npz file. The owner (e.g. the
+        folder of the unpacked members) is released as well, and it is
+        dropped when the arrays loaded so far are not used anymore
+        """
+        self.release()
+        self._zip.close()
+        self._owner = None
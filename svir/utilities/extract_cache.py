@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+# /***************************************************************************
+# Irmt
+#                                 A QGIS plugin
+# OpenQuake Integrated Risk Modelling Toolkit
+#                              -------------------
+#        begin                : 2013-10-24
+#        copyright            : (C) 2013-2026 by GEM Foundation
+#        email                : devops@openquake.org
+# ***************************************************************************/
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from qgis.core import QgsApplication
+from qgis.PyQt.QtCore import QSettings
+
+from svir.utilities.shared import DEFAULT_SETTINGS
+
+# statuses of the calculations whose extracts can be cached (the outputs of
+# a completed calculation do not change)
+CACHEABLE_CALC_STATUSES = ('complete', 'shared')
+
+# attributes of a calculation that change if it is run again (the list of
+# calculations and the status of a single calculation are described by
+# different sets of attributes)
+CALC_FINGERPRINT_KEYS = ('calculation_mode', 'description')
+
+
+def get_extract_cache_max_size():
+    """
+    Get from the QSettings the maximum size of the cache of the extracted
+    npz files
+
+    :returns: the maximum size in bytes (0 means the cache is disabled)
+    """
+    max_size_mb = QSettings().value(
+        'irmt/extract_cache_size_mb',
+        DEFAULT_SETTINGS['extract_cache_size_mb'], type=int)
+    return max(max_size_mb, 0) * 1024 * 1024
+
+
+def canonicalize_params(params):
+    """
+    Build a string representation of the parameters of an extract, that does
+    not depend on the order of the keys
+
+    :param params: a dict of parameters (or None)
+    :returns: a string
+    """
+    return json.dumps(params or {}, sort_keys=True, default=str)
+
+
+def _digest(*values):
+    return hashlib.sha1(json.dumps(
+        values, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+class ExtractCache(object):
+    """
+    Persistent least recently used cache of the npz files extracted from
+    the OpenQuake Engine, stored in the QGIS profile folder and keyed by
+    (hostname, calc_id, extract path, canonicalized parameters). Only the
+    extracts of calculations known to be complete (see :meth:`update_calcs`)
+    are cached, and the entries of a calculation are dropped when it is
+    removed, or when it is not complete anymore or its description changes
+    (i.e. it is run again). When the total size of the cached files exceeds
+    the maximum size (see :func:`get_extract_cache_max_size`), the least
+    recently used files are deleted. Entries can be read and stored from any
+    thread.
+
+    :param cache_dir: the folder containing the cached files (by default, a
+        folder inside the QGIS profile folder)
+    :param max_size: the maximum size of the cache in bytes (by default, it
+        is read from the settings each time a file is stored)
+    """
+    def __init__(self, cache_dir=None, max_size=None):
+        self._cache_dir = cache_dir
+        self.max_size = max_size
+        self._lock = threading.RLock()
+
+    @property
+    def cache_dir(self):
+        if self._cache_dir is None:
+            self._cache_dir = os.path.join(
+                QgsApplication.qgisSettingsDirPath(), 'irmt',
+                'extract_cache')
+        return self._cache_dir
+
+    def _get_max_size(self):
+        if self.max_size is None:
+            return get_extract_cache_max_size()
+        return self.max_size
+
+    def _calc_dir(self, hostname, calc_id):
+        return os.path.join(
+            self.cache_dir, _digest(hostname.rstrip('/'))[:16], str(calc_id))
+
+    def _entry_path(self, hostname, calc_id, extract_path, params):
+        return os.path.join(
+            self._calc_dir(hostname, calc_id), '%s.npz' % _digest(
+                extract_path.strip('/'), canonicalize_params(params)))
+
+    def update_calcs(self, hostname, calc_list):
+        """
+        Register the calculations that are complete, so their extracts can
+        be cached, and drop the entries of the calculations that are not
+        complete anymore or whose description changed (e.g. because they
+        were run again)
+
+        :param hostname: the url of the OpenQuake Engine server
+        :param calc_list: a list of dicts describing the calculations, as
+            returned by the server
+        """
+        for calc in calc_list:
+            if 'id' not in calc:
+                continue
+            calc_dir = self._calc_dir(hostname, calc['id'])
+            info_path = os.path.join(calc_dir, 'calc.json')
+            fingerprint = _digest(
+                *[calc.get(key) for key in CALC_FINGERPRINT_KEYS])
+            with self._lock:
+                if calc.get('status') not in CACHEABLE_CALC_STATUSES:
+                    if os.path.isdir(calc_dir):
+                        self.invalidate(hostname, calc['id'])
+                    continue
+                try:
+                    with open(info_path) as f:
+                        cached_fingerprint = json.load(f)['fingerprint']
+                except (OSError, ValueError, KeyError):
+                    cached_fingerprint = None
+                if cached_fingerprint == fingerprint:
+                    continue
+                self.invalidate(hostname, calc['id'])
+                try:
+                    os.makedirs(calc_dir, exist_ok=True)
+                    with open(info_path, 'w') as f:
+                        json.dump({'fingerprint': fingerprint}, f)
+                except OSError:
+                    # the cache is not writable: extracts are not cached
+                    pass
+
+    def is_cacheable(self, hostname, calc_id):
+        """
+        :returns: True if the calculation was registered as complete
+        """
+        return os.path.isfile(os.path.join(
+            self._calc_dir(hostname, calc_id), 'calc.json'))
+
+    def get(self, hostname, calc_id, extract_path, params=None):
+        """
+        Get the path of a cached npz file, marking it as recently used
+
+        :returns: the path of the file, or None if it is not cached
+        """
+        if not self.is_cacheable(hostname, calc_id):
+            return None
+        path = self._entry_path(hostname, calc_id, extract_path, params)
+        with self._lock:
+            try:
+                os.utime(path)
+            except OSError:
+                return None
+        return path
+
+    def put(self, hostname, calc_id, extract_path, params, npz_path):
+        """
+        Store a copy of an extracted npz file, if the calculation is
+        complete, evicting the least recently used files if the cache is
+        full
+
+        :param npz_path: the path of the extracted npz file
+        :returns: the path of the cached file, or None if it was not cached
+        """
+        max_size = self._get_max_size()
+        if (not self.is_cacheable(hostname, calc_id)
+                or os.path.getsize(npz_path) > max_size):
+            return None
+        path = self._entry_path(hostname, calc_id, extract_path, params)
+        try:
+            # the file is copied next to its destination, then renamed, so
+            # it is never read while it is partially written
+            fd, tmp_path = tempfile.mkstemp(
+                suffix='.tmp', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as dst, open(npz_path, 'rb') as src:
+                shutil.copyfileobj(src, dst)
+            with self._lock:
+                os.replace(tmp_path, path)
+                self.evict(max_size)
+        except OSError:
+            return None
+        return path
+
+    def evict(self, max_size=None):
+        """
+        Delete the least recently used files, until the total size of the
+        cache does not exceed the maximum size
+        """
+        if max_size is None:
+            max_size = self._get_max_size()
+        entries = []
+        with self._lock:
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if not filename.endswith('.npz'):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total_size <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # e.g. the file is open on Windows
+                    continue
+                total_size -= size
+
+    def invalidate(self, hostname=None, calc_id=None):
+        """
+        Drop cached files
+
+        :param hostname: if specified, only the files extracted from this
+                         server are dropped
+        :param calc_id: if specified (with the hostname), only the files
+                        extracted from this calculation are dropped
+        """
+        if hostname is None:
+            path = self.cache_dir
+        elif calc_id is None:
+            path = os.path.dirname(self._calc_dir(hostname, 0))
+        else:
+            path = self._calc_dir(hostname, calc_id)
+        with self._lock:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# cache shared by all the extractions performed by the plugin
+EXTRACT_CACHE = ExtractCache()
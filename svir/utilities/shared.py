@@ -187,6 +187,8 @@ DEFAULT_SETTINGS = dict(
     experimental_enabled=False,
     developer_mode=False,
     log_level='C',
+    max_workers=0,
+    extract_cache_size_mb=1024,
 )
 
 DEFAULT_ENGINE_PROFILES = (
@@ -225,3 +227,12 @@ RAMP_EXTREME_COLORS = {
 }
 
 GEOM_FIELDNAMES = ('geom', 'the_geom', 'geometry', 'wkt')
+
+# attributes of layers having more features than this are transformed in
+# chunks of this size, keeping in memory the ids of the features and only
+# one chunk of values at a time, and writing each chunk directly through the
+# data provider, without undo (see ProcessLayer.transform_attribute)
+TRANSFORMATION_CHUNK_SIZE = 1000000
+# number of features whose attribute values are written at once through the
+# data provider
+WRITE_BATCH_SIZE = 100000
@@ -30,7 +30,6 @@ import sys
 import traceback
 import locale
 import zlib
-import io
 import re
 import html
 from datetime import datetime
@@ -69,6 +68,8 @@ from qgis.PyQt.QtWidgets import (
 from qgis.PyQt.QtGui import QColor
 
 from .shared import DEBUG, DEFAULT_SETTINGS, DEFAULT_ENGINE_PROFILES
+from .engine_client import (
+    fetch_extract, ExtractFailed, EXTRACT_PREFETCHER)
 
 F32 = numpy.float32
 
@@ -1184,35 +1185,34 @@ def get_checksum(file_path):
 
 def extract_npz(
         session, hostname, calc_id, output_type, message_bar, params=None):
-    # NOTE: there is also an asynchronous extract_npz utility that contains
-    # some duplicated code
+    """
+    Extract an output of a calculation from the OpenQuake Engine server,
+    blocking until it is downloaded (see
+    :func:`svir.utilities.engine_client.fetch_extract`), unless it was
+    prefetched when the calculation was selected
+
+    :returns: a :class:`svir.utilities.engine_client.LazyNpz`, or None in
+        case of failure
+    """
+    prefetched = EXTRACT_PREFETCHER.get(
+        hostname, calc_id, output_type, params)
+    if prefetched is not None:
+        return prefetched
     url = '%s/v1/calc/%s/extract/%s' % (hostname, calc_id, output_type)
     log_msg('GET: %s, with parameters: %s' % (url, params), level='I',
             print_to_stderr=True)
-    resp = session.get(url, params=params)
-    if not resp.ok:
-        msg = "Unable to extract %s with parameters %s (%s):\n%s" % (
-            url, params, resp.reason, resp.content.decode('utf8'))
-        log_msg(msg, level='C', message_bar=message_bar, print_to_stderr=True)
-        return
-    resp_content = resp.content
-    msg = 'GET %s returned an empty content!' % url
-    if not resp_content:
-        log_msg(msg, level='C', message_bar=message_bar, print_to_stderr=True)
+    try:
+        extracted_content = fetch_extract(
+            session, hostname, calc_id, output_type, params=params)
+    except ExtractFailed as exc:
+        log_msg(str(exc), level='C', message_bar=message_bar,
+                print_to_stderr=True)
         return
-    extracted_content = numpy.load(io.BytesIO(resp_content),
-                                   allow_pickle=False)
     if not extracted_content:
+        msg = 'GET %s returned an empty content!' % url
         log_msg(msg, level='C', message_bar=message_bar, print_to_stderr=True)
         return
-
-    dic = {}
-    for k, v in extracted_content.items():
-        if k == 'json':
-            dic.update(json.loads(bytes(v)))
-        else:
-            dic[k] = v
-    return dic
+    return extracted_content
 
 
 def convert_bytes(num):